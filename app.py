@@ -1,7 +1,171 @@
-from flask import Flask,jsonify,abort,request
+import os
+import json
+import click
+from datetime import date, timedelta
+from flask import Flask,jsonify,abort,request,Response,stream_with_context,send_file
 from flask_cors import CORS
-from models import setup_db,Actor,Movie,insertInitialData,db
-from auth import AuthError, requires_auth
+from models import setup_db,Actor,Movie,insertInitialData,db,utcnow,insert_returning,update_returning,delete_returning,get_many,actor_query,movie_query,split_movie_partitions,upcoming_release_dates
+from auth import requires_auth, get_request_payload
+from errors import register_error_handlers
+from coalesce import coalesce_reads
+from idempotency import idempotent, purge_expired_keys
+from stats import get_stats, rebuild_stats
+from validation import ValidationError, validate_actor, validate_movie
+from catalog import Catalog, get_catalog, catalog_snapshot
+from batch import validate_batch, run_batch
+from counts import total_count, COUNT_MODES
+from jobs import validate_job, job_permission, submit_job, get_owned_job, get_result_path, run_worker, filtered_query
+from arrow_export import get_export_schema, export_chunks, EXPORT_FORMATS
+from breakers import init_breakers, get_readiness
+from querybudget import query_budget, init_query_budget, query_budget_mode
+from ratelimit import create_store
+from audit import init_audit, get_audit_events, audit_log
+from httpcache import cache_policy, init_http_cache, cache_shared, cache_max_age
+from tenants import init_tenants, tenant_routing, tenant_database_uri, tenant_max_engines, tenant_names
+from changes import get_changes, stream_changes, compact_changes, last_seq_before, change_page_size, change_page_max
+
+multi_get_max_ids = int(os.getenv('MULTI_GET_MAX_IDS', 100))
+
+'''
+    @INPUTS
+        list_permission: permission of the list route (i.e. 'get:actors')
+        item_permission: permission of the single-item route (i.e. 'get:actor')
+
+    Returns the permission for a list route that also serves ?ids= lookups,
+        which need the same permission as the single-item route
+'''
+def list_or_ids_permission(list_permission, item_permission):
+    return lambda: item_permission if 'ids' in request.args else list_permission
+
+'''
+    Returns the JSON body of a PATCH request, or {} if it has no body
+    A body that isn't JSON (malformed, or form-encoded) is returned as None,
+        which validation rejects with a 400
+'''
+def get_patch_body():
+    if not request.get_data():
+        return {}
+    return request.get_json(silent=True)
+
+'''
+    Parses the ?ids=1,2,3 query argument
+    Aborts with 400 if it is malformed or asks for more than multi_get_max_ids
+    Returns the ids in requested order, without duplicates
+'''
+def get_requested_ids():
+    try:
+        ids = [int(id) for id in request.args['ids'].split(',')]
+    except ValueError:
+        abort(400)
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > multi_get_max_ids:
+        abort(400)
+    return ids
+
+'''
+    Parses the optional filters of GET /actors (gender, min_age, max_age)
+    and GET /movies (released_from, released_to, as YYYY-MM-DD)
+    Aborts with 400 if one is malformed
+'''
+def optional_arg(name, convert):
+    value = request.args.get(name)
+    try:
+        return None if value is None else convert(value)
+    except ValueError:
+        abort(400)
+
+def get_actor_filters():
+    return {
+        'gender': request.args.get('gender'),
+        'min_age': optional_arg('min_age', int),
+        'max_age': optional_arg('max_age', int)
+    }
+
+def get_movie_filters():
+    return {
+        'released_from': optional_arg('released_from', date.fromisoformat),
+        'released_to': optional_arg('released_to', date.fromisoformat)
+    }
+
+'''
+    Parses the optional paging of the listings (?limit=&offset=)
+    and the total count mode (?count=exact|estimated|auto, see counts.py)
+    Aborts with 400 if one is malformed
+'''
+def get_page():
+    limit = optional_arg('limit', int)
+    offset = optional_arg('offset', int) or 0
+    if (limit is not None and limit < 0) or offset < 0:
+        abort(400)
+    return limit, offset
+
+def get_count_mode():
+    mode = request.args.get('count')
+    if mode is not None and mode not in COUNT_MODES:
+        abort(400)
+    return mode
+
+'''
+    @INPUTS
+        response: the listing response
+        total: (count, source) from counts.total_count, or None
+
+    Sets X-Total-Count and X-Total-Count-Source (exact, counter or planner)
+'''
+def with_total_count(response, total):
+    if total is not None:
+        response.headers['X-Total-Count'] = str(total[0])
+        response.headers['X-Total-Count-Source'] = total[1]
+    return response
+
+'''
+    @INPUTS
+        model: Actor or Movie
+        rows: the formatted rows of the catalog, or None
+        query: the listing query, if rows is None
+        filters: the listing filters
+        page: (limit, offset) from get_page
+        count_mode: from get_count_mode
+
+    Returns the requested page of the formatted rows, and their total
+        if one was requested with ?count=
+'''
+def list_page(model, rows, query, filters, page, count_mode):
+    limit, offset = page
+    end = None if limit is None else offset + limit
+    if rows is not None:
+        return rows[offset:end], (len(rows), 'exact') if count_mode else None
+
+    total = None
+    if count_mode:
+        filtered = any(value is not None for value in filters.values())
+        total = total_count(model, query, filtered, count_mode)
+    return [row.format() for row in query.offset(offset).limit(limit)], total
+
+'''
+    @INPUTS
+        model: Actor or Movie
+        query: the filtered listing query
+        name: file name of the download, without extension
+
+    Returns the streamed columnar export of the query's rows, in the
+        ?format= (arrow or parquet) and with the ?columns= requested
+    Aborts with 400 if one is malformed
+'''
+def export_response(model, query, name):
+    format = request.args.get('format', 'arrow')
+    if format not in EXPORT_FORMATS:
+        abort(400)
+    try:
+        schema = get_export_schema(model, request.args.get('columns'))
+    except ValueError:
+        abort(400)
+    mimetype, extension = EXPORT_FORMATS[format]
+    return Response(
+        stream_with_context(export_chunks(model, query, schema, format)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={name}.{extension}'}
+    )
 
 def create_app(test_config=None):
     # create and configure the app
@@ -13,8 +177,35 @@ def create_app(test_config=None):
         database_uri = test_config.get('SQLALCHEMY_DATABASE_URI')
         setup_db(app, database_uri=database_uri)
 
-    # Setup cors
-    CORS(app)
+    # Per-agency database routing (see tenants.py)
+    app.config['TENANT_ROUTING'] = (test_config or {}).get('TENANT_ROUTING', tenant_routing)
+    app.config['TENANT_DATABASE_URI'] = (test_config or {}).get('TENANT_DATABASE_URI', tenant_database_uri)
+    app.config['TENANT_MAX_ENGINES'] = (test_config or {}).get('TENANT_MAX_ENGINES', tenant_max_engines)
+    app.config['TENANTS'] = (test_config or {}).get('TENANTS', tenant_names)
+    init_tenants(app)
+
+    # Cache-Control and Surrogate-Key headers, purged on changes (see httpcache.py)
+    app.config['CACHE_SHARED'] = (test_config or {}).get('CACHE_SHARED', cache_shared)
+    app.config['CACHE_MAX_AGE'] = (test_config or {}).get('CACHE_MAX_AGE', cache_max_age)
+    init_http_cache(app, (test_config or {}).get('CACHE_PURGER'))
+
+    # Opt-in SQL statement budgets per route (see querybudget.py)
+    # the budgets below are the worst case for one request
+    app.config['QUERY_BUDGET_MODE'] = (test_config or {}).get('QUERY_BUDGET_MODE', query_budget_mode)
+
+    # Per-client rate limit and concurrency counters (see ratelimit.py)
+    app.extensions['rate_limits'] = (test_config or {}).get('RATE_LIMIT_STORE') or create_store()
+
+    # Write-behind audit log of actor and movie changes (see audit.py)
+    app.config['AUDIT_LOG'] = (test_config or {}).get('AUDIT_LOG', audit_log)
+    app.config['AUDIT_SPOOL_FILE'] = (test_config or {}).get('AUDIT_SPOOL_FILE')
+
+    # Optional in-memory read tier for the GET endpoints
+    if (test_config or {}).get('CATALOG_SNAPSHOT', catalog_snapshot):
+        app.extensions['catalog'] = Catalog()
+
+    # Setup cors (browsers only let other origins read the headers listed here)
+    CORS(app, expose_headers=['X-Total-Count', 'X-Total-Count-Source'])
 
     '''
         Uncomment this only the first time you run this application 
@@ -26,68 +217,154 @@ def create_app(test_config=None):
     #ROUTES
 
     @app.route('/')
+    @query_budget(0)
     def home():
         return "Welcome to Casting Agency app!"
 
-    # GET all actors
+    # Liveness: the process is up (no database or Auth0 call)
+    @app.route('/healthz', methods=['GET'])
+    @query_budget(0)
+    def healthz():
+        return jsonify({'success': True}), 200
+
+    # Readiness: the circuit breaker states (no token needed)
+    @app.route('/readyz', methods=['GET'])
+    @query_budget(1)
+    def readyz():
+        body, status_code = get_readiness()
+        return jsonify(body), status_code
+
+    # GET all actors, or the actors listed in ?ids=
+    # (?count= adds up to 4: bounded count, counter, planner estimate, exact fallback)
     @app.route('/actors', methods=['GET'])
-    @requires_auth('get:actors')
+    @query_budget(5)
+    @cache_policy('actors-list')
+    @requires_auth(list_or_ids_permission('get:actors', 'get:actor'))
+    @coalesce_reads('get:actors')
     def get_actors(payload):
-        try:
-            actors = Actor.query.all()
+        catalog = get_catalog()
+        if 'ids' in request.args:
+            ids = get_requested_ids()
+            actors, missing = catalog.get_many('actor', ids) if catalog else get_many(Actor, ids)
             return jsonify({
                 'success': True,
-                'actors': [actor.format() for actor in actors]
+                'actors': actors,
+                'missing': missing
             }), 200
+
+        filters = get_actor_filters()
+        page = get_page()
+        count_mode = get_count_mode()
+        try:
+            if catalog:
+                actors, total = list_page(Actor, catalog.filter_actors(**filters), None, filters, page, count_mode)
+            else:
+                actors, total = list_page(Actor, None, actor_query(**filters), filters, page, count_mode)
+            return with_total_count(jsonify({
+                'success': True,
+                'actors': actors
+            }), total), 200
         except:
             abort(500)
 
+    # GET the filtered actors as an Arrow or Parquet file (see arrow_export.py)
+    # (the rows are read while the response streams, which isn't counted)
+    @app.route('/actors/export', methods=['GET'])
+    @query_budget(0)
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export_response(Actor, actor_query(**get_actor_filters()), 'actors')
+
     # GET a specific actor by id
     @app.route('/actors/<int:actor_id>', methods=['GET'])
-    @requires_auth('get:actor') 
+    @query_budget(1)
+    @cache_policy('actor-{actor_id}')
+    @requires_auth('get:actor')
+    @coalesce_reads('get:actor')
     def get_actor(payload,actor_id):
-        actor = db.session.get(Actor, actor_id)
+        catalog = get_catalog()
+        if catalog:
+            actor = catalog.get('actor', actor_id)
+        else:
+            actor = db.session.get(Actor, actor_id)
+            actor = actor and actor.format()
         if actor is None:
             abort(404)
         return jsonify({
             'success': True,
-            'actor': actor.format()
+            'actor': actor
         }), 200
 
-    # GET all movies
+    # GET all movies, or the movies listed in ?ids=
+    # (?count= adds up to 4: bounded count, counter, planner estimate, exact fallback)
     @app.route('/movies', methods=['GET'])
-    @requires_auth('get:movies')
+    @query_budget(5)
+    @cache_policy('movies-list')
+    @requires_auth(list_or_ids_permission('get:movies', 'get:movie'))
+    @coalesce_reads('get:movies')
     def get_movies(payload):
-        try:
-            movies = Movie.query.all()
+        catalog = get_catalog()
+        if 'ids' in request.args:
+            ids = get_requested_ids()
+            movies, missing = catalog.get_many('movie', ids) if catalog else get_many(Movie, ids)
             return jsonify({
                 'success': True,
-                'movies': [movie.format() for movie in movies]
+                'movies': movies,
+                'missing': missing
             }), 200
+
+        filters = get_movie_filters()
+        page = get_page()
+        count_mode = get_count_mode()
+        try:
+            if catalog:
+                movies, total = list_page(Movie, catalog.filter_movies(**filters), None, filters, page, count_mode)
+            else:
+                movies, total = list_page(Movie, None, movie_query(**filters), filters, page, count_mode)
+            return with_total_count(jsonify({
+                'success': True,
+                'movies': movies
+            }), total), 200
         except:
             abort(500)
 
+    # GET the filtered movies as an Arrow or Parquet file (see arrow_export.py)
+    @app.route('/movies/export', methods=['GET'])
+    @query_budget(0)
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export_response(Movie, movie_query(**get_movie_filters()), 'movies')
+
     # GET a specific movie by id
     @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @query_budget(1)
+    @cache_policy('movie-{movie_id}')
     @requires_auth('get:movie')
+    @coalesce_reads('get:movie')
     def get_movie(payload,movie_id):
-        movie = Movie.query.get(movie_id)
+        catalog = get_catalog()
+        if catalog:
+            movie = catalog.get('movie', movie_id)
+        else:
+            movie = db.session.get(Movie, movie_id)
+            movie = movie and movie.format()
         if movie is None:
             abort(404)
         return jsonify({
             'success': True,
-            'movie': movie.format()
+            'movie': movie
         }), 200
 
     # DELETE an actor by id
+    # (delete, the change seq lock on PostgreSQL, change log, stats)
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @query_budget(4)
     @requires_auth('delete:actors')
     def delete_actor(payload,actor_id):
-        actor = Actor.query.get(actor_id)
+        actor = delete_returning(Actor, actor_id)
         if actor is None:
             abort(404)
 
-        actor.delete()
         return jsonify({
             'success': True,
             'deleted': actor_id
@@ -95,151 +372,278 @@ def create_app(test_config=None):
 
     # DELETE a movie by id
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
+    @query_budget(4)
     @requires_auth('delete:movies')
     def delete_movie(payload,movie_id):
-        movie = Movie.query.get(movie_id)
+        movie = delete_returning(Movie, movie_id)
         if movie is None:
             abort(404)
 
-        movie.delete()
         return jsonify({
             'success': True,
             'deleted': movie_id
         }), 200
 
     # POST (create) a new actor
+    # (insert, the change seq lock on PostgreSQL, change log, stats;
+    # an Idempotency-Key adds its insert and update)
     @app.route('/actors', methods=['POST'])
+    @query_budget(6)
     @requires_auth('post:actors')
+    @idempotent
     def create_actor(payload):
-        body = request.get_json()
-        if not body or not body.get('name') or not body.get('age') or not body.get('gender'):
-            abort(400)
-        
+        values = validate_actor(request.get_json(silent=True))
+
         try:
-            new_actor = Actor(
-                name=body['name'],
-                age=body['age'],
-                gender=body['gender']
-            )
-            new_actor.insert()
+            new_actor = insert_returning(Actor, values)
             return jsonify({
                 'success': True,
-                'created': new_actor.id,
-                'actor': new_actor.format()
+                'created': new_actor['id'],
+                'actor': new_actor
             }), 201  # HTTP 201: Created
         except:
             abort(500)
 
     # POST (create) a new movie
     @app.route('/movies', methods=['POST'])
+    @query_budget(6)
     @requires_auth('post:movies')
+    @idempotent
     def create_movie(payload):
-        body = request.get_json()
-        if not body or not body.get('title') or not body.get('release_date'):
-            abort(400)
-        
+        values = validate_movie(request.get_json(silent=True))
+
         try:
-            new_movie = Movie(
-                title=body['title'],
-                release_date=body['release_date']
-            )
-            new_movie.insert()
+            new_movie = insert_returning(Movie, values)
             return jsonify({
                 'success': True,
-                'created': new_movie.id,
-                'movie': new_movie.format()
+                'created': new_movie['id'],
+                'movie': new_movie
             }), 201  # HTTP 201: Created
         except:
             abort(500)
 
     # PATCH (update) an existing actor by id
+    # (update, the change seq lock on PostgreSQL, change log, stats; a change
+    # to age or gender locks the row first, for the stats)
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @query_budget(5)
     @requires_auth('patch:actors')
     def update_actor(payload,actor_id):
-        actor = Actor.query.get(actor_id)
-        if actor is None:
-            abort(404)
-        
-        body = request.get_json()
+        values = validate_actor(get_patch_body(), partial=True)
         try:
-            if 'name' in body:
-                actor.name = body['name']
-            if 'age' in body:
-                actor.age = body['age']
-            if 'gender' in body:
-                actor.gender = body['gender']
-            
-            actor.update()
-            return jsonify({
-                'success': True,
-                'actor': actor.format()
-            }), 200
+            actor = update_returning(Actor, actor_id, values)
         except:
             abort(500)
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actor': actor
+        }), 200
 
     # PATCH (update) an existing movie by id
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @query_budget(5)
     @requires_auth('patch:movies')
     def update_movie(payload,movie_id):
-        movie = Movie.query.get(movie_id)
-        if movie is None:
-            abort(404)
-        
-        body = request.get_json()
+        values = validate_movie(get_patch_body(), partial=True)
         try:
-            if 'title' in body:
-                movie.title = body['title']
-            if 'release_date' in body:
-                movie.release_date = body['release_date']
-            
-            movie.update()
-            return jsonify({
-                'success': True,
-                'movie': movie.format()
-            }), 200
+            movie = update_returning(Movie, movie_id, values)
         except:
             abort(500)
+        if movie is None:
+            abort(404)
 
-    #Error handlers
-    @app.errorhandler(400)
-    def bad_request(error):
         return jsonify({
-            'success': False,
-            'error': 400,
-            'message': 'Bad request.'
-        }), 400
+            'success': True,
+            'movie': movie
+        }), 200
+
+    # GET the change log of actors and movies after a given seq
+    @app.route('/changes', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:changes')
+    def get_change_log(payload):
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', change_page_size))
+        except ValueError:
+            abort(400)
+        if since < 0 or limit < 1:
+            abort(400)
+
+        changes = get_changes(since, min(limit, change_page_max))
+        return jsonify({
+            'success': True,
+            'changes': [change.format() for change in changes],
+            'next_since': changes[-1].seq if changes else since,
+            'has_more': len(changes) == min(limit, change_page_max)
+        }), 200
+
+    # GET who changed which actor or movie, after a given audit event id
+    # (events are written a moment after the change, see audit.py)
+    @app.route('/audit', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:audit')
+    def get_audit_log(payload):
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', change_page_size))
+        except ValueError:
+            abort(400)
+        entity_id = optional_arg('entity_id', int)
+        if since < 0 or limit < 1:
+            abort(400)
+
+        events = get_audit_events(
+            since, min(limit, change_page_max),
+            subject=request.args.get('subject'),
+            entity=request.args.get('entity'),
+            entity_id=entity_id
+        )
+        return jsonify({
+            'success': True,
+            'events': [event.format() for event in events],
+            'next_since': events[-1].id if events else since,
+            'has_more': len(events) == min(limit, change_page_max)
+        }), 200
+
+    # GET the change log as a server-sent event stream
+    # (the stream's polling runs after the response starts and isn't counted)
+    @app.route('/changes/stream', methods=['GET'])
+    @query_budget(0)
+    @requires_auth('get:changes')
+    def stream_change_log(payload):
+        try:
+            since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+        except ValueError:
+            abort(400)
+
+        return Response(
+            stream_with_context(stream_changes(since)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    # GET aggregate statistics of actors and movies
+    @app.route('/stats', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:stats')
+    @coalesce_reads('get:stats')
+    def get_statistics(payload):
+        return jsonify({
+            'success': True,
+            'stats': get_stats()
+        }), 200
+
+    # POST many sub-requests verified with a single auth check
+    # (each sub-request is counted against its own route's budget)
+    @app.route('/batch', methods=['POST'])
+    @query_budget(0)
+    def run_batch_requests():
+        payload = get_request_payload()
+        items = request.get_json(silent=True)
+        validate_batch(items)
 
-    @app.errorhandler(404)
-    def not_found(error):
         return jsonify({
-            'success': False,
-            'error': 404,
-            'message': 'Resource not found.'
-        }), 404
+            'success': True,
+            'responses': run_batch(app, items, payload)
+        }), 200
 
-    @app.errorhandler(422)
-    def unprocessable_entity(error):
+    #CLI commands
+    # POST a bulk import, delete or export job (run by `flask worker`)
+    @app.route('/jobs', methods=['POST'])
+    @query_budget(1)
+    @requires_auth(job_permission)
+    def create_job(payload):
+        body = request.get_json(silent=True)
+        params = validate_job(body)
+        job = submit_job(body['kind'], params, owner=payload.get('sub'))
         return jsonify({
-            'success': False,
-            'error': 422,
-            'message': 'Unprocessable entity.'
-        }), 422
+            'success': True,
+            'job': job
+        }), 202, {'Location': f'/jobs/{job["id"]}'}
 
-    @app.errorhandler(500)
-    def internal_server_error(error):
+    # GET the status and progress of a job
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:jobs')
+    def get_job(payload,job_id):
+        job = get_owned_job(job_id, payload)
         return jsonify({
-            'success': False,
-            'error': 500,
-            'message': 'Internal server error.'
-        }), 500
+            'success': True,
+            'job': job.format()
+        }), 200
 
-    @app.errorhandler(AuthError)
-    def handle_auth_error(error):
+    # GET the result of a finished job (the JSON lines file of an export)
+    @app.route('/jobs/<int:job_id>/result', methods=['GET'])
+    @query_budget(1)
+    @requires_auth('get:jobs')
+    def get_job_result(payload,job_id):
+        job = get_owned_job(job_id, payload)
+        if job.status != 'succeeded':
+            abort(409)
+        if job.kind == 'export':
+            return send_file(get_result_path(job.id), mimetype='application/x-ndjson')
         return jsonify({
-            "success": False,
-            "error": error.status_code,
-            "message": error.error['description']
-        }), error.status_code
+            'success': True,
+            'result': job.format()['result']
+        }), 200
+
+    @app.cli.command('worker')
+    @click.option('--threads', default=2, help='Number of worker threads.')
+    @click.option('--burst', is_flag=True, help='Exit once there are no queued jobs left.')
+    def worker(threads, burst):
+        run_worker(app, threads=threads, burst=burst)
+
+    @app.cli.command('export')
+    @click.argument('entity', type=click.Choice(['actors', 'movies']))
+    @click.argument('output', type=click.Path(dir_okay=False, writable=True))
+    @click.option('--format', 'format', default='parquet', type=click.Choice(list(EXPORT_FORMATS)))
+    @click.option('--columns', default=None, help='Comma separated columns to export (default: all).')
+    @click.option('--filters', default='{}', help='Listing filters as JSON, i.e. {"min_age": 30}.')
+    def export(entity, output, format, columns, filters):
+        try:
+            model, query = filtered_query({'entity': entity, 'filters': json.loads(filters)})
+            schema = get_export_schema(model, columns)
+        except (ValueError, ValidationError) as error:
+            raise click.BadParameter(str(getattr(error, 'errors', error)))
+        with open(output, 'wb') as output_file:
+            for chunk in export_chunks(model, query, schema, format):
+                output_file.write(chunk)
+        print(f'Exported {entity} to {output}.')
+
+    @app.cli.command('partition-movies')
+    def partition_movies():
+        created = split_movie_partitions(db.engine) + split_movie_partitions(db.engine, upcoming_release_dates())
+        print(f'Created {created} movie partitions.')
+
+    @app.cli.command('purge-idempotency-keys')
+    def purge_idempotency_keys():
+        print(f'Purged {purge_expired_keys()} expired idempotency keys.')
+
+    @app.cli.command('rebuild-stats')
+    def rebuild_statistics():
+        print(f'Rebuilt {rebuild_stats()} stats counters.')
+
+    @app.cli.command('compact-changes')
+    @click.option('--older-than-days', default=7, help='Compact change log entries older than this.')
+    def compact_change_log(older_than_days):
+        before_seq = last_seq_before(utcnow() - timedelta(days=older_than_days))
+        print(f'Removed {compact_changes(before_seq)} change log entries.')
+
+    # Fail fast while the database circuit is open
+    init_breakers(app)
+
+    # Buffer the audit events of committed changes
+    init_audit(app)
+
+    # Count the SQL statements of each request against the route's budget
+    init_query_budget(app)
+
+    #Error handlers
+    register_error_handlers(app)
 
     return app
 
@@ -0,0 +1,127 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from models import db, Actor, Movie
+
+'''
+    Columnar export of actors and movies (Arrow IPC stream or Parquet)
+
+    The rows are read with a streaming cursor (yield_per) and converted
+    to Arrow record batches of export_batch_size rows, which are written
+    out one by one: memory stays bounded by one batch, whatever the size
+    of the table. Columns are typed (release_date is date32, age int16)
+    so analytics tools load them without parsing JSON
+    Only the requested columns are selected, and the listing filters are
+    applied in the query (projection and filter pushdown)
+'''
+
+export_batch_size = int(os.getenv('EXPORT_BATCH_SIZE', 10000))
+
+EXPORT_SCHEMAS = {
+    Actor: pa.schema([
+        ('id', pa.int32()),
+        ('name', pa.string()),
+        ('age', pa.int16()),
+        ('gender', pa.string())
+    ]),
+    Movie: pa.schema([
+        ('id', pa.int32()),
+        ('title', pa.string()),
+        ('release_date', pa.date32())
+    ])
+}
+
+EXPORT_FORMATS = {
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
+
+
+'''
+    @INPUTS
+        model: Actor or Movie
+        columns: comma separated column names, or None for all of them
+
+    Returns the export schema of those columns
+    Raises ValueError for an unknown column
+'''
+def get_export_schema(model, columns=None):
+    schema = EXPORT_SCHEMAS[model]
+    if not columns:
+        return schema
+    names = list(dict.fromkeys(name.strip() for name in columns.split(',')))
+    unknown = [name for name in names if schema.get_field_index(name) < 0]
+    if unknown or not names:
+        raise ValueError(f'Unknown columns: {", ".join(unknown)}')
+    return pa.schema([schema.field(name) for name in names])
+
+
+'''
+    @INPUTS
+        model: Actor or Movie
+        query: the filtered listing query (see actor_query / movie_query)
+        schema: from get_export_schema
+
+    Yields the matching rows as record batches of at most export_batch_size rows
+'''
+def record_batches(model, query, schema):
+    statement = query.with_entities(*[getattr(model, name) for name in schema.names]).statement
+    result = db.session.execute(statement.execution_options(yield_per=export_batch_size))
+    for rows in result.partitions():
+        columns = list(zip(*rows))
+        yield pa.record_batch([
+            pa.array(values, type=field.type) for values, field in zip(columns, schema)
+        ], schema=schema)
+
+
+'''
+    File-like sink collecting what the writers write, so it can be
+    handed out chunk by chunk (see export_chunks)
+'''
+class ChunkSink:
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def open_writer(format, sink, schema):
+    if format == 'parquet':
+        return pq.ParquetWriter(sink, schema)
+    return pa.ipc.new_stream(sink, schema)
+
+
+'''
+    @INPUTS
+        model: Actor or Movie
+        query: the filtered listing query
+        schema: from get_export_schema
+        format: arrow or parquet (see EXPORT_FORMATS)
+
+    Yields the export as bytes, one chunk per record batch
+    (each batch is one Parquet row group)
+'''
+def export_chunks(model, query, schema, format):
+    sink = ChunkSink()
+    writer = open_writer(format, pa.PythonFile(sink, mode='w'), schema)
+    try:
+        for batch in record_batches(model, query, schema):
+            writer.write_batch(batch)
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
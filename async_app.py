@@ -0,0 +1,48 @@
+if __name__ == '__main__':
+    # must run before anything imports socket, ssl or threading
+    from gevent import monkey
+    monkey.patch_all()
+
+import os
+import sys
+from app import create_app
+from models import db_driver
+
+'''
+    Cooperative variant of the API, for slow upstreams (Auth0, the database)
+
+    It serves the app of create_app (the same routes, responses and error
+    handlers) on gevent: with the standard library patched, a request
+    waiting on the JWKS fetch or on PostgreSQL yields to the other
+    requests of its worker instead of holding it, so one worker process
+    serves up to --worker-connections requests at once
+        gunicorn -k gevent --worker-connections 200 async_app:app
+    (without --preload: the worker has to patch before the app is loaded)
+    psycopg 3 waits cooperatively on its own, psycopg2 through psycogreen;
+    SQLite queries still block
+    Flask async views would not do this: Flask runs each of them to the
+    end in an event loop of its own, holding the worker thread meanwhile
+'''
+
+def gevent_patched():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+'''
+    Makes psycopg2 wait for the server through gevent (psycopg 3 detects
+    the patched modules by itself)
+'''
+def patch_database_driver():
+    if gevent_patched() and db_driver == 'psycopg2':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+def create_async_app(test_config=None):
+    patch_database_driver()
+    return create_app(test_config)
+
+app = create_async_app()
+
+if __name__ == '__main__':
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('0.0.0.0', int(os.getenv('PORT', 5000))), app).serve_forever()
@@ -0,0 +1,340 @@
+import os
+import re
+import glob
+import json
+import time
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+from collections import deque
+from datetime import datetime
+from flask import g, current_app, has_app_context
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+from models import db, Change, AuditEvent, pipeline, lock_sequence, AUDIT_ID_LOCK
+from tenants import current_tenant
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no lock between processes (run a single worker process)
+    fcntl = None
+
+'''
+    Audit log of actor and movie changes: who (the token's sub) changed
+    which row, and when (GET /audit)
+
+    Writing the audit row inside every mutation's transaction would add
+    an insert to each write, so events are written behind instead:
+        - an event is collected for every change log row a session flushes,
+          and handed to the app's AuditLog once the session commits
+          (events of a rolled back transaction are dropped)
+        - a flusher thread writes the buffered events with multi-row
+          INSERTs, once audit_batch_size are waiting or every
+          audit_flush_seconds
+        - at most audit_max_events are buffered: a write that finds the
+          buffer full waits up to audit_block_seconds for the flusher,
+          then appends its events to the spool file instead
+        - events that can't be written (the database is down) are
+          appended to the spool file too, and replayed by the next flush;
+          the buffer is flushed at exit
+        - events are written to the database of the tenant that made the
+          change (see tenants.py), in id order (see models.lock_sequence)
+    The worker processes of a host share the spool file: appending to it
+    and moving it aside to be replayed happen under a file lock, and each
+    process replays its own copy (spool.<pid>.replay), or the one left by
+    a dead process; lines that can't be parsed (a torn last line) are
+    moved to spool.bad
+    A worker killed outright loses the events of its last flush interval
+'''
+
+# AUDIT_LOG=off stops collecting events
+audit_log = os.getenv('AUDIT_LOG', 'on')
+audit_batch_size = int(os.getenv('AUDIT_BATCH_SIZE', 200))
+audit_flush_seconds = float(os.getenv('AUDIT_FLUSH_SECONDS', 1))
+audit_max_events = int(os.getenv('AUDIT_MAX_EVENTS', 10000))
+audit_block_seconds = float(os.getenv('AUDIT_BLOCK_SECONDS', 1))
+# must survive a restart of the worker (one file per host)
+audit_spool_file = os.getenv('AUDIT_SPOOL_FILE', os.path.join(tempfile.gettempdir(), 'casting-agency-audit.jsonl'))
+
+
+'''
+AuditLog
+    the write-behind buffer of one app, and its flusher thread
+    (started by the first event, so it runs in the worker process)
+'''
+class AuditLog:
+    def __init__(self, engine, logger, spool_path=None, batch_size=None, flush_seconds=None,
+                 max_events=None, block_seconds=None, router=None):
+        self.engine = engine
+        self.router = router
+        self.logger = logger
+        self.spool_path = spool_path or audit_spool_file
+        self.batch_size = batch_size or audit_batch_size
+        self.flush_seconds = flush_seconds or audit_flush_seconds
+        self.max_events = max_events or audit_max_events
+        self.block_seconds = audit_block_seconds if block_seconds is None else block_seconds
+        self.events = deque()
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.spool_lock = threading.Lock()
+        self.thread = None
+
+    '''
+        Buffers events for the flusher, waiting up to block_seconds if the
+        buffer is full; spools them if it still is
+    '''
+    def record(self, events):
+        with self.condition:
+            self.start()
+            deadline = time.monotonic() + self.block_seconds
+            while len(self.events) + len(events) > self.max_events:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.notify_all()
+                self.condition.wait(remaining)
+            else:
+                self.events.extend(events)
+                if len(self.events) >= self.batch_size:
+                    self.condition.notify_all()
+                return
+        self.logger.warning(f'Audit buffer full, spooling {len(events)} events')
+        self.spool(events)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            with self.condition:
+                if len(self.events) < self.batch_size:
+                    self.condition.wait(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                self.logger.exception('Audit flush failed')
+
+    def take(self):
+        with self.condition:
+            events = list(self.events)
+            self.events.clear()
+            self.condition.notify_all()
+        return events
+
+    '''
+        Writes the spooled, then the buffered events; spools the ones
+        that couldn't be written
+        Returns the number of buffered events taken
+    '''
+    def flush(self):
+        with self.flush_lock:
+            events = self.take()
+            spooled, replay_path = self.take_spool()
+            failed = self.write(spooled + events)
+            if replay_path:
+                os.remove(replay_path)
+            self.spool(failed)
+            return len(events)
+
+    '''
+        Writes the events to the database of their tenant (see tenants.py)
+        Returns the events that couldn't be written
+    '''
+    def write(self, events):
+        groups = {}
+        for event in events:
+            row = dict(event)
+            groups.setdefault(row.pop('tenant', None), []).append(row)
+
+        failed = []
+        for tenant, rows in groups.items():
+            try:
+                engine = self.engine if tenant is None else self.router.engine_for(tenant)
+                with engine.begin() as connection:
+                    lock_sequence(connection, AUDIT_ID_LOCK)
+                    # the batches of a large flush (a spool replay) are sent back to back
+                    with pipeline(connection):
+                        for start in range(0, len(rows), self.batch_size):
+                            connection.execute(insert(AuditEvent.__table__).values(rows[start:start + self.batch_size]))
+            except Exception:
+                self.logger.exception(f'Audit flush failed, spooling {len(rows)} events')
+                failed += [dict(row, tenant=tenant) for row in rows]
+        return failed
+
+    '''
+        Holds the spool file lock, shared by this worker's threads and
+        by the other worker processes of the host
+    '''
+    @contextmanager
+    def spool_file_lock(self):
+        with self.spool_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.spool_path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def spool(self, events):
+        if not events:
+            return
+        with self.spool_file_lock(), open(self.spool_path, 'a') as spool_file:
+            for event in events:
+                spool_file.write(json.dumps(event, default=str) + '\n')
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+
+    '''
+        Returns the replay files of processes that are gone
+    '''
+    def orphaned_replays(self):
+        if fcntl is None:
+            return []
+        orphans = []
+        for path in glob.glob(glob.escape(self.spool_path) + '.*.replay'):
+            match = re.search(r'\.(\d+)\.replay$', path)
+            if match is None:
+                continue
+            try:
+                os.kill(int(match.group(1)), 0)
+            except ProcessLookupError:
+                orphans.append(path)
+            except OSError:
+                pass
+        return orphans
+
+    '''
+        Moves the spool file aside (so events spooled meanwhile go to a
+        new one), unless this process still has one to replay or can take
+        over the one of a dead process
+        Returns its events and its path
+    '''
+    def take_spool(self):
+        replay_path = f'{self.spool_path}.{os.getpid()}.replay'
+        if not os.path.exists(replay_path):
+            candidates = self.orphaned_replays() + [self.spool_path]
+            if not any(os.path.exists(path) for path in candidates):
+                return [], None
+            with self.spool_file_lock():
+                # another process may have taken them meanwhile
+                for path in self.orphaned_replays() + [self.spool_path]:
+                    if os.path.exists(path):
+                        os.replace(path, replay_path)
+                        break
+        if not os.path.exists(replay_path):
+            return [], None
+
+        events, unparsable = [], []
+        with open(replay_path) as spool_file:
+            for line in spool_file:
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                    event['created_at'] = datetime.fromisoformat(event['created_at'])
+                    events.append(event)
+                except (ValueError, TypeError, KeyError):
+                    unparsable.append(line if line.endswith('\n') else line + '\n')
+        if unparsable:
+            self.logger.warning(f'Moving {len(unparsable)} unparsable spooled audit events to {self.spool_path}.bad')
+            with self.spool_file_lock(), open(self.spool_path + '.bad', 'a') as bad_file:
+                bad_file.writelines(unparsable)
+        return events, replay_path
+
+
+'''
+    Returns who is making the current change: the subject set by
+    audit_subject (i.e. a job's owner), or else the sub (azp if there
+    is none) of the request's token
+'''
+def get_subject():
+    subject = g.get('audit_subject')
+    if subject is None:
+        payload = g.get('auth_payload') or g.get('batch_payload') or {}
+        subject = payload.get('sub') or payload.get('azp')
+    return subject
+
+
+def get_audit_log():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('audit')
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_audit_events(session, flush_context):
+    if get_audit_log() is None:
+        return
+    changes = [instance for instance in session.new if isinstance(instance, Change)]
+    if changes:
+        subject = get_subject()
+        tenant = current_tenant()
+        session.info.setdefault('audit_events', []).extend({
+            'tenant': tenant,
+            'subject': subject,
+            'entity': change.entity,
+            'entity_id': change.entity_id,
+            'op': change.op,
+            'change_seq': change.seq,
+            'created_at': change.created_at
+        } for change in changes)
+
+@event.listens_for(Session, 'after_commit')
+def record_audit_events(session):
+    events = session.info.pop('audit_events', None)
+    audit_log = get_audit_log()
+    if events and audit_log is not None:
+        audit_log.record(events)
+
+@event.listens_for(Session, 'after_rollback')
+def drop_audit_events(session):
+    session.info.pop('audit_events', None)
+
+
+'''
+    @INPUTS
+        since: last audit event id the client has seen
+        limit: max number of events returned
+        subject, entity, entity_id: optional filters
+
+    Returns the matching audit events with id > since, oldest first
+    (served by ix_audit_subject and ix_audit_entity)
+'''
+def get_audit_events(since, limit, subject=None, entity=None, entity_id=None):
+    query = AuditEvent.query.filter(AuditEvent.id > since)
+    if subject is not None:
+        query = query.filter(AuditEvent.subject == subject)
+    if entity is not None:
+        query = query.filter(AuditEvent.entity == entity)
+    if entity_id is not None:
+        query = query.filter(AuditEvent.entity_id == entity_id)
+    return query.order_by(AuditEvent.id).limit(limit).all()
+
+
+'''
+    @INPUTS
+        app: a flask application
+        engine: the engine the events are written with (defaults to db.engine)
+
+    Gives the app an AuditLog (app.extensions['audit']) unless
+    app.config['AUDIT_LOG'] is off
+'''
+def init_audit(app, engine=None):
+    if app.config.get('AUDIT_LOG', 'on') == 'off':
+        return
+    if engine is None:
+        with app.app_context():
+            engine = db.engine
+    app.extensions['audit'] = AuditLog(
+        engine, app.logger,
+        spool_path=app.config.get('AUDIT_SPOOL_FILE'),
+        router=app.extensions.get('tenants')
+    )
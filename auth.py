@@ -1,11 +1,15 @@
 import json
-from flask import request
+from flask import request, g, current_app
 from functools import wraps
-from jose import jwt
+from jose import jwt, jwk
 from urllib.request import urlopen
 import requests
 import os
 from dotenv import load_dotenv
+from coalesce import SingleFlight
+from breakers import auth0_breaker, get_database_breaker
+from ratelimit import client_limits
+from tenants import resolve_tenant, set_tenant
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,6 +18,20 @@ auth0_domain = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 api_audience = os.getenv('API_AUDIENCE')
 
+# concurrent JWKS fetches for the same url share one request
+jwks_flight = SingleFlight()
+
+# a JWKS request that takes longer than this fails (and counts against
+# the auth0 circuit breaker) instead of holding the worker
+jwks_connect_timeout = float(os.getenv('JWKS_CONNECT_TIMEOUT', 3))
+jwks_read_timeout = float(os.getenv('JWKS_READ_TIMEOUT', 5))
+
+# auth0  - every token is verified against the Auth0 JWKS
+# mixed  - tokens from a trusted issuer are verified offline, others with Auth0
+# local  - only tokens from a trusted issuer are accepted (no network calls)
+auth_mode = os.getenv('AUTH_MODE', 'mixed')
+trusted_issuers_file = os.getenv('TRUSTED_ISSUERS_FILE')
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -93,20 +111,100 @@ def check_permissions(permission, payload):
     return True
 
 
+'''
+    @INPUTS
+        payload: decoded jwt payload
+
+    If the app routes tenants (see tenants.py), this method makes the
+        tenant claim of the payload the request's tenant
+    It raises an AuthError if the claim is missing or not a valid tenant,
+        and a DependencyError while the tenant's database circuit is open
+'''
+def check_tenant(payload):
+    router = current_app.extensions.get('tenants')
+    try:
+        tenant = resolve_tenant(router, payload)
+    except ValueError as error:
+        raise AuthError({
+            'code': 'invalid_tenant',
+            'description': str(error)
+        }, 403)
+    if router is not None:
+        set_tenant(tenant)
+        # fail fast while the tenant's database circuit is open
+        get_database_breaker(tenant).check()
+
+
+'''
+    This method returns the Auth0 /.well-known/jwks.json url
+'''
+def get_jwks_url():
+    return f'https://{auth0_domain}/.well-known/jwks.json'
+
+
+'''
+    @INPUTS
+        jwks_url: url of the key set (defaults to the Auth0 one)
+
+    This method fetches the JSON web key set with a blocking request
+    Concurrent calls for the same url are coalesced into one request
+    The request goes through the auth0 circuit breaker: once Auth0 keeps
+        failing, callers get a DependencyError (503) without waiting
+'''
+def request_jwks(jwks_url):
+    response = requests.get(jwks_url, timeout=(jwks_connect_timeout, jwks_read_timeout))
+    response.raise_for_status()
+    return response.json()
+
+def fetch_jwks(jwks_url=None):
+    jwks_url = jwks_url or get_jwks_url()
+    return jwks_flight.do(jwks_url, lambda: auth0_breaker.call(
+        lambda: request_jwks(jwks_url),
+        errors=(requests.RequestException, ValueError)
+    ))
+
+
 '''
     @INPUTS
         token: a json web token (string)
-        The token is an Auth0 token with key id (kid)
-    This method verifies the token using Auth0 /.well-known/jwks.json
+        key: the public key (jwk dict, PEM or a constructed jose key)
+        **options: passed on to jwt.decode (algorithms, audience, issuer...)
+
+    This method verifies the signature and claims of the token
+    It raises an AuthError for expired tokens, wrong claims or bad tokens
+    returns the decoded payload
+'''
+def decode_with_key(token, key, **options):
+    try:
+        return jwt.decode(token, key, **options)
+    except jwt.ExpiredSignatureError:
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, 401)
+
+    except jwt.JWTClaimsError:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
+        }, 401)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+
+'''
+    @INPUTS
+        token: a json web token (string)
+        jwks: the JSON web key set the token was signed with
+
     It decodes the payload from the token and validates the claims
     finally returns the decoded payload
 
 '''
-def verify_decode_jwt(token):
-    jwks_url = f'https://{auth0_domain}/.well-known/jwks.json'
-    response = requests.get(jwks_url)
-    jwks = response.json()
-
+def decode_jwt(token, jwks):
     # Get the key ID from the token header
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
@@ -126,55 +224,185 @@ def verify_decode_jwt(token):
                 'e': key['e']
             }
     if rsa_key:
-        try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=api_audience,
-                issuer='https://' + auth0_domain + '/'
-            )
-
-            return payload
-        except jwt.ExpiredSignatureError:
-            raise AuthError({
-                'code': 'token_expired',
-                'description': 'Token expired.'
-            }, 401)
-
-        except jwt.JWTClaimsError:
-            raise AuthError({
-                'code': 'invalid_claims',
-                'description': 'Incorrect claims. Please, check the audience and issuer.'
-            }, 401)
-        except Exception:
-            raise AuthError({
-                'code': 'invalid_header',
-                'description': 'Unable to parse authentication token.'
-            }, 400)
+        return decode_with_key(
+            token,
+            rsa_key,
+            algorithms=ALGORITHMS,
+            audience=api_audience,
+            issuer='https://' + auth0_domain + '/'
+        )
     raise AuthError({
                 'code': 'invalid_header',
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
+
+'''
+    @INPUTS
+        path: a JSON file listing the trusted issuers, i.e.
+            {"issuers": [{
+                "issuer": "https://batch.internal/",
+                "audiences": ["casting-agency-internal"],
+                "algorithms": ["RS256"],
+                "jwks_file": "internal.jwks.json",
+                "public_key_file": "internal.pem"
+            }]}
+            (key files are relative to the config file; either or both)
+
+    This method loads the pinned keys of every trusted issuer once, at startup
+    The keys are constructed up front so verifying a token doesn't parse them
+    returns a dict of issuer -> {issuer, audiences, algorithms, keys}
+        where keys maps kid (None for a pinned PEM key) to the key
+'''
+def load_trusted_issuers(path):
+    if not path:
+        return {}
+    with open(path) as config_file:
+        config = json.load(config_file)
+    base = os.path.dirname(os.path.abspath(path))
+
+    issuers = {}
+    for entry in config['issuers']:
+        algorithms = entry.get('algorithms', ALGORITHMS)
+        keys = {}
+        if 'public_key_file' in entry:
+            with open(os.path.join(base, entry['public_key_file'])) as key_file:
+                keys[None] = jwk.construct(key_file.read(), algorithms[0])
+        if 'jwks_file' in entry:
+            with open(os.path.join(base, entry['jwks_file'])) as jwks_file:
+                for key in json.load(jwks_file)['keys']:
+                    keys[key['kid']] = jwk.construct(key, key.get('alg', algorithms[0]))
+        issuers[entry['issuer']] = {
+            'issuer': entry['issuer'],
+            'audiences': set(entry['audiences']),
+            'algorithms': algorithms,
+            'keys': keys
+        }
+    return issuers
+
+trusted_issuers = load_trusted_issuers(trusted_issuers_file)
+
+
+'''
+    @INPUTS
+        token: a json web token (string)
+
+    This method returns the trusted issuer config for the token's iss claim
+    or None if the token has to be verified with Auth0
+    In local mode it raises an AuthError for any other issuer
+'''
+def get_trusted_issuer(token):
+    if auth_mode == 'auth0':
+        return None
+    try:
+        issuer = jwt.get_unverified_claims(token).get('iss')
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+    trusted = trusted_issuers.get(issuer)
+    if trusted is None and auth_mode == 'local':
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Token issuer is not trusted.'
+        }, 401)
+    return trusted
+
+
+'''
+    @INPUTS
+        token: a json web token (string)
+        trusted: the trusted issuer config (see load_trusted_issuers)
+
+    This method verifies the token against the issuer's pinned keys
+    The audience claim must contain one of the issuer's audiences
+    returns the decoded payload
+'''
+def decode_local_jwt(token, trusted):
+    kid = jwt.get_unverified_header(token).get('kid')
+    key = trusted['keys'].get(kid, trusted['keys'].get(None))
+    if key is None:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to find the appropriate key.'
+        }, 400)
+
+    payload = decode_with_key(
+        token,
+        key,
+        algorithms=trusted['algorithms'],
+        issuer=trusted['issuer'],
+        options={'verify_aud': False}
+    )
+    audience = payload.get('aud')
+    audiences = audience if isinstance(audience, list) else [audience]
+    if trusted['audiences'].isdisjoint(audiences):
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
+        }, 401)
+    return payload
+
+
+'''
+    @INPUTS
+        token: a json web token (string)
+        The token is an Auth0 token with key id (kid)
+        or a token from a trusted issuer (see load_trusted_issuers)
+    This method verifies the token using Auth0 /.well-known/jwks.json
+        or, for trusted issuers, the locally pinned keys
+    It decodes the payload from the token and validates the claims
+    finally returns the decoded payload
+
+'''
+def verify_decode_jwt(token):
+    trusted = get_trusted_issuer(token)
+    if trusted is not None:
+        return decode_local_jwt(token, trusted)
+    jwks = fetch_jwks()
+    return decode_jwt(token, jwks)
+
+
+'''
+    This method returns the decoded payload of the request's bearer token
+    Sub-requests of POST /batch reuse the payload the batch was verified
+        with (g.batch_payload) instead of verifying the token again
+'''
+def get_request_payload():
+    payload = g.get('batch_payload')
+    if payload is None:
+        token = get_token_auth_header()
+        payload = verify_decode_jwt(token)
+    return payload
+
+
 '''
 Implementation of @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
+            or a function returning it, evaluated for each request
 
-    This method uses the get_token_auth_header method to get the token
-    it uses the verify_decode_jwt method to decode the jwt
+    This method uses the get_request_payload method to get the decoded jwt
+        (get_token_auth_header + verify_decode_jwt)
     it uses the check_permissions method, validate claims and checks the requested permission
+    and the check_tenant method (the tenant whose database the request uses)
+    keeps the payload in g.auth_payload (the audit log's subject, see audit.py)
+    then runs the request within the client's rate limits (see ratelimit.py)
     returns the decorator which passes the decoded payload to the decorated method
 '''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            payload = get_request_payload()
+            requested_permission = permission() if callable(permission) else permission
+            check_permissions(requested_permission, payload)
+            check_tenant(payload)
+            g.auth_payload = payload
+            with client_limits(payload, requested_permission):
+                return f(payload, *args, **kwargs)
 
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
@@ -0,0 +1,106 @@
+import os
+import time
+from flask import g, request, make_response, abort
+from werkzeug.test import EnvironBuilder
+from models import db
+
+batch_max_requests = int(os.getenv('BATCH_MAX_REQUESTS', 20))
+batch_max_seconds = float(os.getenv('BATCH_MAX_SECONDS', 10))
+
+# endpoints that can't run inside a batch
+batch_excluded_endpoints = {'run_batch_requests', 'stream_change_log'}
+
+'''
+    POST /batch
+
+    Runs many sub-requests under one auth check
+    The token is verified once by the batch route; each sub-request then
+        goes through the normal view function (and its requires_auth
+        permission check) with the already-decoded payload
+    Sub-requests run one after the other in the batch's app context, so
+        they share its DB session; a failed sub-request is rolled back
+        before the next one runs
+'''
+
+'''
+    @INPUTS
+        items: the JSON body of the batch
+
+    Aborts with 400 unless items is a list of at most batch_max_requests
+        objects with a method and a path
+'''
+def validate_batch(items):
+    if not isinstance(items, list) or not items or len(items) > batch_max_requests:
+        abort(400)
+    for item in items:
+        if not isinstance(item, dict) \
+                or not isinstance(item.get('method'), str) \
+                or not isinstance(item.get('path'), str) \
+                or not item['path'].startswith('/'):
+            abort(400)
+
+
+def error_item(status, message):
+    return {
+        'status': status,
+        'body': {'success': False, 'error': status, 'message': message}
+    }
+
+
+'''
+    @INPUTS
+        app: the flask application
+        item: one sub-request (method, path, optional body)
+
+    Dispatches the sub-request through the app in a nested request context
+    Returns its status code and JSON body
+'''
+def run_sub_request(app, item):
+    builder = EnvironBuilder(
+        path=item['path'],
+        base_url=request.host_url,
+        method=item['method'].upper(),
+        json=item.get('body')
+    )
+    try:
+        with app.request_context(builder.get_environ()) as ctx:
+            if ctx.request.url_rule is not None \
+                    and ctx.request.url_rule.endpoint in batch_excluded_endpoints:
+                return error_item(400, 'Bad request.')
+            response = make_response(app.full_dispatch_request())
+    except Exception:
+        db.session.rollback()
+        return error_item(500, 'Internal server error.')
+    finally:
+        builder.close()
+
+    if response.status_code >= 500:
+        db.session.rollback()
+    return {
+        'status': response.status_code,
+        'body': response.get_json(silent=True)
+    }
+
+
+'''
+    @INPUTS
+        app: the flask application
+        items: validated sub-requests
+        payload: decoded jwt payload of the batch request
+
+    Returns the sub-responses in order
+    Sub-requests left when batch_max_seconds runs out get a 504
+'''
+def run_batch(app, items, payload):
+    deadline = time.monotonic() + batch_max_seconds
+    g.batch_payload = payload
+    responses = []
+    try:
+        for item in items:
+            if time.monotonic() > deadline:
+                responses.append(error_item(504, 'Batch time limit exceeded.'))
+            else:
+                responses.append(run_sub_request(app, item))
+    finally:
+        g.pop('batch_payload', None)
+    return responses
@@ -0,0 +1,160 @@
+'''
+    Benchmark: requests in flight against the app with a slow Auth0
+
+    Starts a local HTTP server that answers the JWKS request after a fixed
+    delay (a degraded Auth0), then serves the app (SQLite) from a child
+    process in two ways and times N concurrent GET /actors with a valid
+    token, for growing N:
+        sync    one request at a time (a sync gunicorn worker)
+        gevent  async_app on gevent (gunicorn -k gevent), where requests
+                waiting on the JWKS fetch yield to each other
+    With gevent the JWKS fetches of concurrent requests are also coalesced
+    into one (auth.jwks_flight), which a sync worker never gets to do
+
+    Usage:
+        python benchmarks/bench_async_jwks.py [delay_seconds]
+'''
+import os
+import sys
+
+if __name__ == '__main__' and sys.argv[1:2] == ['--serve'] and sys.argv[2] == 'gevent':
+    # must run before anything imports socket, ssl or threading
+    from gevent import monkey
+    monkey.patch_all()
+
+import json
+import time
+import base64
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DELAY = float(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1] != '--serve' else 0.05
+IN_FLIGHT = [1, 2, 4, 8, 16, 32]
+MODES = ('sync', 'gevent')
+DOMAIN, AUDIENCE = 'bench.local', 'bench'
+
+
+def serve(mode, port, jwks_url):
+    import auth
+    auth.get_jwks_url = lambda: jwks_url
+    from async_app import create_async_app
+    from models import db, Actor
+
+    app = create_async_app()
+    with app.app_context():
+        db.create_all()
+        Actor(name='Actor', age=30, gender='Female').insert()
+    if mode == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('127.0.0.1', port), app, log=None).serve_forever()
+    else:
+        import logging
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        make_server('127.0.0.1', port, app, threaded=False).serve_forever()
+
+
+def make_key():
+    import rsa
+    from jose import jwt
+    public_key, private_key = rsa.newkeys(2048)
+
+    def b64(number):
+        return base64.urlsafe_b64encode(number.to_bytes((number.bit_length() + 7) // 8, 'big')).rstrip(b'=').decode()
+
+    jwks = {'keys': [{'kty': 'RSA', 'kid': 'bench', 'use': 'sig', 'n': b64(public_key.n), 'e': b64(public_key.e)}]}
+    token = jwt.encode(
+        {'iss': f'https://{DOMAIN}/', 'aud': AUDIENCE, 'sub': 'bench', 'permissions': ['get:actors'],
+         'exp': int(time.time()) + 3600},
+        private_key.save_pkcs1().decode(), algorithm='RS256', headers={'kid': 'bench'}
+    )
+    return jwks, token
+
+
+def slow_jwks_handler(jwks):
+    body = json.dumps(jwks).encode()
+
+    class SlowJWKSHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(DELAY)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return SlowJWKSHandler
+
+
+class SlowJWKSServer(ThreadingHTTPServer):
+    # the default listen backlog (5) would make the server the bottleneck
+    request_queue_size = 128
+
+
+def get(url, token=None):
+    request = Request(url, headers={'Authorization': f'Bearer {token}'} if token else {})
+    with urlopen(request, timeout=60) as response:
+        return response.status
+
+
+def start_app(mode, port, jwks_url):
+    env = dict(
+        os.environ,
+        DATABASE_URI='sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'),
+        AUTH0_DOMAIN=DOMAIN, API_AUDIENCE=AUDIENCE, AUTH_MODE='auth0',
+        AUDIT_LOG='off', RATE_LIMIT_PER_SECOND='0'
+    )
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', mode, str(port), jwks_url], env=env)
+    for _ in range(200):
+        try:
+            get(f'http://127.0.0.1:{port}/healthz')
+            return child
+        except OSError:
+            time.sleep(0.05)
+    child.kill()
+    sys.exit(f'The {mode} app did not start')
+
+
+def run(url, token, n):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n) as pool:
+        statuses = list(pool.map(lambda _: get(url, token), range(n)))
+    assert statuses == [200] * n, statuses
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+        sys.exit()
+
+    jwks, token = make_key()
+    server = SlowJWKSServer(('127.0.0.1', 0), slow_jwks_handler(jwks))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    jwks_url = f'http://127.0.0.1:{server.server_address[1]}/.well-known/jwks.json'
+
+    times = {}
+    for index, mode in enumerate(MODES):
+        port = server.server_address[1] + 1 + index
+        child = start_app(mode, port, jwks_url)
+        try:
+            times[mode] = [run(f'http://127.0.0.1:{port}/actors', token, n) for n in IN_FLIGHT]
+        finally:
+            child.kill()
+            child.wait()
+
+    print(f'upstream delay: {DELAY * 1000:.0f} ms')
+    print(f'{"in flight":>10} {"sync (s)":>10} {"gevent (s)":>11} {"speedup":>8}')
+    for n, sync_time, gevent_time in zip(IN_FLIGHT, times['sync'], times['gevent']):
+        print(f'{n:>10} {sync_time:>10.3f} {gevent_time:>11.3f} {sync_time / gevent_time:>7.1f}x')
+
+    server.shutdown()
@@ -0,0 +1,98 @@
+'''
+    Benchmark: memory and latency of the in-memory catalog against the
+    database path it replaces
+
+    Fills a SQLite actors table with N rows, loads the catalog from it,
+    then reports:
+        - the bytes per row (tracemalloc) of the columnar snapshot and of
+          the same rows loaded as ORM objects
+        - a lookup by id, as GET /actors/<id> serves it: catalog.get
+          against db.session.get(Actor, id).format()
+        - an age-range scan, as GET /actors?min_age=&max_age= serves it:
+          catalog.filter_actors against actor_query and format()
+    The database path ends each lookup and scan with db.session.remove(),
+    as every request does, so no row is served from the identity map
+
+    Usage:
+        python benchmarks/bench_catalog.py [rows]
+'''
+import os
+import sys
+import timeit
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+GENDERS = ['Male', 'Female', 'Other']
+LOOKUPS = 20000
+SCANS = 5
+os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['AUDIT_LOG'] = 'off'
+
+from app import create_app
+from catalog import Catalog
+from models import db, Actor, actor_query
+
+
+def fill():
+    db.create_all()
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': f'Actor {id}', 'age': 18 + id % 70, 'gender': GENDERS[id % 3]}
+        for id in range(1, ROWS + 1)
+    ])
+    db.session.commit()
+
+
+def measure(build):
+    db.session.remove()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, (after - before) / ROWS
+
+
+def load_catalog():
+    catalog = Catalog()
+    catalog.refresh()
+    return catalog
+
+
+def orm_get(id):
+    actor = db.session.get(Actor, id)
+    db.session.remove()
+    return actor.format()
+
+
+def orm_scan():
+    actors = [actor.format() for actor in actor_query(min_age=30, max_age=40)]
+    db.session.remove()
+    return actors
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        fill()
+        catalog, catalog_bytes = measure(load_catalog)
+        objects, object_bytes = measure(lambda: Actor.query.all())
+        del objects
+        print(f'{"rows":<24} {ROWS}')
+        print(f'{"catalog (MB / 1M rows)":<24} {catalog_bytes:>8.1f}')
+        print(f'{"ORM objects (MB / 1M)":<24} {object_bytes:>8.1f}')
+
+        ids = [(id * 7919) % ROWS + 1 for id in range(LOOKUPS)]
+        assert catalog.get('actor', ids[0]) == orm_get(ids[0])
+        seconds = timeit.timeit(lambda: [catalog.get('actor', id) for id in ids], number=1)
+        print(f'{"catalog get (us)":<24} {seconds / LOOKUPS * 1e6:>8.2f}')
+        seconds = timeit.timeit(lambda: [orm_get(id) for id in ids], number=1)
+        print(f'{"ORM get (us)":<24} {seconds / LOOKUPS * 1e6:>8.2f}')
+
+        assert catalog.filter_actors(min_age=30, max_age=40) == orm_scan()
+        seconds = timeit.timeit(lambda: catalog.filter_actors(min_age=30, max_age=40), number=SCANS)
+        print(f'{"catalog scan (ms)":<24} {seconds / SCANS * 1e3:>8.1f}')
+        seconds = timeit.timeit(orm_scan, number=SCANS)
+        print(f'{"ORM scan (ms)":<24} {seconds / SCANS * 1e3:>8.1f}')
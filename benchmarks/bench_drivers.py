@@ -0,0 +1,78 @@
+'''
+    Benchmark: psycopg2 against psycopg 3 on identical workloads
+
+    Needs PostgreSQL. Runs the same workloads once per driver (each in its
+    own process, as DB_DRIVER is read at import) against BENCH_DATABASE_URI:
+        get by id     db.session.get of random actors
+        list page     GET /actors pages (actor_query, limit/offset)
+        bulk insert   job import chunks (insert_rows + commit)
+        audit flush   AuditLog.write of 10 batches (pipelined with psycopg 3)
+    psycopg 3 prepares a statement once a connection has run it
+    DB_PREPARE_THRESHOLD times (default 2)
+
+    Usage:
+        BENCH_DATABASE_URI=postgresql://... python benchmarks/bench_drivers.py [operations]
+'''
+import os
+import sys
+import random
+import logging
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+OPERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+DRIVERS = ('psycopg2', 'psycopg')
+
+
+def run_workloads():
+    import time
+    from flask import Flask
+    from models import setup_db, db, Actor, insert_rows, actor_query, utcnow
+    from audit import AuditLog
+
+    app = Flask(__name__)
+    setup_db(app, os.environ['BENCH_DATABASE_URI'])
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        insert_rows(Actor, [{'name': f'Actor {n}', 'age': 18 + n % 70, 'gender': 'Female'} for n in range(10000)])
+        db.session.commit()
+
+        def get_by_id():
+            for _ in range(OPERATIONS):
+                db.session.get(Actor, random.randint(1, 10000))
+                db.session.expunge_all()
+
+        def list_page():
+            for _ in range(OPERATIONS // 10):
+                actor_query(min_age=30).offset(random.randint(0, 5000)).limit(50).all()
+
+        def bulk_insert():
+            for _ in range(OPERATIONS // 100):
+                insert_rows(Actor, [{'name': 'Bulk', 'age': 40, 'gender': 'Male'} for _ in range(100)])
+                db.session.commit()
+
+        audit = AuditLog(db.engine, logging.getLogger(__name__), batch_size=100)
+        event = {'subject': 'bench', 'entity': 'actor', 'entity_id': 1, 'op': 'update', 'change_seq': None}
+
+        def audit_flush():
+            for _ in range(OPERATIONS // 100):
+                audit.write([dict(event, created_at=utcnow()) for _ in range(1000)])
+
+        for name, workload in [('get by id', get_by_id), ('list page', list_page),
+                               ('bulk insert', bulk_insert), ('audit flush', audit_flush)]:
+            start = time.perf_counter()
+            workload()
+            print(f'{os.environ["DB_DRIVER"]:<10} {name:<12} {time.perf_counter() - start:>8.3f}s')
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    if os.environ.get('DB_DRIVER') and os.environ.get('BENCH_CHILD'):
+        run_workloads()
+    else:
+        print(f'{"driver":<10} {"workload":<12} {"time":>9}  ({OPERATIONS} operations)')
+        for driver in DRIVERS:
+            env = dict(os.environ, DB_DRIVER=driver, BENCH_CHILD='1')
+            subprocess.run([sys.executable, os.path.abspath(__file__), str(OPERATIONS)], env=env, check=True)
@@ -0,0 +1,68 @@
+'''
+    Benchmark: columnar export (arrow_export.py) against the JSON listing
+
+    Fills a SQLite actors table with N rows, then reports the time, the
+    peak traced memory and the output size of:
+        - the JSON listing path (actor_query, format() and json.dumps)
+        - the Arrow IPC stream and the Parquet export
+
+    Usage:
+        python benchmarks/bench_export.py [rows]
+'''
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+GENDERS = ['Male', 'Female', 'Other']
+os.environ['DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+from app import create_app
+from models import db, Actor, actor_query
+from arrow_export import get_export_schema, export_chunks
+
+
+def fill():
+    db.create_all()
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': f'Actor {id}', 'age': 18 + id % 70, 'gender': GENDERS[id % 3]}
+        for id in range(1, ROWS + 1)
+    ])
+    db.session.commit()
+
+
+def json_listing():
+    return len(json.dumps({'success': True, 'actors': [actor.format() for actor in actor_query()]}))
+
+
+def columnar(format):
+    def export():
+        return sum(len(chunk) for chunk in export_chunks(Actor, actor_query(), get_export_schema(Actor), format))
+    return export
+
+
+def measure(run):
+    db.session.remove()
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = run()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, size
+
+
+if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        fill()
+        print(f'{"rows":<12} {ROWS}')
+        print(f'{"":<12} {"seconds":>8} {"rows/s":>10} {"peak MB":>8} {"size MB":>8}')
+        for name, run in [('json', json_listing), ('arrow', columnar('arrow')), ('parquet', columnar('parquet'))]:
+            seconds, peak, size = measure(run)
+            print(f'{name:<12} {seconds:>8.2f} {ROWS / seconds:>10.0f} {peak / 1e6:>8.1f} {size / 1e6:>8.1f}')
@@ -0,0 +1,93 @@
+'''
+    Benchmark: date-range movie queries on a partitioned movies table
+
+    Needs PostgreSQL. Fills a plain table (bench_movies_flat) and a table
+    partitioned like movies with MOVIE_PARTITIONING (bench_movies_parted,
+    one partition per year or decade) with the same N rows released
+    between 1900 and today, then times the GET /movies date filters on
+    both and reports how many partitions the planner kept
+
+    Usage:
+        BENCH_DATABASE_URI=postgresql://... python benchmarks/bench_partitions.py [rows] [year|decade]
+'''
+import os
+import sys
+import json
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from models import movie_partition_bounds
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+GRANULARITY = sys.argv[2] if len(sys.argv) > 2 else 'year'
+FIRST_YEAR, LAST_YEAR = 1900, date.today().year
+QUERIES = {
+    'one year, count': ("SELECT count(*) FROM {table} WHERE release_date >= '2010-01-01' AND release_date <= '2010-12-31'"),
+    'one year, page': ("SELECT * FROM {table} WHERE release_date >= '2010-01-01' AND release_date <= '2010-12-31' ORDER BY id LIMIT 50"),
+    'decade, count': ("SELECT count(*) FROM {table} WHERE release_date >= '1990-01-01' AND release_date <= '1999-12-31'"),
+    'by id': ("SELECT * FROM {table} WHERE id = 123456"),
+}
+
+
+def fill(connection):
+    connection.exec_driver_sql('DROP TABLE IF EXISTS bench_movies_flat, bench_movies_parted')
+    connection.exec_driver_sql('CREATE TABLE bench_movies_flat (id SERIAL PRIMARY KEY, title VARCHAR NOT NULL, release_date DATE NOT NULL)')
+    connection.exec_driver_sql(
+        'CREATE TABLE bench_movies_parted (id SERIAL NOT NULL, title VARCHAR NOT NULL, release_date DATE NOT NULL, '
+        'PRIMARY KEY (id, release_date)) PARTITION BY RANGE (release_date)'
+    )
+    for name, start, end in sorted({movie_partition_bounds(date(year, 1, 1), GRANULARITY) for year in range(FIRST_YEAR, LAST_YEAR + 1)}):
+        connection.exec_driver_sql(
+            f"CREATE TABLE bench_{name} PARTITION OF bench_movies_parted FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+    days = (date(LAST_YEAR, 1, 1) - date(FIRST_YEAR, 1, 1)).days
+    for table in ('bench_movies_flat', 'bench_movies_parted'):
+        connection.execute(text(
+            f"INSERT INTO {table} (title, release_date) SELECT 'Movie ' || n, "
+            f"DATE '{FIRST_YEAR}-01-01' + (n * 7919 % :days) FROM generate_series(1, :rows) AS n"
+        ), {'days': days, 'rows': ROWS})
+        connection.exec_driver_sql(f'CREATE INDEX ON {table} (release_date)')
+        connection.exec_driver_sql(f'ANALYZE {table}')
+
+
+def scanned_partitions(plan):
+    scanned = set()
+    relation = plan.get('Relation Name')
+    if relation:
+        scanned.add(relation)
+    for child in plan.get('Plans', []):
+        scanned |= scanned_partitions(child)
+    return scanned
+
+
+def measure(connection, sql, number=20):
+    start = time.perf_counter()
+    for _ in range(number):
+        connection.exec_driver_sql(sql).all()
+    return (time.perf_counter() - start) / number
+
+
+if __name__ == '__main__':
+    engine = create_engine(os.environ['BENCH_DATABASE_URI'])
+    if engine.dialect.name != 'postgresql':
+        sys.exit('Partitioning needs PostgreSQL')
+    with engine.begin() as connection:
+        fill(connection)
+
+    with engine.connect() as connection:
+        print(f'{"rows":<18} {ROWS} ({GRANULARITY} partitions)')
+        print(f'{"":<18} {"flat ms":>8} {"parted ms":>9} {"scanned":>8}')
+        for name, sql in QUERIES.items():
+            flat = measure(connection, sql.format(table='bench_movies_flat'))
+            parted_sql = sql.format(table='bench_movies_parted')
+            parted = measure(connection, parted_sql)
+            plan = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + parted_sql).scalar()
+            plan = plan if isinstance(plan, list) else json.loads(plan)
+            scanned = len(scanned_partitions(plan[0]['Plan']))
+            print(f'{name:<18} {flat * 1e3:>8.2f} {parted * 1e3:>9.2f} {scanned:>8}')
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE bench_movies_flat, bench_movies_parted')
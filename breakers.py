@@ -0,0 +1,253 @@
+import os
+import time
+import threading
+from flask import request, g, current_app
+from sqlalchemy import exc, text
+from models import db
+from tenants import listen_engines, current_tenant, engine_tenant
+
+'''
+    Circuit breakers for the services the API depends on (Auth0, the database)
+
+    closed     calls go through; consecutive failures are counted
+    open       after breaker_failure_threshold failures in a row, calls fail
+               fast with a DependencyError (503 + Retry-After) for
+               breaker_reset_seconds instead of waiting on a dead service
+    half_open  once that time is up one call is let through as a probe:
+               success closes the circuit, failure opens it again
+
+    Each tenant database (see tenants.py) has a circuit of its own, so an
+    agency whose database is down doesn't fail the others' requests
+'''
+
+breaker_failure_threshold = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+breaker_reset_seconds = float(os.getenv('BREAKER_RESET_SECONDS', 30))
+
+# endpoints that don't touch the database are never failed fast
+breaker_exempt_endpoints = {'home', 'healthz', 'readyz', 'static'}
+
+
+'''
+DependencyError Exception
+    raised when a dependency failed or its circuit is open
+    retry_after is the number of seconds the client should wait
+'''
+class DependencyError(Exception):
+    def __init__(self, name, retry_after=1):
+        self.name = name
+        self.retry_after = max(int(retry_after + 0.999), 1)
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=None, reset_seconds=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or breaker_failure_threshold
+        self.reset_seconds = reset_seconds or breaker_reset_seconds
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_started = None
+
+    '''
+        Returns True if a call may go through now
+        In half_open state only one probe is let through at a time; a probe
+            that never reports back is given up after reset_seconds
+    '''
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                if now - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = 'half_open'
+            elif self.state == 'closed':
+                return True
+            if self.probe_started is not None and now - self.probe_started < self.reset_seconds:
+                return False
+            self.probe_started = now
+            return True
+
+    def retry_after(self):
+        if self.state != 'open':
+            return 1
+        return self.reset_seconds - (time.monotonic() - self.opened_at)
+
+    def success(self):
+        if self.state == 'closed' and not self.failures:
+            return
+        with self.lock:
+            self.reset()
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.probe_started = None
+
+    def check(self):
+        if not self.allow():
+            raise DependencyError(self.name, self.retry_after())
+
+    '''
+        @INPUTS
+            fn: zero-argument callable calling the dependency
+            errors: the exceptions that count as the dependency failing
+
+        Returns fn(); raises a DependencyError if the circuit is open
+            or fn failed with one of errors
+    '''
+    def call(self, fn, errors=(Exception,)):
+        self.check()
+        try:
+            result = fn()
+        except errors as error:
+            self.failure()
+            raise DependencyError(self.name, self.retry_after()) from error
+        self.success()
+        return result
+
+    def status(self):
+        return {'state': self.state, 'failures': self.failures}
+
+
+auth0_breaker = CircuitBreaker('auth0')
+database_breaker = CircuitBreaker('database')
+# the circuits of tenant databases, by tenant (as TenantRouter keys engines)
+tenant_breakers = {}
+tenant_breakers_lock = threading.Lock()
+
+
+'''
+    Returns the circuit of a tenant's database, or database_breaker for
+    None (the app's own database)
+'''
+def get_database_breaker(tenant=None):
+    if tenant is None:
+        return database_breaker
+    breaker = tenant_breakers.get(tenant)
+    if breaker is None:
+        with tenant_breakers_lock:
+            breaker = tenant_breakers.setdefault(tenant, CircuitBreaker(f'database:{tenant}'))
+    return breaker
+
+
+'''
+    @INPUTS
+        error: an exception raised while handling a request
+
+    Returns True if it means the database is unavailable (connection
+    refused or lost, pool checkout or statement timeout) rather than
+    a bug or a bad query
+'''
+def is_database_unavailable(error):
+    if isinstance(error, exc.TimeoutError):
+        return True
+    if isinstance(error, exc.DBAPIError):
+        return error.connection_invalidated or isinstance(error, exc.OperationalError)
+    return False
+
+
+'''
+    @INPUTS
+        error: the 500 error a request ended with
+
+    Returns the DependencyError to answer with instead if the request
+    failed because the database is unavailable, and counts the failure
+'''
+def get_database_error(error):
+    cause = getattr(error, 'original_exception', None) or error.__context__
+    while cause is not None and not is_database_unavailable(cause):
+        if isinstance(cause, DependencyError):
+            return cause
+        cause = cause.__context__
+    if cause is None or g.get('database_failure_counted'):
+        return None
+    g.database_failure_counted = True
+    breaker = get_database_breaker(current_tenant())
+    breaker.failure()
+    return DependencyError(breaker.name, breaker.retry_after())
+
+
+'''
+    @INPUTS
+        app: a flask application
+        engine: the engine its routes use (defaults to db.engine; tenant
+            engines are listened to as well, see tenants.py)
+
+    Fails requests fast while the circuit of their database is open, and
+    closes a circuit again as soon as a statement on its database succeeds
+    With tenant routing, a request's database is only known once its token
+    is (see auth.check_tenant), so it checks its tenant's circuit there
+'''
+def init_breakers(app, engine=None):
+
+    @app.before_request
+    def check_database_breaker():
+        if request.endpoint not in breaker_exempt_endpoints and 'tenants' not in app.extensions:
+            database_breaker.check()
+
+    def database_succeeded(conn, cursor, statement, parameters, context, executemany):
+        get_database_breaker(engine_tenant(conn.engine)).success()
+
+    listen_engines(app, engine, 'after_cursor_execute', database_succeeded)
+
+
+'''
+    Returns the readiness report of /readyz and its status code
+    The database circuit decides readiness: a half-open circuit is probed
+        with SELECT 1 here, so an instance taken out of rotation recovers
+        without live traffic
+    The Auth0 circuit is only reported: tokens of trusted issuers are still
+        accepted while it is open; so are the circuits of tenant databases
+        that have one (checks.tenants), probed the same way
+'''
+def get_readiness():
+    if database_breaker.state != 'closed' and database_breaker.allow():
+        try:
+            db.session.execute(text('SELECT 1'))
+            database_breaker.success()
+        except exc.SQLAlchemyError:
+            database_breaker.failure()
+        finally:
+            db.session.rollback()
+
+    checks = {
+        'database': database_breaker.status(),
+        'auth0': auth0_breaker.status()
+    }
+    router = current_app.extensions.get('tenants')
+    if router is not None:
+        checks['tenants'] = {tenant: probe_tenant(router, tenant).status()
+                             for tenant in sorted(router.tenants) if tenant in tenant_breakers}
+
+    ready = database_breaker.state != 'open'
+    return {
+        'success': ready,
+        'checks': checks
+    }, 200 if ready else 503
+
+
+'''
+    Probes a tenant's database like get_readiness probes the app's own
+    A tenant whose database is down is only reported: the instance still
+    serves the other tenants
+    Returns the tenant's circuit
+'''
+def probe_tenant(router, tenant):
+    breaker = get_database_breaker(tenant)
+    if breaker.state != 'closed' and breaker.allow():
+        try:
+            with router.engine_for(tenant).connect() as connection:
+                connection.execute(text('SELECT 1'))
+            breaker.success()
+        except exc.SQLAlchemyError:
+            breaker.failure()
+    return breaker
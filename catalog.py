@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import threading
+from array import array
+from datetime import date
+from flask import current_app, g
+from sqlalchemy import select, func
+import models
+from models import db, Actor, Movie, Change
+from querybudget import unbudgeted
+
+'''
+    In-memory columnar snapshot of the catalog (optional read tier)
+
+    Each worker can keep the actors and movies in compact array-backed
+    columns instead of ORM objects, and serve the GET endpoints from
+    them without a database round trip
+    The snapshot follows the change log (see changes.py): it is loaded
+    once, then refreshed with the changes committed since its last seq,
+    at most every catalog_refresh_seconds, or right away after a commit
+    in this worker
+    Enable it with CATALOG_SNAPSHOT=true
+'''
+
+catalog_snapshot = os.getenv('CATALOG_SNAPSHOT', 'false').lower() == 'true'
+catalog_refresh_seconds = float(os.getenv('CATALOG_REFRESH_SECONDS', 1))
+catalog_refresh_batch = 1000
+# seqs commit in order (see models.lock_sequence), but a change logged by
+# hand, outside the app, could still land below the last seq applied;
+# every refresh re-reads this many entries back (replaying full-row
+# changes in order is idempotent)
+catalog_seq_overlap = int(os.getenv('CATALOG_SEQ_OVERLAP', 100))
+
+
+## Column kinds
+## each knows how to store a value and give it back
+
+class IntColumn:
+    def __init__(self, typecode):
+        self.values = array(typecode)
+
+    def append(self, value):
+        self.values.append(value)
+
+    def set(self, index, value):
+        self.values[index] = value
+
+    def get(self, index):
+        return self.values[index]
+
+
+class TextColumn(IntColumn):
+    def __init__(self):
+        self.values = []
+
+
+class DateColumn(IntColumn):
+    # dates are kept as their proleptic ordinal
+    def __init__(self):
+        self.values = array('l')
+
+    def append(self, value):
+        self.values.append(value.toordinal())
+
+    def set(self, index, value):
+        self.values[index] = value.toordinal()
+
+    def get(self, index):
+        return date.fromordinal(self.values[index])
+
+    def code(self, value):
+        return value.toordinal()
+
+
+class CategoryColumn(IntColumn):
+    # low-cardinality strings are interned; rows store a small code
+    def __init__(self):
+        self.values = array('H')
+        self.categories = []
+        self.codes = {}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.categories)
+            self.categories.append(value)
+        return code
+
+    def append(self, value):
+        self.values.append(self.code(value))
+
+    def set(self, index, value):
+        self.values[index] = self.code(value)
+
+    def get(self, index):
+        return self.categories[self.values[index]]
+
+
+'''
+ColumnarTable
+    rows stored column by column, in id order
+    inserts append; deletes leave a tombstone that is compacted away
+    once they are a quarter of the rows
+    an insert committed out of id order is appended too, and the table
+    is re-sorted once, before the next ordered read
+'''
+class ColumnarTable:
+    def __init__(self, columns):
+        self.column_kinds = columns
+        self.clear()
+
+    def clear(self):
+        self.columns = {name: kind() for name, kind in self.column_kinds.items()}
+        self.ids = array('q')
+        self.live = bytearray()
+        self.index = {}
+        self.deleted = 0
+        self.unsorted = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def upsert(self, row):
+        position = self.index.get(row['id'])
+        if position is not None:
+            for name, column in self.columns.items():
+                column.set(position, row[name])
+            return
+        if self.ids and row['id'] < self.ids[-1]:
+            self.unsorted = True
+        self.index[row['id']] = len(self.ids)
+        self.ids.append(row['id'])
+        self.live.append(1)
+        for name, column in self.columns.items():
+            column.append(row[name])
+
+    def delete(self, id):
+        position = self.index.pop(id, None)
+        if position is None:
+            return
+        self.live[position] = 0
+        self.deleted += 1
+        if self.deleted * 4 > len(self.ids):
+            self.rebuild(list(self.rows()))
+
+    def rebuild(self, rows):
+        self.clear()
+        for row in sorted(rows, key=lambda row: row['id']):
+            self.upsert(row)
+
+    def ensure_sorted(self):
+        if self.unsorted:
+            self.rebuild(list(self.rows()))
+
+    def row(self, position):
+        row = {'id': self.ids[position]}
+        for name, column in self.columns.items():
+            row[name] = column.get(position)
+        return row
+
+    def get(self, id):
+        position = self.index.get(id)
+        return None if position is None else self.row(position)
+
+    def rows(self, positions=None):
+        # callers that care about id order call ensure_sorted first
+        if positions is None:
+            positions = range(len(self.ids))
+        return (self.row(position) for position in positions if self.live[position])
+
+
+ACTOR_COLUMNS = {'name': TextColumn, 'age': lambda: IntColumn('h'), 'gender': CategoryColumn}
+MOVIE_COLUMNS = {'title': TextColumn, 'release_date': DateColumn}
+
+
+class Catalog:
+    def __init__(self):
+        self.actors = ColumnarTable(ACTOR_COLUMNS)
+        self.movies = ColumnarTable(MOVIE_COLUMNS)
+        self.tables = {'actor': self.actors, 'movie': self.movies}
+        self.seq = None
+        self.version = None
+        self.checked_at = 0
+        self.lock = threading.RLock()
+
+    '''
+        Loads the snapshot on first use, then applies the changes
+        committed since the last refresh when one is due
+    '''
+    def refresh(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.seq is None:
+                self.load()
+            elif self.version != models.change_version or now - self.checked_at >= catalog_refresh_seconds:
+                self.apply_changes()
+            else:
+                return
+            self.checked_at = now
+
+    def load(self):
+        # read the seq first: changes committed while the tables are read
+        # are applied again afterwards, and upserts make that harmless
+        self.version = models.change_version
+        self.seq = db.session.query(func.max(Change.seq)).scalar() or 0
+        self.actors.rebuild([row._asdict() for row in db.session.execute(select(Actor.__table__))])
+        self.movies.rebuild([row._asdict() for row in db.session.execute(select(Movie.__table__))])
+        self.apply_changes()
+
+    def apply_changes(self):
+        self.version = models.change_version
+        while True:
+            since = max(self.seq - catalog_seq_overlap, 0)
+            changes = Change.query.filter(Change.seq > since) \
+                .order_by(Change.seq) \
+                .limit(catalog_refresh_batch + catalog_seq_overlap) \
+                .all()
+            for change in changes:
+                table = self.tables[change.entity]
+                if change.op == 'delete':
+                    table.delete(change.entity_id)
+                else:
+                    row = json.loads(change.data)
+                    if 'release_date' in row:
+                        row['release_date'] = date.fromisoformat(row['release_date'][:10])
+                    table.upsert(row)
+                self.seq = max(self.seq, change.seq)
+            if len(changes) < catalog_refresh_batch + catalog_seq_overlap:
+                break
+        # end the read transaction so the next refresh sees new commits
+        db.session.rollback()
+
+    ## Reads (the same dicts as Actor.format() / Movie.format())
+
+    def get(self, entity, id):
+        with self.lock:
+            return self.tables[entity].get(id)
+
+    def get_many(self, entity, ids):
+        with self.lock:
+            table = self.tables[entity]
+            rows = {id: table.get(id) for id in ids}
+        found = [rows[id] for id in ids if rows[id] is not None]
+        missing = [id for id in ids if rows[id] is None]
+        return found, missing
+
+    def filter_actors(self, gender=None, min_age=None, max_age=None):
+        with self.lock:
+            table = self.actors
+            table.ensure_sorted()
+            ages = table.columns['age'].values
+            genders = table.columns['gender']
+            gender_code = genders.codes.get(gender, -1) if gender is not None else None
+            low = min_age if min_age is not None else -1
+            high = max_age if max_age is not None else 1 << 15
+            positions = [
+                position for position in range(len(table.ids))
+                if low <= ages[position] <= high
+                and (gender_code is None or genders.values[position] == gender_code)
+            ]
+            return list(table.rows(positions))
+
+    def filter_movies(self, released_from=None, released_to=None):
+        with self.lock:
+            table = self.movies
+            table.ensure_sorted()
+            dates = table.columns['release_date'].values
+            low = released_from.toordinal() if released_from is not None else 0
+            high = released_to.toordinal() if released_to is not None else date.max.toordinal()
+            positions = [position for position in range(len(table.ids)) if low <= dates[position] <= high]
+            return list(table.rows(positions))
+
+
+'''
+    Returns the refreshed catalog snapshot of the current app,
+    or None if the read tier is disabled
+    The snapshot is of the app's own database: requests of a tenant
+        (see tenants.py) read their tenant's database instead
+    The refresh is shared by every reader, so its statements are not
+        counted against the request's query budget
+'''
+def get_catalog():
+    if g.get('tenant') is not None:
+        return None
+    catalog = current_app.extensions.get('catalog')
+    if catalog is not None:
+        with unbudgeted():
+            catalog.refresh()
+    return catalog
@@ -0,0 +1,91 @@
+import os
+import json
+import time
+from sqlalchemy import func, select
+from models import db, Change, change_signal
+
+change_page_size = int(os.getenv('CHANGE_FEED_PAGE_SIZE', 100))
+change_page_max = int(os.getenv('CHANGE_FEED_PAGE_MAX', 1000))
+# a stream ends after this long; clients reconnect with Last-Event-ID
+change_stream_seconds = float(os.getenv('CHANGE_FEED_STREAM_SECONDS', 300))
+# fallback poll for changes committed by other workers
+change_poll_seconds = float(os.getenv('CHANGE_FEED_POLL_SECONDS', 2))
+
+'''
+    @INPUTS
+        since: last seq the client has seen
+        limit: max number of changes returned
+
+    Returns the changes with seq > since, oldest first
+    (seqs commit in order, see models.lock_sequence, so a change
+    committed later never gets a seq below one already returned)
+'''
+def get_changes(since, limit=change_page_size):
+    return Change.query.filter(Change.seq > since) \
+        .order_by(Change.seq) \
+        .limit(limit) \
+        .all()
+
+
+def format_event(change):
+    return f'id: {change.seq}\nevent: change\ndata: {json.dumps(change.format())}\n\n'
+
+
+'''
+    @INPUTS
+        since: last seq the client has seen
+
+    Generator of server-sent events for every change after since
+    It waits on change_signal (commits in this worker) or the poll
+        interval (commits in other workers) between reads
+'''
+def stream_changes(since, duration=change_stream_seconds):
+    deadline = time.monotonic() + duration
+    while True:
+        changes = get_changes(since, change_page_max)
+        # end the read transaction so the next poll sees new commits
+        db.session.rollback()
+        for change in changes:
+            since = change.seq
+            yield format_event(change)
+        if len(changes) == change_page_max:
+            continue
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield ': keepalive\n\n'
+        with change_signal:
+            change_signal.wait(min(change_poll_seconds, remaining))
+
+
+'''
+    @INPUTS
+        before_seq: entries with seq <= before_seq are compacted
+
+    Keeps only the latest entry per actor/movie among the compacted ones
+    Deletes are kept as tombstones, so a mirror that syncs from before
+        the cutoff still ends up with the same state
+    Returns the number of entries removed
+'''
+def compact_changes(before_seq):
+    latest = select(func.max(Change.seq)) \
+        .where(Change.seq <= before_seq) \
+        .group_by(Change.entity, Change.entity_id)
+    removed = Change.query \
+        .filter(Change.seq <= before_seq, Change.seq.notin_(latest)) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+
+'''
+    @INPUTS
+        created_before: naive UTC datetime
+
+    Returns the last seq logged before created_before (0 if none)
+'''
+def last_seq_before(created_before):
+    return db.session.query(func.max(Change.seq)) \
+        .filter(Change.created_at < created_before) \
+        .scalar() or 0
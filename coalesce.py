@@ -0,0 +1,90 @@
+import threading
+from functools import wraps
+from flask import request, make_response, current_app
+from tenants import current_tenant
+
+'''
+    Single-flight coalescing of concurrent identical calls
+
+    The first caller for a key (the leader) runs the computation; callers
+    arriving with the same key while it is in flight wait for it and get
+    the same result (or the same exception) instead of repeating the work.
+    Nothing is kept once the call finishes, so this is not a cache.
+'''
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    '''
+        @INPUTS
+            key: hashable key identifying the computation
+            fn: zero-argument callable doing the work
+
+        Returns fn() or the result of the identical call already in flight
+    '''
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+# shared by every GET endpoint in this worker
+read_flight = SingleFlight()
+
+
+'''
+Implementation of @coalesce_reads(scope) decorator method
+    @INPUTS
+        scope: the permission the route requires (i.e. 'get:movies')
+
+    Must be applied below @requires_auth
+    Concurrent requests of the same tenant with the same scope, path and query args share
+        one run of the view and its serialized body and headers
+'''
+def coalesce_reads(scope=''):
+    def coalesce_reads_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            key = (current_tenant(), scope, request.path, tuple(sorted(request.args.items(multi=True))))
+
+            def compute():
+                response = make_response(f(payload, *args, **kwargs))
+                headers = [
+                    (name, value) for name, value in response.headers
+                    if name not in ('Content-Type', 'Content-Length')
+                ]
+                return response.get_data(), response.status_code, response.content_type, headers
+
+            body, status, content_type, headers = read_flight.do(key, compute)
+            return current_app.response_class(body, status=status, headers=headers, content_type=content_type)
+
+        return wrapper
+    return coalesce_reads_decorator
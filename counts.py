@@ -0,0 +1,90 @@
+import os
+from sqlalchemy import func, text
+from models import db, Stat
+
+'''
+    Total counts for the GET /actors and GET /movies listings (X-Total-Count)
+
+    A COUNT(*) over a large table reads the whole table, so clients pick
+    how exact the total must be with ?count=:
+        exact      SELECT COUNT(*)
+        estimated  the maintained stats counter for an unfiltered listing
+                   (see stats.py), or else the PostgreSQL planner's estimate
+                   (pg_class.reltuples, or EXPLAIN for a filtered listing)
+        auto       exact if there are at most total_count_threshold rows,
+                   estimated otherwise; costs at most threshold + 1 rows
+    Planner estimates need PostgreSQL; on SQLite they fall back to an exact count
+    Each total is returned with the source that produced it:
+        exact, counter or planner
+'''
+
+total_count_threshold = int(os.getenv('TOTAL_COUNT_THRESHOLD', 10000))
+COUNT_MODES = ('exact', 'estimated', 'auto')
+
+
+def exact_count(query):
+    return query.order_by(None).count()
+
+'''
+    Counts the rows of query, reading at most limit of them
+'''
+def bounded_count(model, query, limit):
+    rows = query.order_by(None).with_entities(model.id).limit(limit).subquery()
+    return db.session.query(func.count()).select_from(rows).scalar()
+
+'''
+    Returns the stats counter of the table's total, or None if there
+    is none yet (stats are only kept from the first write, or a rebuild)
+'''
+def counter_total(model):
+    stat = db.session.get(Stat, (model.__tablename__, 'total'))
+    return None if stat is None else stat.count
+
+'''
+    Returns the planner's row estimate, or None if it has none
+    (the table was never analyzed, or the database isn't PostgreSQL)
+'''
+def planner_estimate(model, query, filtered):
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return None
+    if not filtered:
+        reltuples = db.session.execute(
+            text('SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+            {'table': model.__tablename__}
+        ).scalar()
+        return None if reltuples is None or reltuples < 0 else int(reltuples)
+
+    compiled = query.order_by(None).statement.compile(dialect=db.session.get_bind().dialect)
+    plan = db.session.connection().exec_driver_sql(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params
+    ).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def estimated_count(model, query, filtered):
+    if not filtered:
+        total = counter_total(model)
+        if total is not None:
+            return total, 'counter'
+    estimate = planner_estimate(model, query, filtered)
+    if estimate is not None:
+        return estimate, 'planner'
+    return exact_count(query), 'exact'
+
+
+'''
+    @INPUTS
+        model: Actor or Movie
+        query: the listing query (see actor_query / movie_query)
+        filtered: True if the listing has filters
+        mode: exact, estimated or auto (see COUNT_MODES)
+
+    Returns (total, source) where source is exact, counter or planner
+'''
+def total_count(model, query, filtered, mode):
+    if mode == 'exact':
+        return exact_count(query), 'exact'
+    if mode == 'auto':
+        count = bounded_count(model, query, total_count_threshold + 1)
+        if count <= total_count_threshold:
+            return count, 'exact'
+    return estimated_count(model, query, filtered)
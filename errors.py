@@ -0,0 +1,91 @@
+from flask import jsonify
+from auth import AuthError
+from validation import ValidationError
+from breakers import DependencyError, get_database_error
+from ratelimit import RateLimitExceeded
+
+'''
+    @INPUTS
+        app: a flask application
+
+    This method registers the JSON error handlers on the given app
+    It is called by create_app (async_app.py serves the same app)
+'''
+def register_error_handlers(app):
+
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': 'Bad request.'
+        }), 400
+
+    @app.errorhandler(404)
+    def not_found(error):
+        return jsonify({
+            'success': False,
+            'error': 404,
+            'message': 'Resource not found.'
+        }), 404
+
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            'success': False,
+            'error': 409,
+            'message': 'Conflict.'
+        }), 409
+
+    @app.errorhandler(422)
+    def unprocessable_entity(error):
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'Unprocessable entity.'
+        }), 422
+
+    @app.errorhandler(500)
+    def internal_server_error(error):
+        # a database that is down or timing out is a 503, not a bug
+        dependency_error = get_database_error(error)
+        if dependency_error is not None:
+            return handle_dependency_error(dependency_error)
+        return jsonify({
+            'success': False,
+            'error': 500,
+            'message': 'Internal server error.'
+        }), 500
+
+    @app.errorhandler(AuthError)
+    def handle_auth_error(error):
+        return jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": error.error['description']
+        }), error.status_code
+
+    @app.errorhandler(ValidationError)
+    def handle_validation_error(error):
+        return jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": 'Bad request.' if error.status_code == 400 else 'Unprocessable entity.',
+            "errors": error.errors
+        }), error.status_code
+
+    @app.errorhandler(DependencyError)
+    def handle_dependency_error(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": 'Service unavailable.'
+        }), 503, {'Retry-After': str(error.retry_after)}
+
+    @app.errorhandler(RateLimitExceeded)
+    def handle_rate_limit_exceeded(error):
+        return jsonify({
+            "success": False,
+            "error": 429,
+            "message": 'Too many requests.'
+        }), 429, {'Retry-After': str(error.retry_after)}
@@ -0,0 +1,210 @@
+import os
+import queue
+import logging
+import importlib
+import threading
+from abc import ABC, abstractmethod
+from functools import wraps
+from urllib.request import Request, urlopen
+from flask import current_app, has_app_context, make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import Change
+
+'''
+    Cache-Control and Surrogate-Key headers for a caching reverse proxy
+
+    The GET routes of actors and movies declare a cache policy
+    (@cache_policy): their 200 responses name what they show in a
+    Surrogate-Key header (actor-42, actors-list, ...) and carry
+        CACHE_SHARED=off (default)  Cache-Control: private, no-cache
+        CACHE_SHARED=on             Cache-Control: public, max-age=0, s-maxage=CACHE_MAX_AGE
+    These routes require a token: with CACHE_SHARED=on the proxy must
+    verify it, and the route's permission, before answering from its
+    cache, as those requests never reach the API
+
+    Every committed actor or movie change purges the keys it affects
+    (actor-42 and actors-list) through the app's Purger. A response
+    computed just before a change can still be stored just after its
+    purge, so CACHE_MAX_AGE bounds how stale the proxy can be
+'''
+
+cache_shared = os.getenv('CACHE_SHARED', 'off')
+cache_max_age = int(os.getenv('CACHE_MAX_AGE', 60))
+# a Purger class as module:Class, or else PURGE requests to CACHE_PURGE_URL
+cache_purger = os.getenv('CACHE_PURGER')
+cache_purge_url = os.getenv('CACHE_PURGE_URL')
+# Varnish (xkey) reads the keys from an xkey header
+cache_purge_method = os.getenv('CACHE_PURGE_METHOD', 'PURGE')
+cache_purge_header = os.getenv('CACHE_PURGE_HEADER', 'Surrogate-Key')
+cache_purge_timeout = float(os.getenv('CACHE_PURGE_TIMEOUT', 2))
+# keys per purge request
+cache_purge_batch_size = 256
+
+
+def entity_keys(entity, entity_id):
+    return [f'{entity}-{entity_id}', f'{entity}s-list']
+
+
+'''
+Purger
+    the interface a purge backend implements
+    purge is called after every commit changing actors or movies, so it
+    must not wait on the proxy
+'''
+class Purger(ABC):
+    @abstractmethod
+    def purge(self, keys):
+        pass
+
+
+'''
+MemoryPurger
+    records the purged keys instead of sending them (tests, local runs)
+'''
+class MemoryPurger(Purger):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.purged = []
+
+    def purge(self, keys):
+        with self.lock:
+            self.purged.extend(keys)
+
+
+'''
+HttpPurger
+    sends the keys to the proxy from a background thread, one request
+    (method url, keys space-separated in header) per cache_purge_batch_size
+    keys; the keys queued meanwhile are merged into the next requests
+'''
+class HttpPurger(Purger):
+    def __init__(self, url, method=None, header=None, timeout=None, logger=None):
+        self.url = url
+        self.method = method or cache_purge_method
+        self.header = header or cache_purge_header
+        self.timeout = timeout or cache_purge_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def purge(self, keys):
+        self.queue.put(list(keys))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            keys = set(self.queue.get())
+            while not self.queue.empty():
+                keys.update(self.queue.get())
+            keys = sorted(keys)
+            for start in range(0, len(keys), cache_purge_batch_size):
+                self.send(keys[start:start + cache_purge_batch_size])
+
+    def send(self, keys):
+        request = Request(self.url, method=self.method, headers={self.header: ' '.join(keys)})
+        try:
+            with urlopen(request, timeout=self.timeout):
+                pass
+        except Exception:
+            self.logger.exception(f'Cache purge of {len(keys)} keys failed')
+
+
+'''
+    @INPUTS
+        path: module:Class of a Purger, or None
+        logger: where an HttpPurger reports failed purges
+
+    Returns a new purger of that class, else an HttpPurger if
+    CACHE_PURGE_URL is set, else None (nothing is purged)
+'''
+def create_purger(path=cache_purger, logger=None):
+    if path:
+        module_name, class_name = path.split(':')
+        return getattr(importlib.import_module(module_name), class_name)()
+    if cache_purge_url:
+        return HttpPurger(cache_purge_url, logger=logger)
+    return None
+
+
+def get_cache_control():
+    if current_app.config.get('CACHE_SHARED', 'off') == 'on':
+        return f'public, max-age=0, s-maxage={current_app.config.get("CACHE_MAX_AGE", cache_max_age)}'
+    return 'private, no-cache'
+
+
+'''
+Implementation of @cache_policy(*keys) decorator method
+    @INPUTS
+        keys: the route's surrogate keys, formatted with the view's
+            arguments (i.e. 'actor-{actor_id}')
+
+    Must be applied above @requires_auth
+    Adds the Cache-Control and Surrogate-Key headers to 200 responses
+    (errors are not cached)
+'''
+def cache_policy(*keys):
+    def cache_policy_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.headers['Cache-Control'] = get_cache_control()
+                response.headers['Surrogate-Key'] = ' '.join(key.format(**kwargs) for key in keys)
+            return response
+
+        return wrapper
+    return cache_policy_decorator
+
+
+def get_purger():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('purger')
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_purge_keys(session, flush_context):
+    if get_purger() is None:
+        return
+    changes = [instance for instance in session.new if isinstance(instance, Change)]
+    if changes:
+        keys = session.info.setdefault('purge_keys', set())
+        for change in changes:
+            keys.update(entity_keys(change.entity, change.entity_id))
+
+@event.listens_for(Session, 'after_commit')
+def purge_committed_keys(session):
+    keys = session.info.pop('purge_keys', None)
+    purger = get_purger()
+    if keys and purger is not None:
+        # the change is committed already, a failed purge only leaves it cached longer
+        try:
+            purger.purge(sorted(keys))
+        except Exception:
+            current_app.logger.exception('Cache purge failed')
+
+@event.listens_for(Session, 'after_rollback')
+def drop_purge_keys(session):
+    session.info.pop('purge_keys', None)
+
+
+'''
+    @INPUTS
+        app: a flask application
+        purger: the app's Purger (defaults to create_purger())
+
+    Gives the app its purger (app.extensions['purger'])
+    Raises ValueError if CACHE_SHARED is on while the app routes tenants
+    (the proxy would serve one agency's responses to another)
+'''
+def init_http_cache(app, purger=None):
+    if app.config.get('CACHE_SHARED', 'off') not in ('off', 'on'):
+        raise ValueError('CACHE_SHARED must be on or off')
+    if app.config.get('CACHE_SHARED') == 'on' and 'tenants' in app.extensions:
+        raise ValueError('A shared cache needs TENANT_ROUTING=off')
+    app.extensions['purger'] = purger or create_purger(logger=app.logger)
@@ -0,0 +1,189 @@
+import os
+import hashlib
+from datetime import timedelta
+from functools import wraps
+from flask import request, make_response, current_app, abort
+from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
+from models import db, IdempotencyKey, utcnow
+
+idempotency_ttl = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+idempotency_purge_batch_size = int(os.getenv('IDEMPOTENCY_PURGE_BATCH_SIZE', 1000))
+# how long a reservation waits for its response before a retry may take it
+# over (a worker killed mid-request never stores one); keep it above the
+# worker timeout, or a slow request could run twice
+idempotency_lease = int(os.getenv('IDEMPOTENCY_LEASE_SECONDS', 60))
+
+'''
+    @INPUTS
+        payload: decoded jwt payload
+
+    Returns a sha256 of who sent which body to which route
+    A key reused with a different request gets a 422 instead of a replay
+'''
+def request_fingerprint(payload):
+    digest = hashlib.sha256()
+    for part in (payload.get('sub', ''), request.method, request.path):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+'''
+    @INPUTS
+        fingerprint: see request_fingerprint
+        now: the current time
+
+    Returns the condition of a record a new request may take over: an
+    expired one, or one for the same request whose lease ran out before a
+    response was stored (can_take_over checks a loaded record)
+'''
+def takeover_condition(fingerprint, now):
+    return or_(
+        IdempotencyKey.expires_at <= now,
+        and_(
+            IdempotencyKey.status_code.is_(None),
+            IdempotencyKey.locked_until <= now,
+            IdempotencyKey.fingerprint == fingerprint
+        )
+    )
+
+def can_take_over(record, fingerprint, now):
+    if record.expires_at <= now:
+        return True
+    return (record.status_code is None and record.locked_until is not None
+            and record.locked_until <= now and record.fingerprint == fingerprint)
+
+'''
+    Deletes the key's record if it can still be taken over
+    The condition is checked by the DELETE itself: of two requests taking
+        over the same record, the one deleting nothing finds the other's
+        reservation on its next attempt
+'''
+def take_over_key(key, fingerprint, now):
+    IdempotencyKey.query.filter(IdempotencyKey.key == key, takeover_condition(fingerprint, now)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+'''
+    @INPUTS
+        key: the Idempotency-Key header
+        fingerprint: see request_fingerprint
+
+    Inserts the key with no response yet, leased for idempotency_lease
+        seconds, and returns None
+    If the key is already taken returns the existing record instead
+    The unique constraint on key serializes concurrent duplicates, so a new
+        key costs a single INSERT; the record is only read on a conflict
+'''
+def reserve_key(key, fingerprint):
+    for attempt in range(2):
+        now = utcnow()
+        expires_at = now + timedelta(seconds=idempotency_ttl)
+        db.session.add(IdempotencyKey(key, fingerprint, expires_at, now + timedelta(seconds=idempotency_lease)))
+        try:
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+
+        existing = IdempotencyKey.query.filter_by(key=key).first()
+        if existing is None:
+            # released meanwhile
+            continue
+        if attempt or not can_take_over(existing, fingerprint, now):
+            return existing
+        db.session.expunge(existing)
+        take_over_key(key, fingerprint, now)
+    return IdempotencyKey(key, fingerprint, expires_at)
+
+
+def release_key(key):
+    db.session.rollback()
+    IdempotencyKey.query.filter_by(key=key).delete()
+    db.session.commit()
+
+
+def store_response(key, response):
+    IdempotencyKey.query.filter_by(key=key).update({
+        'status_code': response.status_code,
+        'response_body': response.get_data(as_text=True),
+        'locked_until': None
+    })
+    db.session.commit()
+
+
+def replay_response(record, fingerprint):
+    if record.fingerprint != fingerprint:
+        abort(422)
+    if record.status_code is None:
+        # the original request is still running
+        abort(409)
+    response = current_app.response_class(
+        record.response_body,
+        status=record.status_code,
+        mimetype='application/json'
+    )
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+'''
+Implementation of @idempotent decorator method
+
+    Must be applied below @requires_auth
+    Requests without an Idempotency-Key header run as usual
+    The first request with a key runs the view and stores its response
+    Retries with the same key and body replay the stored response
+        without running the view again
+    If the view fails, the key is released so the client can retry
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > 255:
+            abort(400)
+
+        fingerprint = request_fingerprint(payload)
+        record = reserve_key(key, fingerprint)
+        if record is not None:
+            return replay_response(record, fingerprint)
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except BaseException:
+            release_key(key)
+            raise
+
+        if response.status_code >= 500:
+            release_key(key)
+        else:
+            store_response(key, response)
+        return response
+
+    return wrapper
+
+
+'''
+    @INPUTS
+        batch_size: rows deleted per statement
+
+    Deletes expired idempotency keys in batches, so a large backlog
+        doesn't hold one long transaction
+    Returns the number of rows deleted
+'''
+def purge_expired_keys(batch_size=idempotency_purge_batch_size):
+    purged = 0
+    while True:
+        ids = [row.id for row in db.session.query(IdempotencyKey.id)
+               .filter(IdempotencyKey.expires_at <= utcnow())
+               .limit(batch_size)]
+        if not ids:
+            return purged
+        IdempotencyKey.query.filter(IdempotencyKey.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        purged += len(ids)
@@ -0,0 +1,341 @@
+import os
+import json
+import uuid
+import tempfile
+import threading
+from datetime import timedelta
+from flask import request, current_app, g, abort
+from sqlalchemy import or_, and_
+from auth import check_permissions
+from models import db, Actor, Movie, Job, utcnow, notify_changes, insert_rows, delete_rows, actor_query, movie_query
+from tenants import worker_tenants, tenant_context, current_tenant
+from validation import ValidationError, validate_actor, validate_movie, validate_actor_filters, validate_movie_filters
+
+'''
+    Background jobs for bulk operations (POST /jobs, `flask worker`)
+
+    A job is a row of the jobs table. `flask worker` runs a pool of threads
+    that claim queued jobs and run them chunk by chunk; there is no broker,
+    the table is the queue
+    Each chunk's writes are committed in the same transaction as the job's
+    checkpoint, so a job is never half-way through a chunk: if its worker
+    dies, the job's lease runs out and another worker resumes it from the
+    last committed checkpoint
+
+    Kinds:
+        import  inserts the given rows (validated like POST /actors, /movies)
+        delete  deletes the rows matching the given listing filters
+        export  writes the rows matching the filters, as JSON lines, to a
+                file under job_results_dir (GET /jobs/<id>/result), in a
+                directory per tenant
+'''
+
+job_chunk_size = int(os.getenv('JOB_CHUNK_SIZE', 500))
+job_lease_seconds = int(os.getenv('JOB_LEASE_SECONDS', 60))
+job_poll_seconds = float(os.getenv('JOB_POLL_SECONDS', 1))
+job_max_import_rows = int(os.getenv('JOB_MAX_IMPORT_ROWS', 100000))
+# shared by the web and worker processes (export results are read from here)
+job_results_dir = os.getenv('JOB_RESULTS_DIR', os.path.join(tempfile.gettempdir(), 'casting-agency-jobs'))
+
+JOB_ENTITIES = {
+    'actors': (Actor, validate_actor, actor_query, validate_actor_filters),
+    'movies': (Movie, validate_movie, movie_query, validate_movie_filters),
+}
+# the permission a job needs is the one of the equivalent single request
+JOB_ACTIONS = {'import': 'post', 'delete': 'delete', 'export': 'get'}
+
+
+'''
+    @INPUTS
+        body: the JSON body of POST /jobs
+            {"kind": "import", "entity": "actors", "rows": [...]}
+            {"kind": "delete" | "export", "entity": "movies", "filters": {...}}
+
+    Raises ValidationError unless it describes a job
+    Returns the job's params
+'''
+def validate_job_kind(body):
+    if not isinstance(body, dict):
+        raise ValidationError({'body': 'Must be a JSON object.'}, 400)
+    if body.get('kind') not in JOB_ACTIONS:
+        raise ValidationError({'kind': f'Must be one of {", ".join(JOB_ACTIONS)}.'}, 400)
+    if body.get('entity') not in JOB_ENTITIES:
+        raise ValidationError({'entity': f'Must be one of {", ".join(JOB_ENTITIES)}.'}, 400)
+
+def validate_job(body):
+    validate_job_kind(body)
+    model, validate, query, validate_filters = JOB_ENTITIES[body['entity']]
+
+    if body['kind'] == 'import':
+        rows = body.get('rows')
+        if not isinstance(rows, list) or not rows:
+            raise ValidationError({'rows': 'Must be a non-empty list.'}, 400)
+        if len(rows) > job_max_import_rows:
+            raise ValidationError({'rows': f'Must have at most {job_max_import_rows} items.'}, 422)
+        errors = {}
+        status_code = 422
+        for index, row in enumerate(rows):
+            try:
+                validate(row)
+            except ValidationError as error:
+                status_code = min(status_code, error.status_code)
+                errors.update({f'rows.{index}.{field}': message for field, message in error.errors.items()})
+        if errors:
+            raise ValidationError(errors, status_code)
+        return {'entity': body['entity'], 'rows': rows}
+
+    filters = body.get('filters') or {}
+    validate_filters(filters, partial=True)
+    return {'entity': body['entity'], 'filters': filters}
+
+
+'''
+    Returns the permission POST /jobs needs for the job in the request body
+    (i.e. post:actors for an actors import)
+'''
+def job_permission():
+    body = request.get_json(silent=True)
+    validate_job_kind(body)
+    return f"{JOB_ACTIONS[body['kind']]}:{body['entity']}"
+
+
+'''
+    @INPUTS
+        job_id: id of a job of the current tenant
+        payload: decoded jwt payload
+
+    Returns the job if the token's sub submitted it and the token still
+    has the permission the job needed (i.e. get:actors for an actors export)
+    Aborts with 404 for the jobs of other subs, whose ids say nothing
+'''
+def get_owned_job(job_id, payload):
+    job = db.session.get(Job, job_id)
+    if job is None or job.owner != payload.get('sub'):
+        abort(404)
+    check_permissions(f"{JOB_ACTIONS[job.kind]}:{json.loads(job.params)['entity']}", payload)
+    return job
+
+
+'''
+    Queues a job and returns it formatted (before the commit expires it,
+    as reloading it would take another SELECT)
+'''
+def submit_job(kind, params, owner=None):
+    job = Job(kind, params, owner)
+    db.session.add(job)
+    db.session.flush()
+    formatted = job.format()
+    db.session.commit()
+    return formatted
+
+
+'''
+    Returns the export file of the current tenant's job (every tenant
+    database numbers its jobs from 1, see tenants.py)
+'''
+def get_result_path(job_id):
+    return os.path.join(job_results_dir, current_tenant() or '', f'job-{job_id}.jsonl')
+
+
+## Job kinds
+## each runs one chunk, without committing, and returns
+## (checkpoint, rows processed, done, result, total)
+
+def run_import(job, params, checkpoint):
+    model, validate, query, validate_filters = JOB_ENTITIES[params['entity']]
+    rows = params['rows']
+    start = checkpoint or 0
+    chunk = rows[start:start + job_chunk_size]
+    created = insert_rows(model, [validate(row) for row in chunk])
+    end = start + len(chunk)
+    done = end >= len(rows)
+    return end, created, done, {'created': end} if done else None, len(rows)
+
+
+def filtered_query(params):
+    model, validate, query, validate_filters = JOB_ENTITIES[params['entity']]
+    return model, query(**validate_filters(params['filters'], partial=True))
+
+
+def run_delete(job, params, checkpoint):
+    model, query = filtered_query(params)
+    total = query.order_by(None).count() if checkpoint is None else job.total
+    ids = query.with_entities(model.id).limit(job_chunk_size).statement
+    deleted = delete_rows(model, ids)
+    done = deleted < job_chunk_size
+    checkpoint = (checkpoint or 0) + deleted
+    return checkpoint, deleted, done, {'deleted': checkpoint} if done else None, total
+
+
+def run_export(job, params, checkpoint):
+    model, query = filtered_query(params)
+    total = query.order_by(None).count() if checkpoint is None else job.total
+    checkpoint = checkpoint or {'last_id': 0, 'offset': 0}
+    rows = query.filter(model.id > checkpoint['last_id']).limit(job_chunk_size).all()
+
+    result_path = get_result_path(job.id)
+    os.makedirs(os.path.dirname(result_path), exist_ok=True)
+    with open(result_path, 'ab') as result_file:
+        # drop whatever a crashed run wrote after the last checkpoint
+        result_file.truncate(checkpoint['offset'])
+        result_file.seek(checkpoint['offset'])
+        for row in rows:
+            result_file.write(json.dumps(row.format(), default=str).encode() + b'\n')
+        result_file.flush()
+        os.fsync(result_file.fileno())
+        offset = result_file.tell()
+
+    done = len(rows) < job_chunk_size
+    exported = job.processed + len(rows)
+    checkpoint = {'last_id': rows[-1].id if rows else checkpoint['last_id'], 'offset': offset}
+    return checkpoint, len(rows), done, {'exported': exported} if done else None, total
+
+
+JOB_KINDS = {'import': run_import, 'delete': run_delete, 'export': run_export}
+
+
+## Worker
+
+def claimable(now):
+    return or_(
+        Job.status == 'queued',
+        and_(Job.status == 'running', Job.locked_until < now)
+    )
+
+'''
+    @INPUTS
+        worker_id: unique id of the calling worker thread
+
+    Claims the oldest queued job, or a running one whose lease ran out
+    The claim is a conditional UPDATE, so two workers can't both win
+    Returns the job id, or None if there is nothing to do
+'''
+def claim_job(worker_id):
+    now = utcnow()
+    candidates = [row.id for row in db.session.query(Job.id)
+                  .filter(claimable(now)).order_by(Job.id).limit(5)]
+    for job_id in candidates:
+        claimed = Job.query.filter(Job.id == job_id, claimable(now)).update({
+            'status': 'running',
+            'locked_by': worker_id,
+            'locked_until': now + timedelta(seconds=job_lease_seconds),
+            'updated_at': now
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+'''
+    Saves the job's progress, in the same transaction as the chunk's writes
+    Returns False if the worker no longer holds the job's lease
+'''
+def save_progress(job_id, worker_id, values):
+    now = utcnow()
+    values.update({'updated_at': now, 'locked_until': now + timedelta(seconds=job_lease_seconds)})
+    return Job.query \
+        .filter(Job.id == job_id, Job.locked_by == worker_id, Job.status == 'running') \
+        .update(values, synchronize_session=False) == 1
+
+
+'''
+    @INPUTS
+        job_id: a job claimed by this worker
+        worker_id: unique id of the calling worker thread
+
+    Runs the job chunk by chunk until it is done, fails, or its lease
+    was taken over by another worker
+'''
+def run_job(job_id, worker_id):
+    while True:
+        job = db.session.get(Job, job_id)
+        # the job's changes are audited as its owner's (see audit.py)
+        g.audit_subject = job.owner
+        checkpoint = json.loads(job.checkpoint) if job.checkpoint else None
+        try:
+            checkpoint, processed, done, result, total = \
+                JOB_KINDS[job.kind](job, json.loads(job.params), checkpoint)
+        except Exception as error:
+            db.session.rollback()
+            current_app.logger.exception(f'Job {job_id} failed')
+            save_progress(job_id, worker_id, {'status': 'failed', 'error': str(error) or type(error).__name__})
+            db.session.commit()
+            return
+
+        values = {
+            'checkpoint': json.dumps(checkpoint),
+            'processed': Job.processed + processed,
+            'total': total
+        }
+        if done:
+            values.update({'status': 'succeeded', 'result': json.dumps(result)})
+        if not save_progress(job_id, worker_id, values):
+            db.session.rollback()
+            return
+        db.session.commit()
+        db.session.expire_all()
+        if processed:
+            notify_changes()
+        if done:
+            return
+
+
+def new_worker_id():
+    return f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+'''
+    Runs queued jobs in the calling thread until there are none left
+    Returns the number of jobs run (used by `flask worker --burst` and tests)
+'''
+def run_pending_jobs(worker_id=None):
+    worker_id = worker_id or new_worker_id()
+    count = 0
+    while True:
+        job_id = claim_job(worker_id)
+        if job_id is None:
+            return count
+        run_job(job_id, worker_id)
+        count += 1
+
+
+'''
+    @INPUTS
+        app: the flask application
+        stop: threading.Event ending the loop
+        burst: return once the queue is empty instead of polling
+
+    The loop of one worker thread, serving the jobs of every tenant
+    (see tenants.py) in turn
+'''
+def work(app, stop, burst=False):
+    worker_id = new_worker_id()
+    with app.app_context():
+        while not stop.is_set():
+            count = 0
+            for tenant in worker_tenants(app):
+                with tenant_context(tenant):
+                    count += run_pending_jobs(worker_id)
+            if count == 0 and burst:
+                return
+            stop.wait(job_poll_seconds)
+
+
+'''
+    Runs a pool of worker threads until interrupted (or, with burst,
+    until the queue is empty)
+'''
+def run_worker(app, threads=1, burst=False):
+    stop = threading.Event()
+    pool = [threading.Thread(target=work, args=(app, stop, burst), daemon=True) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    try:
+        for thread in pool:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in pool:
+            thread.join()
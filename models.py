@@ -1,26 +1,269 @@
 import os
+import json
+import logging
+import threading
+import weakref
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
 from dotenv import load_dotenv
+from collections import Counter
+from flask import g, current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import inspect, select, insert, update, delete, event, exc, text
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
 
 # Load environment variables from .env file
 load_dotenv()
 
 database_uri = os.getenv('DATABASE_URI')
 
-db = SQLAlchemy()
+# explicit timeouts, so a degraded database fails fast instead of
+# hanging the worker (see breakers.py)
+db_connect_timeout = int(os.getenv('DB_CONNECT_TIMEOUT', 5))
+db_pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', 5))
+db_statement_timeout_ms = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 15000))
+
+# PostgreSQL driver: psycopg2 or psycopg (psycopg 3, see get_engine_options)
+db_driver = os.getenv('DB_DRIVER', 'psycopg2')
+# runs of a statement before psycopg 3 prepares it (off: never, i.e. behind PgBouncer)
+db_prepare_threshold = None if os.getenv('DB_PREPARE_THRESHOLD') == 'off' \
+    else int(os.getenv('DB_PREPARE_THRESHOLD', 2))
+
+# range partitioning of movies by release_date on PostgreSQL: off, year or decade
+# (see create_partitioned_movies)
+movie_partitioning = os.getenv('MOVIE_PARTITIONING', 'off')
+# partitions created ahead of the current year, for upcoming releases
+movie_partitions_ahead = int(os.getenv('MOVIE_PARTITIONS_AHEAD', 2))
+
+"""
+TenantSession
+    routes the session to the engine of the request's tenant when the app
+    routes tenants (see tenants.py), and to the app's database otherwise
+"""
+class TenantSession(FlaskSession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            router = current_app.extensions.get('tenants')
+            tenant = g.get('tenant')
+            if router is not None and tenant is not None:
+                return router.engine_for(tenant)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': TenantSession})
+
+"""
+get_database_uri(database_uri, driver)
+    points a PostgreSQL uri at the DB_DRIVER driver: psycopg2 (default)
+    or psycopg (psycopg 3, with server-side prepared statements)
+"""
+PG_SCHEMES = ('postgres', 'postgresql', 'postgresql+psycopg2', 'postgresql+psycopg')
+
+def get_database_uri(database_uri, driver=None):
+    scheme, sep, rest = (database_uri or '').partition('://')
+    if scheme not in PG_SCHEMES:
+        return database_uri
+    return f'postgresql+{driver or db_driver}' + sep + rest
+
+"""
+get_engine_options(database_uri)
+    returns the engine options giving PostgreSQL connections explicit
+    connect, pool checkout and statement timeouts (none for sqlite)
+    With psycopg 3, a statement a connection has run db_prepare_threshold
+    times is prepared server-side, so the hot queries (get by id, list
+    pages) are parsed and planned once per connection
+"""
+def get_engine_options(database_uri):
+    if not (database_uri or '').startswith('postgres'):
+        return {}
+    connect_args = {
+        'connect_timeout': db_connect_timeout,
+        'options': f'-c statement_timeout={db_statement_timeout_ms}'
+    }
+    if database_uri.startswith('postgresql+psycopg://'):
+        connect_args['prepare_threshold'] = db_prepare_threshold
+    return {
+        'pool_timeout': db_pool_timeout,
+        'connect_args': connect_args
+    }
+
+"""
+pipeline(connection)
+    runs the block in psycopg 3 pipeline mode: statements are sent without
+    waiting for the previous ones' results, so a run of writes costs one
+    round trip. Only for writes without RETURNING whose rowcount isn't
+    used: SQLAlchemy reads a statement's result as soon as it executes it,
+    and in pipeline mode there is none yet; errors are raised when it ends
+    That rules out the job chunks and /batch, which read their RETURNING
+    rows, change seqs and lease updates (their bulk writes are one
+    multi-row statement each, and psycopg 3 pipelines executemany itself)
+    A no-op with other drivers
+"""
+@contextmanager
+def pipeline(connection):
+    if connection.dialect.driver != 'psycopg':
+        yield
+        return
+    with connection.connection.driver_connection.pipeline():
+        yield
 
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
 """
 def setup_db(app, database_uri=database_uri):
+    database_uri = get_database_uri(database_uri)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options(database_uri)
     db.app = app
     db.init_app(app)
     with app.app_context():
+        if uses_movie_partitions(db.engine):
+            create_partitioned_movies(db.engine)
         db.create_all()
 
+"""
+Movie partitions
+
+    With MOVIE_PARTITIONING=year (or decade) on PostgreSQL, movies is
+    created as a table partitioned by range of release_date, with one
+    partition per year (movies_2010) or decade (movies_2010s) and a
+    default partition (movies_default) for the rest. Date-filtered
+    listings then only scan the partitions of their range (partition
+    pruning); lookups by id probe every partition's primary key, so
+    decades suit large archives better than years
+    The primary key is (id, release_date), as PostgreSQL requires the
+    partition key in it; the model keeps id alone as its identity
+    A release year without a partition is written to the default
+    partition, then moved into a new partition of its own once the
+    transaction commits (split_movie_partitions)
+    On SQLite, or with MOVIE_PARTITIONING=off, movies is a single table
+    An existing unpartitioned movies table is left as it is
+"""
+PARTITIONED_MOVIES_DDL = '''
+CREATE TABLE movies (
+    id SERIAL NOT NULL,
+    title VARCHAR NOT NULL,
+    release_date DATE NOT NULL,
+    PRIMARY KEY (id, release_date)
+) PARTITION BY RANGE (release_date)
+'''
+
+# partition names already attached, by engine (tenant engines of schema
+# routing share their url, not their schema)
+movie_partitions = weakref.WeakKeyDictionary()
+logger = logging.getLogger(__name__)
+
+def uses_movie_partitions(engine):
+    return movie_partitioning != 'off' and engine.dialect.name == 'postgresql'
+
+# a partition's end is None (MAXVALUE) past the last year a date can have
+def movie_partition_bounds(release_date, granularity=None):
+    granularity = granularity or movie_partitioning
+    span = 10 if granularity == 'decade' else 1
+    year = release_date.year - release_date.year % span
+    name = f'movies_{year}s' if span == 10 else f'movies_{year}'
+    end = date(year + span, 1, 1) if year + span <= date.max.year else None
+    return name, date(year, 1, 1), end
+
+def create_partitioned_movies(engine):
+    with engine.begin() as connection:
+        if inspect(connection).has_table('movies'):
+            return
+        connection.exec_driver_sql(PARTITIONED_MOVIES_DDL)
+        connection.exec_driver_sql('CREATE TABLE movies_default PARTITION OF movies DEFAULT')
+    split_movie_partitions(engine, upcoming_release_dates())
+
+def upcoming_release_dates():
+    this_year = date.today().year
+    return [date(year, 1, 1) for year in range(this_year, this_year + movie_partitions_ahead + 1)]
+
+def get_movie_partitions(engine):
+    if engine not in movie_partitions:
+        with engine.connect() as connection:
+            movie_partitions[engine] = set(connection.exec_driver_sql(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST('movies' AS regclass)"
+            ).scalars())
+    return movie_partitions[engine]
+
+"""
+split_movie_partitions(engine, release_dates)
+    creates the partitions of release_dates that don't exist yet, moving
+    their rows out of the default partition, one transaction each
+    (the new partition is attached once it holds its rows, which only
+    takes a short lock on the parent table)
+    release_dates defaults to the dates in the default partition
+    returns the number of partitions created
+"""
+def split_movie_partitions(engine, release_dates=None):
+    if not uses_movie_partitions(engine):
+        return 0
+    if release_dates is None:
+        with engine.connect() as connection:
+            release_dates = connection.exec_driver_sql(
+                'SELECT DISTINCT make_date(CAST(extract(year FROM release_date) AS int), 1, 1) FROM movies_default'
+            ).scalars().all()
+
+    existing = get_movie_partitions(engine)
+    created = 0
+    for name, start, end in sorted({movie_partition_bounds(release_date) for release_date in release_dates}):
+        if name in existing:
+            continue
+        try:
+            with engine.begin() as connection:
+                # don't queue behind long transactions; the rows wait in the default partition
+                connection.exec_driver_sql("SET LOCAL lock_timeout = '2s'")
+                connection.exec_driver_sql(f'CREATE TABLE IF NOT EXISTS {name} (LIKE movies INCLUDING ALL)')
+                before_end = 'AND release_date < :end ' if end else ''
+                connection.execute(text(
+                    f'WITH moved AS (DELETE FROM movies_default WHERE release_date >= :start '
+                    f'{before_end}RETURNING *) INSERT INTO {name} SELECT * FROM moved'
+                ), {'start': start, 'end': end})
+                upper_bound = f"'{end}'" if end else 'MAXVALUE'
+                connection.exec_driver_sql(
+                    f"ALTER TABLE movies ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ({upper_bound})"
+                )
+        except exc.DBAPIError:
+            logger.warning(f'Could not create movie partition {name}', exc_info=True)
+            # another worker may have created it; reload the names next time
+            movie_partitions.pop(engine, None)
+            continue
+        existing.add(name)
+        created += 1
+    return created
+
+# the release dates of the movie changes a session flushed, for the
+# partitions to create once it commits (read from the change log rows)
+@event.listens_for(Session, 'after_flush')
+def collect_release_dates(session, flush_context):
+    if movie_partitioning == 'off':
+        return
+    for change in session.new:
+        if isinstance(change, Change) and change.entity == 'movie' and change.data:
+            release_date = date.fromisoformat(str(json.loads(change.data)['release_date'])[:10])
+            session.info.setdefault('release_dates', set()).add(release_date)
+
+@event.listens_for(Session, 'after_commit')
+def create_release_partitions(session):
+    release_dates = session.info.pop('release_dates', None)
+    if not release_dates or not uses_movie_partitions(session.get_bind()):
+        return
+    engine = session.get_bind()
+    try:
+        names = get_movie_partitions(engine)
+        if any(movie_partition_bounds(release_date)[0] not in names for release_date in release_dates):
+            split_movie_partitions(engine, release_dates)
+    except (exc.SQLAlchemyError, ValueError):
+        # the change is committed; `flask partition-movies` splits the rows later
+        logger.warning('Could not create movie partitions', exc_info=True)
+
+@event.listens_for(Session, 'after_rollback')
+def drop_release_dates(session):
+    session.info.pop('release_dates', None)
+
 """
 Movie
 
@@ -30,7 +273,8 @@ class Movie(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
-    release_date = db.Column(db.Date, nullable=False)
+    # active_history: stats need the old value even if it was expired
+    release_date = db.column_property(db.Column(db.Date, nullable=False), active_history=True)
 
     def __init__(self, title, release_date):
         self.title = title
@@ -38,14 +282,15 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        commit_change(self, 'insert')
 
     def update(self):
-        db.session.commit()
+        commit_change(self, 'update')
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_change(self, 'delete')
 
     def format(self):
         return {
@@ -63,8 +308,9 @@ class Actor(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    age = db.Column(db.Integer, nullable=False)
-    gender = db.Column(db.String(10), nullable=False)
+    # active_history: stats need the old values even if they were expired
+    age = db.column_property(db.Column(db.Integer, nullable=False), active_history=True)
+    gender = db.column_property(db.Column(db.String(10), nullable=False), active_history=True)
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -73,14 +319,15 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        commit_change(self, 'insert')
 
     def update(self):
-        db.session.commit()
+        commit_change(self, 'update')
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_change(self, 'delete')
 
     def format(self):
         return {
@@ -90,6 +337,445 @@ class Actor(db.Model):
             'gender': self.gender
         }
 
+"""
+utcnow()
+    naive UTC timestamp, comparable on both PostgreSQL and SQLite
+"""
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+"""
+IdempotencyKey
+    fingerprint and stored response of a POST made with an
+    Idempotency-Key header, so a retry can be replayed
+    status_code is NULL while the original request is still running, which
+    it is presumed to be until locked_until (see idempotency.py)
+"""
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False, unique=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    response_body = db.Column(db.Text)
+    locked_until = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, key, fingerprint, expires_at, locked_until=None):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.expires_at = expires_at
+        self.locked_until = locked_until
+
+"""
+Job
+    a long-running bulk operation run by the `flask worker` command
+    (see jobs.py). params and result are JSON; checkpoint is the JSON
+    position the job has committed up to, so a job whose worker died
+    resumes there once its lease (locked_until) has run out
+"""
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (db.Index('ix_jobs_status', 'status', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    params = db.Column(db.Text, nullable=False)
+    owner = db.Column(db.String(255))
+    checkpoint = db.Column(db.Text)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    locked_by = db.Column(db.String(64))
+    locked_until = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, kind, params, owner=None):
+        self.kind = kind
+        self.status = 'queued'
+        self.params = json.dumps(params)
+        self.owner = owner
+        self.processed = 0
+        self.created_at = self.updated_at = utcnow()
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'processed': self.processed,
+            'total': self.total,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat()
+        }
+
+"""
+Change
+    append-only log of actor and movie mutations (see changes.py)
+    seq orders the feed, in commit order (see lock_sequence); data is the
+    formatted row (NULL for deletes)
+"""
+class Change(db.Model):
+    __tablename__ = 'changes'
+    __table_args__ = (db.Index('ix_changes_entity', 'entity', 'entity_id'),)
+
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def __init__(self, entity, entity_id, op, data):
+        self.entity = entity
+        self.entity_id = entity_id
+        self.op = op
+        self.data = data
+        self.created_at = utcnow()
+
+    @classmethod
+    def of(cls, instance, op):
+        data = None if op == 'delete' else json.dumps(instance.format(), default=str)
+        return cls(type(instance).__name__.lower(), instance.id, op, data)
+
+    @classmethod
+    def of_row(cls, model, row, op):
+        data = None if op == 'delete' else json.dumps(model.format(row), default=str)
+        return cls(model.__name__.lower(), row.id, op, data)
+
+    def format(self):
+        return {
+            'seq': self.seq,
+            'entity': self.entity,
+            'id': self.entity_id,
+            'op': self.op,
+            'data': json.loads(self.data) if self.data else None,
+            'created_at': self.created_at.isoformat()
+        }
+
+"""
+Commit-ordered sequences
+    change seqs (and audit event ids) are handed out at insert time, so
+    two PostgreSQL transactions could commit theirs out of order, and a
+    reader paging on seq > since would skip the one committed last
+    A transaction takes lock_sequence's advisory lock before it inserts
+    such rows and holds it until it ends, so they commit in the order of
+    their numbers (SQLite only runs one write transaction at a time)
+"""
+CHANGE_SEQ_LOCK = 7201
+AUDIT_ID_LOCK = 7202
+
+def lock_sequence(connection, key):
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(f'SELECT pg_advisory_xact_lock({key})')
+
+@event.listens_for(Session, 'before_flush')
+def lock_change_seq(session, flush_context, instances):
+    if session.info.get('change_seq_locked'):
+        return
+    if any(isinstance(instance, Change) for instance in session.new):
+        lock_sequence(session.connection(), CHANGE_SEQ_LOCK)
+        session.info['change_seq_locked'] = True
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def unlock_change_seq(session):
+    session.info.pop('change_seq_locked', None)
+
+"""
+AuditEvent
+    who (the token's sub) made which actor or movie change, and when
+    written behind the change, in batches, by audit.py
+    change_seq is the change log row of the change (see Change)
+"""
+class AuditEvent(db.Model):
+    __tablename__ = 'audit_events'
+    __table_args__ = (
+        db.Index('ix_audit_subject', 'subject', 'id'),
+        db.Index('ix_audit_entity', 'entity', 'entity_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    change_seq = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'subject': self.subject,
+            'entity': self.entity,
+            'entity_id': self.entity_id,
+            'op': self.op,
+            'change_seq': self.change_seq,
+            'created_at': self.created_at.isoformat()
+        }
+
+# notified after every committed change, wakes up the SSE streams of this worker
+change_signal = threading.Condition()
+# bumped on every commit in this worker (see catalog.py)
+change_version = 0
+
+def notify_changes():
+    global change_version
+    with change_signal:
+        change_version += 1
+        change_signal.notify_all()
+
+"""
+Stat
+    precomputed aggregate counters served by GET /stats (see stats.py)
+    kept up to date in the same transaction as every actor/movie change
+"""
+class Stat(db.Model):
+    __tablename__ = 'stats'
+
+    metric = db.Column(db.String(30), primary_key=True)
+    bucket = db.Column(db.String(30), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, metric, bucket, count):
+        self.metric = metric
+        self.bucket = bucket
+        self.count = count
+
+def age_bucket(age):
+    low = int(age) // 10 * 10
+    return f'{low}-{low + 9}'
+
+def release_year(release_date):
+    # release_date is a date, or still the ISO string it was set from
+    return str(release_date)[:4]
+
+def stat_buckets(entity, values):
+    if entity == 'actor':
+        return [
+            ('actors', 'total'),
+            ('actors_by_gender', values['gender']),
+            ('actors_by_age', age_bucket(values['age']))
+        ]
+    return [
+        ('movies', 'total'),
+        ('movies_by_release_year', release_year(values['release_date']))
+    ]
+
+# columns the stats counters are bucketed on
+STAT_COLUMNS = {
+    'actor': {'age', 'gender'},
+    'movie': {'release_date'}
+}
+
+def current_values(instance):
+    return {attr.key: getattr(instance, attr.key) for attr in inspect(instance).mapper.column_attrs}
+
+def previous_values(instance):
+    state = inspect(instance)
+    values = {}
+    for attr in state.mapper.column_attrs:
+        history = state.attrs[attr.key].history
+        values[attr.key] = history.deleted[0] if history.deleted else getattr(instance, attr.key)
+    return values
+
+"""
+stat_deltas(instance, op)
+    counter deltas for one mutation, keyed by (metric, bucket)
+    must run before anything flushes the session, because updates
+    read the old values from the attribute history
+"""
+def stat_deltas(instance, op):
+    return value_stat_deltas(
+        type(instance).__name__.lower(),
+        current_values(instance) if op != 'delete' else None,
+        previous_values(instance) if op != 'insert' else None
+    )
+
+"""
+value_stat_deltas(entity, new_values, old_values)
+    counter deltas for a row going from old_values to new_values
+    (None for the side that doesn't exist, i.e. insert or delete)
+"""
+def value_stat_deltas(entity, new_values=None, old_values=None):
+    deltas = Counter()
+    if new_values is not None:
+        for key in stat_buckets(entity, new_values):
+            deltas[key] += 1
+    if old_values is not None:
+        for key in stat_buckets(entity, old_values):
+            deltas[key] -= 1
+    return {key: delta for key, delta in deltas.items() if delta}
+
+"""
+stat_upserts(dialect_name, deltas)
+    yields the upsert applying every counter delta in one statement
+    (one multi-row INSERT ... ON CONFLICT, not one statement per bucket;
+    the buckets of a delta dict are distinct, as ON CONFLICT requires)
+    The rows are sorted, so concurrent upserts lock shared counters in the
+    same order instead of deadlocking
+"""
+def stat_upserts(dialect_name, deltas):
+    if not deltas:
+        return
+    insert = postgresql.insert if dialect_name == 'postgresql' else sqlite.insert
+    statement = insert(Stat).values([
+        {'metric': metric, 'bucket': bucket, 'count': delta}
+        for (metric, bucket), delta in sorted(deltas.items())
+    ])
+    yield statement.on_conflict_do_update(
+        index_elements=['metric', 'bucket'],
+        set_={'count': Stat.count + statement.excluded['count']}
+    )
+
+"""
+commit_change(instance, op)
+    adds the change log row for instance, updates the stats counters
+    and commits both in the same transaction as the mutation itself
+"""
+def commit_change(instance, op):
+    deltas = stat_deltas(instance, op)
+    db.session.add(Change.of(instance, op))
+    for statement in stat_upserts(db.session.get_bind().dialect.name, deltas):
+        db.session.execute(statement)
+    db.session.commit()
+    notify_changes()
+
+"""
+actor_query(gender, min_age, max_age) / movie_query(released_from, released_to)
+    the GET /actors and GET /movies listings, with optional filters
+"""
+def actor_query(gender=None, min_age=None, max_age=None):
+    query = Actor.query
+    if gender is not None:
+        query = query.filter(Actor.gender == gender)
+    if min_age is not None:
+        query = query.filter(Actor.age >= min_age)
+    if max_age is not None:
+        query = query.filter(Actor.age <= max_age)
+    return query.order_by(Actor.id)
+
+def movie_query(released_from=None, released_to=None):
+    query = Movie.query
+    if released_from is not None:
+        query = query.filter(Movie.release_date >= released_from)
+    if released_to is not None:
+        query = query.filter(Movie.release_date <= released_to)
+    return query.order_by(Movie.id)
+
+"""
+get_many(model, ids)
+    fetches the rows with the given ids in one WHERE id IN (...) query
+    returns the formatted rows in the order of ids, and the missing ids
+"""
+def get_many(model, ids):
+    rows = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+    found = [rows[id].format() for id in ids if id in rows]
+    missing = [id for id in ids if id not in rows]
+    return found, missing
+
+"""
+Single-statement writes
+
+    insert_returning, update_returning and delete_returning write one
+    actor or movie row with a single INSERT/UPDATE/DELETE ... RETURNING
+    and return the formatted row (None if the id doesn't exist)
+    They replace the SELECT + write + re-SELECT of the ORM methods
+    The change log row and stats counters are written in the same
+    transaction, like commit_change does
+"""
+def commit_row_change(model, row, op, deltas):
+    db.session.add(Change.of_row(model, row, op))
+    for statement in stat_upserts(db.session.get_bind().dialect.name, deltas):
+        db.session.execute(statement)
+    db.session.commit()
+    notify_changes()
+
+def insert_returning(model, values):
+    table = model.__table__
+    row = db.session.execute(insert(table).values(**values).returning(*table.c)).one()
+    commit_row_change(model, row, 'insert', value_stat_deltas(model.__name__.lower(), row._asdict()))
+    return model.format(row)
+
+def update_returning(model, id, values):
+    table = model.__table__
+    entity = model.__name__.lower()
+    if not values:
+        row = db.session.execute(select(table).where(table.c.id == id)).first()
+        db.session.rollback()
+        return model.format(row) if row else None
+
+    old_values = None
+    if STAT_COLUMNS[entity] & values.keys():
+        # the stats need the old buckets; lock the row until commit
+        old = db.session.execute(select(table).where(table.c.id == id).with_for_update()).first()
+        if old is None:
+            db.session.rollback()
+            return None
+        old_values = old._asdict()
+
+    row = db.session.execute(
+        update(table).where(table.c.id == id).values(**values).returning(*table.c)
+    ).first()
+    if row is None:
+        db.session.rollback()
+        return None
+    deltas = value_stat_deltas(entity, row._asdict(), old_values) if old_values else {}
+    commit_row_change(model, row, 'update', deltas)
+    return model.format(row)
+
+def delete_returning(model, id):
+    table = model.__table__
+    row = db.session.execute(delete(table).where(table.c.id == id).returning(*table.c)).first()
+    if row is None:
+        db.session.rollback()
+        return None
+    commit_row_change(model, row, 'delete', value_stat_deltas(model.__name__.lower(), old_values=row._asdict()))
+    return model.format(row)
+
+"""
+Chunk writes of the background jobs (see jobs.py)
+
+    insert_rows and delete_rows write many actor or movie rows with one
+    multi-row INSERT/DELETE ... RETURNING, log them and update the stats
+    counters, but leave the transaction open: the job commits the chunk
+    together with its checkpoint, so a resumed job never repeats a chunk
+    Both return the number of rows written
+"""
+def record_row_changes(model, rows, op):
+    entity = model.__name__.lower()
+    deltas = Counter()
+    for row in rows:
+        if op == 'delete':
+            deltas.update(value_stat_deltas(entity, old_values=row._asdict()))
+        else:
+            deltas.update(value_stat_deltas(entity, new_values=row._asdict()))
+    db.session.add_all([Change.of_row(model, row, op) for row in rows])
+    changed = {key: delta for key, delta in deltas.items() if delta}
+    for statement in stat_upserts(db.session.get_bind().dialect.name, changed):
+        db.session.execute(statement)
+    return len(rows)
+
+def insert_rows(model, rows):
+    if not rows:
+        return 0
+    table = model.__table__
+    inserted = db.session.execute(insert(table).returning(*table.c), rows).all()
+    return record_row_changes(model, inserted, 'insert')
+
+def delete_rows(model, ids_query):
+    table = model.__table__
+    deleted = db.session.execute(
+        delete(table).where(table.c.id.in_(ids_query)).returning(*table.c)
+    ).all()
+    return record_row_changes(model, deleted, 'delete')
+
 def insertInitialData(app):
     # Insert some sample movies and  actors into the database
     movie1 = Movie(
@@ -0,0 +1,144 @@
+import os
+import re
+from contextlib import contextmanager
+from collections import Counter
+from flask import request, current_app, has_request_context
+from tenants import listen_engines
+
+'''
+    Per-request SQL statement budgets and N+1 detection (opt-in)
+
+    With QUERY_BUDGET_MODE=warn or raise, every SQL statement a request
+    runs is recorded (SQLAlchemy before_cursor_execute event) and checked
+    when the request ends:
+        - routes declare the most statements they may run with @query_budget(n)
+        - the same statement shape repeated query_repeat_threshold times or
+          more is reported as an N+1 pattern
+    warn logs a warning; raise fails the request (and the test) with a
+    QueryBudgetExceeded. The default, off, records nothing
+'''
+
+query_budget_mode = os.getenv('QUERY_BUDGET_MODE', 'off')
+query_repeat_threshold = int(os.getenv('QUERY_REPEAT_THRESHOLD', 3))
+
+
+'''
+QueryBudgetExceeded Exception
+    raised in raise mode with the report of the offending request
+'''
+class QueryBudgetExceeded(Exception):
+    def __init__(self, report):
+        super().__init__(format_report(report))
+        self.report = report
+
+
+'''
+Implementation of @query_budget(max_queries) decorator method
+    @INPUTS
+        max_queries: the most SQL statements one request to the route may run
+
+    Put it right below @app.route, so the budget is on the registered view
+'''
+def query_budget(max_queries):
+    def query_budget_decorator(f):
+        f.query_budget = max_queries
+        return f
+    return query_budget_decorator
+
+
+'''
+    Statements run inside the block are not counted against the request,
+    for work whose cost isn't per request (i.e. loading the catalog snapshot)
+'''
+@contextmanager
+def unbudgeted():
+    statements = getattr(request, 'sql_statements', None) if has_request_context() else None
+    if statements is not None:
+        request.sql_statements = None
+    try:
+        yield
+    finally:
+        if statements is not None:
+            request.sql_statements = statements
+
+
+'''
+    @INPUTS
+        statement: SQL text as sent to the driver
+
+    Returns the statement's shape: placeholders of any paramstyle become ?,
+    IN lists and multi-row VALUES collapse to one item, and numbers to N,
+    so the same query with other parameters has the same shape
+'''
+placeholder_pattern = re.compile(r'%\(\w+\)s|%s|:\w+|\$\d+|\?')
+list_pattern = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+number_pattern = re.compile(r'\b\d+\b')
+
+def statement_shape(statement):
+    shape = placeholder_pattern.sub('?', ' '.join(statement.split()))
+    shape = list_pattern.sub('(?)', shape)
+    shape = re.sub(r'(\(\?\))(?:\s*,\s*\(\?\))+', r'\1', shape)
+    return number_pattern.sub('N', shape)
+
+
+'''
+    @INPUTS
+        statements: the SQL statements one request ran
+        budget: the route's query budget, or None if it has none
+
+    Returns {count, budget, over_budget, repeated} where repeated maps each
+    statement shape seen query_repeat_threshold times or more to its count
+'''
+def build_report(statements, budget=None):
+    shapes = Counter(statement_shape(statement) for statement in statements)
+    return {
+        'count': len(statements),
+        'budget': budget,
+        'over_budget': budget is not None and len(statements) > budget,
+        'repeated': {shape: n for shape, n in shapes.items() if n >= query_repeat_threshold}
+    }
+
+def format_report(report):
+    lines = [f"{report.get('route', 'request')} ran {report['count']} SQL statements (budget {report['budget']})"]
+    lines += [f'  repeated {n}x: {shape}' for shape, n in report['repeated'].items()]
+    return '\n'.join(lines)
+
+
+'''
+    @INPUTS
+        app: a flask application
+        engine: the engine its routes use (defaults to db.engine; tenant
+            engines are listened to as well, see tenants.py)
+
+    Records the statements of each request (on the request object, so the
+    sub-requests of POST /batch are counted on their own) and checks them
+    against the route's budget once the response is ready
+'''
+def init_query_budget(app, engine=None):
+    if app.config.get('QUERY_BUDGET_MODE', 'off') == 'off':
+        return
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            statements = getattr(request, 'sql_statements', None)
+            if statements is not None:
+                statements.append(statement)
+
+    listen_engines(app, engine, 'before_cursor_execute', record_statement)
+
+    @app.before_request
+    def start_query_log():
+        request.sql_statements = []
+
+    @app.after_request
+    def check_query_budget(response):
+        view = current_app.view_functions.get(request.endpoint)
+        statements = getattr(request, 'sql_statements', None) or []
+        report = build_report(statements, getattr(view, 'query_budget', None))
+        report['route'] = f'{request.method} {request.path}'
+        request.query_report = report
+        if report['over_budget'] or report['repeated']:
+            if current_app.config['QUERY_BUDGET_MODE'] == 'raise':
+                raise QueryBudgetExceeded(report)
+            current_app.logger.warning(format_report(report))
+        return response
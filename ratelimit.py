@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+import importlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from flask import current_app
+
+'''
+    Per-client rate limits and concurrency quotas
+
+    Clients are told apart by the sub claim of their token (azp if there
+    is none). Every request to a route spends tokens from the client's
+    bucket according to the route's permission (reads are cheap, writes
+    cost more), and a client can only have rate_limit_max_in_flight
+    requests running at once. Rejected requests get a 429 with Retry-After
+
+    The counters live in a RateLimitStore: in-process by default, or any
+    shared backend implementing the same three methods (RATE_LIMIT_STORE
+    names its class as module:Class)
+'''
+
+# the bucket refills rate_limit_per_second tokens a second, up to rate_limit_burst
+# (RATE_LIMIT_PER_SECOND=0 turns rate limiting off)
+rate_limit_per_second = float(os.getenv('RATE_LIMIT_PER_SECOND', 20))
+rate_limit_burst = float(os.getenv('RATE_LIMIT_BURST', 100))
+rate_limit_max_in_flight = int(os.getenv('RATE_LIMIT_MAX_IN_FLIGHT', 8))
+rate_limit_store = os.getenv('RATE_LIMIT_STORE')
+
+# tokens one request costs, by permission (i.e. RATE_LIMIT_COSTS=get:stats=5,post:movies=20)
+# or else by its action (the part before the colon)
+default_costs = {'get': 1, 'post': 5, 'patch': 5, 'delete': 5}
+
+def parse_costs(value):
+    costs = {}
+    for item in filter(None, (value or '').split(',')):
+        permission, cost = item.rsplit('=', 1)
+        costs[permission.strip()] = float(cost)
+    return costs
+
+permission_costs = parse_costs(os.getenv('RATE_LIMIT_COSTS'))
+
+
+'''
+RateLimitExceeded Exception
+    raised when a client is over its rate limit or concurrency quota
+    retry_after is the number of seconds the client should wait
+'''
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after=1):
+        self.retry_after = max(int(retry_after + 0.999), 1)
+
+
+'''
+RateLimitStore
+    the interface a counter backend implements
+    A shared backend (i.e. one keeping the counters in Redis, so every
+        worker sees the same buckets) must make each method atomic
+'''
+class RateLimitStore(ABC):
+    '''
+        Takes cost tokens from key's bucket (refilling rate a second, up to burst)
+        Returns 0 if they were taken, or the seconds until they will be available
+    '''
+    @abstractmethod
+    def take(self, key, cost, rate, burst):
+        pass
+
+    '''
+        Counts one more request in flight for key, unless limit already are
+        Returns True if it was counted
+    '''
+    @abstractmethod
+    def acquire(self, key, limit):
+        pass
+
+    @abstractmethod
+    def release(self, key):
+        pass
+
+
+'''
+MemoryStore
+    the in-process RateLimitStore (counters are per worker)
+    full buckets are forgotten once there are max_keys of them
+'''
+class MemoryStore(RateLimitStore):
+    def __init__(self, max_keys=10000):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.in_flight = {}
+        self.max_keys = max_keys
+
+    def take(self, key, cost, rate, burst):
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                if len(self.buckets) > self.max_keys:
+                    self.prune(now, rate, burst)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+
+    def prune(self, now, rate, burst):
+        self.buckets = {
+            key: (tokens, updated) for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * rate < burst
+        }
+
+    def acquire(self, key, limit):
+        with self.lock:
+            count = self.in_flight.get(key, 0)
+            if count >= limit:
+                return False
+            self.in_flight[key] = count + 1
+            return True
+
+    def release(self, key):
+        with self.lock:
+            count = self.in_flight.pop(key, 1) - 1
+            if count:
+                self.in_flight[key] = count
+
+
+'''
+    @INPUTS
+        path: module:Class of a RateLimitStore, or None
+
+    Returns a new store of that class (MemoryStore by default)
+'''
+def create_store(path=rate_limit_store):
+    if not path:
+        return MemoryStore()
+    module_name, class_name = path.split(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def get_client_key(payload):
+    return payload.get('sub') or payload.get('azp') or 'anonymous'
+
+def permission_cost(permission):
+    cost = permission_costs.get(permission)
+    if cost is None:
+        cost = default_costs.get(permission.split(':')[0], 1)
+    return cost
+
+
+'''
+    @INPUTS
+        payload: decoded jwt payload
+        permission: the permission of the route
+
+    Context manager running one request of the client within its limits
+    Raises RateLimitExceeded if the client has no tokens left for the
+        permission, or already has rate_limit_max_in_flight requests running
+    Apps without a store (app.extensions['rate_limits']) are not limited
+'''
+@contextmanager
+def client_limits(payload, permission):
+    store = current_app.extensions.get('rate_limits')
+    if store is None or rate_limit_per_second <= 0:
+        yield
+        return
+
+    key = get_client_key(payload)
+    cost = min(permission_cost(permission), rate_limit_burst)
+    retry_after = store.take(key, cost, rate_limit_per_second, rate_limit_burst)
+    if retry_after:
+        raise RateLimitExceeded(retry_after)
+    if not store.acquire(key, rate_limit_max_in_flight):
+        raise RateLimitExceeded()
+    try:
+        yield
+    finally:
+        store.release(key)
@@ -0,0 +1,95 @@
+from sqlalchemy import event, func, extract, select, insert
+from models import db, Actor, Movie, Stat, age_bucket
+
+'''
+    Aggregate statistics of the catalog
+
+    The counters in the stats table are maintained incrementally by
+    commit_change (models.py), so reading them costs the same whatever
+    the size of the actors and movies tables
+    rebuild_stats recomputes them from scratch with GROUP BY queries
+    A stats table created next to existing actors or movies (i.e. on
+    upgrade) is seeded the same way (seed_stats)
+'''
+
+'''
+    @INPUTS
+        rows: iterable of (metric, bucket, count)
+
+    Returns the counters in the shape served by GET /stats
+'''
+def format_stats(rows):
+    stats = {
+        'actors': {'total': 0, 'by_gender': {}, 'by_age': {}},
+        'movies': {'total': 0, 'by_release_year': {}}
+    }
+    sections = {
+        'actors_by_gender': stats['actors']['by_gender'],
+        'actors_by_age': stats['actors']['by_age'],
+        'movies_by_release_year': stats['movies']['by_release_year']
+    }
+    for metric, bucket, count in rows:
+        if count == 0:
+            continue
+        if metric in ('actors', 'movies'):
+            stats[metric]['total'] = count
+        else:
+            sections[metric][bucket] = count
+    return stats
+
+
+def get_stats():
+    return format_stats(db.session.query(Stat.metric, Stat.bucket, Stat.count))
+
+
+'''
+    @INPUTS
+        connection: where to run the queries (defaults to db.session)
+
+    Computes the counters with GROUP BY queries over the full tables
+    Returns a list of (metric, bucket, count)
+'''
+def compute_stats(connection=None):
+    connection = connection or db.session
+    rows = [
+        ('actors', 'total', connection.scalar(select(func.count()).select_from(Actor))),
+        ('movies', 'total', connection.scalar(select(func.count()).select_from(Movie)))
+    ]
+    rows += [('actors_by_gender', gender, count) for gender, count in
+             connection.execute(select(Actor.gender, func.count()).group_by(Actor.gender))]
+
+    decade = Actor.age // 10 * 10
+    rows += [('actors_by_age', age_bucket(low), count) for low, count in
+             connection.execute(select(decade, func.count()).group_by(decade))]
+
+    year = extract('year', Movie.release_date)
+    rows += [('movies_by_release_year', str(int(value)), count) for value, count in
+             connection.execute(select(year, func.count()).group_by(year))]
+    return rows
+
+
+'''
+    Seeds a newly created stats table from the actors and movies already
+    there, as commit_change only counts the changes made from then on
+'''
+@event.listens_for(db.metadata, 'after_create')
+def seed_stats(metadata, connection, tables=(), **kwargs):
+    if Stat.__table__ not in tables:
+        return
+    rows = [row for row in compute_stats(connection) if row[2]]
+    if rows:
+        connection.execute(insert(Stat), [
+            {'metric': metric, 'bucket': bucket, 'count': count} for metric, bucket, count in rows
+        ])
+
+
+'''
+    Replaces the stats table with counters computed from scratch
+    Returns the number of counters written
+'''
+def rebuild_stats():
+    rows = compute_stats()
+    Stat.query.delete()
+    db.session.add_all([Stat(metric, bucket, count) for metric, bucket, count in rows])
+    db.session.commit()
+    return len(rows)
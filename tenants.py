@@ -0,0 +1,213 @@
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import g, has_app_context
+from sqlalchemy import create_engine, event
+from models import db, get_database_uri, get_engine_options, uses_movie_partitions, create_partitioned_movies
+
+'''
+    Multi-tenant routing: one deployment serving several agencies
+
+    The tenant of a request is the tenant_claim of its token (requires_auth
+    sets g.tenant), and the session runs its queries on that tenant's
+    engine (see models.TenantSession):
+        database  each tenant has its own database, TENANT_DATABASE_URI
+                  with {tenant} in it (i.e. sqlite:////data/{tenant}.db)
+        schema    each tenant has its own PostgreSQL schema in the
+                  DATABASE_URI database (its connections' search_path)
+    Tenant engines are opened on first use, and their tables created; at
+    most tenant_max_engines are kept, the least recently used one is
+    disposed (its idle connections closed) to make room for another
+    With TENANT_ROUTING=off (the default) everything uses DATABASE_URI
+'''
+
+tenant_routing = os.getenv('TENANT_ROUTING', 'off')
+tenant_claim = os.getenv('TENANT_CLAIM', 'agency')
+tenant_database_uri = os.getenv('TENANT_DATABASE_URI')
+tenant_max_engines = int(os.getenv('TENANT_MAX_ENGINES', 16))
+# the tenants accepted, and served by `flask worker` (required with routing on)
+tenant_names = [name.strip() for name in os.getenv('TENANTS', '').split(',') if name.strip()]
+
+TENANT_MODES = ('off', 'database', 'schema')
+# safe as a schema name and in a database uri
+tenant_pattern = re.compile(r'^[a-z0-9][a-z0-9_]{0,62}$')
+# the tenant of each tenant engine (see engine_tenant)
+engine_tenants = weakref.WeakKeyDictionary()
+
+
+'''
+TenantRouter
+    the LRU of tenant engines of one app
+'''
+class TenantRouter:
+    def __init__(self, mode, database_uri, uri_template=None, max_engines=None, tenants=None):
+        if mode == 'database' and '{tenant}' not in (uri_template or ''):
+            raise ValueError('TENANT_DATABASE_URI must contain {tenant}')
+        if mode == 'schema' and not get_database_uri(database_uri).startswith('postgresql'):
+            raise ValueError('Schema routing needs PostgreSQL')
+        self.mode = mode
+        self.database_uri = database_uri
+        self.uri_template = uri_template
+        self.max_engines = max_engines or tenant_max_engines
+        self.tenants = set(tenants or [])
+        self.engines = OrderedDict()
+        self.provisioned = set()
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    '''
+        Returns the tenant name if it is a valid, accepted tenant
+        Raises ValueError otherwise
+    '''
+    def validate(self, tenant):
+        if not isinstance(tenant, str) or not tenant_pattern.match(tenant):
+            raise ValueError('Invalid tenant.')
+        if tenant not in self.tenants:
+            raise ValueError('Unknown tenant.')
+        return tenant
+
+    def engine_for(self, tenant):
+        with self.lock:
+            engine = self.engines.get(tenant)
+            if engine is not None:
+                self.engines.move_to_end(tenant)
+                return engine
+            engine = self.open(tenant)
+            self.engines[tenant] = engine
+            if len(self.engines) > self.max_engines:
+                evicted, old_engine = self.engines.popitem(last=False)
+                # connections in use are closed when they are returned
+                old_engine.dispose()
+        return engine
+
+    def open(self, tenant):
+        if self.mode == 'database':
+            uri = get_database_uri(self.uri_template.format(tenant=tenant))
+            engine = create_engine(uri, **get_engine_options(uri))
+        else:
+            uri = get_database_uri(self.database_uri)
+            options = get_engine_options(uri)
+            options['connect_args']['options'] += f' -c search_path={tenant}'
+            engine = create_engine(uri, **options)
+        engine_tenants[engine] = tenant
+        for name, listener in self.listeners:
+            event.listen(engine, name, listener)
+        if tenant not in self.provisioned:
+            self.provision(tenant, engine)
+            self.provisioned.add(tenant)
+        return engine
+
+    def provision(self, tenant, engine):
+        if self.mode == 'schema':
+            with engine.begin() as connection:
+                connection.exec_driver_sql(f'CREATE SCHEMA IF NOT EXISTS {tenant}')
+        if uses_movie_partitions(engine):
+            create_partitioned_movies(engine)
+        db.metadata.create_all(engine)
+
+    '''
+        Listens to an engine event on every tenant engine, open or to come
+    '''
+    def listen(self, name, listener):
+        with self.lock:
+            self.listeners.append((name, listener))
+            for engine in self.engines.values():
+                event.listen(engine, name, listener)
+
+
+def current_tenant():
+    return g.get('tenant') if has_app_context() else None
+
+
+'''
+    Returns the tenant an engine was opened for (None for the app's own
+    engine), i.e. in engine event listeners
+'''
+def engine_tenant(engine):
+    return engine_tenants.get(engine)
+
+
+'''
+    @INPUTS
+        router: the app's TenantRouter, or None
+        payload: decoded jwt payload
+
+    Returns the tenant of the payload (None if the app doesn't route tenants)
+    Raises ValueError if it has no valid tenant
+'''
+def resolve_tenant(router, payload):
+    if router is None:
+        return None
+    return router.validate(payload.get(tenant_claim))
+
+'''
+    Makes tenant the current one (g.tenant); the session is reset when
+    the tenant changes, so no row of another tenant stays in it
+'''
+def set_tenant(tenant):
+    if g.get('tenant') != tenant:
+        db.session.remove()
+    g.tenant = tenant
+
+@contextmanager
+def tenant_context(tenant):
+    set_tenant(tenant)
+    try:
+        yield
+    finally:
+        db.session.remove()
+        g.pop('tenant', None)
+
+
+'''
+    @INPUTS
+        app: a flask application
+        engine: the engine to listen to (defaults to db.engine)
+        name, listener: the engine event and its listener
+
+    Listens to the event on the engine and on the app's tenant engines
+'''
+def listen_engines(app, engine, name, listener):
+    if engine is None:
+        with app.app_context():
+            engine = db.engine
+    event.listen(engine, name, listener)
+    router = app.extensions.get('tenants')
+    if router is not None:
+        router.listen(name, listener)
+
+
+'''
+    Returns the tenants `flask worker` runs the jobs of (every accepted
+    tenant, or [None], the app's own database, unless the app routes tenants)
+'''
+def worker_tenants(app):
+    router = app.extensions.get('tenants')
+    if router is None:
+        return [None]
+    return sorted(router.tenants)
+
+
+'''
+    Gives the app a TenantRouter (app.extensions['tenants']) unless
+    app.config['TENANT_ROUTING'] is off
+'''
+def init_tenants(app):
+    mode = app.config.get('TENANT_ROUTING', 'off')
+    if mode not in TENANT_MODES:
+        raise ValueError(f'TENANT_ROUTING must be one of {", ".join(TENANT_MODES)}')
+    if mode == 'off':
+        return
+    # a tenant the worker doesn't serve could queue jobs that never run
+    if not app.config.get('TENANTS'):
+        raise ValueError('TENANTS must list the tenants when TENANT_ROUTING is on')
+    app.extensions['tenants'] = TenantRouter(
+        mode,
+        app.config['SQLALCHEMY_DATABASE_URI'],
+        uri_template=app.config.get('TENANT_DATABASE_URI'),
+        max_engines=app.config.get('TENANT_MAX_ENGINES'),
+        tenants=app.config.get('TENANTS')
+    )
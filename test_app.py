@@ -1,10 +1,44 @@
 import os
+import base64
+import glob
+import shutil
+import tempfile
 import unittest
 import json
+import re
+import threading
+import time
+import http.server
+from contextlib import contextmanager
+from sqlalchemy import event, exc, create_engine
 from dotenv import load_dotenv
-from models import Actor, Movie, db
+from datetime import date, timedelta
+from models import Actor, Movie, IdempotencyKey, Change, Stat, Job, AuditEvent, db, utcnow, movie_partition_bounds, get_database_uri, get_engine_options, pipeline, lock_sequence, CHANGE_SEQ_LOCK
 from app import create_app  
-from unittest.mock import patch
+from async_app import create_async_app, patch_database_driver
+from coalesce import SingleFlight
+from idempotency import purge_expired_keys, reserve_key
+import idempotency
+from changes import stream_changes, compact_changes
+from validation import validate_actor, validate_movie, ValidationError
+from catalog import ColumnarTable, ACTOR_COLUMNS
+from stats import get_stats, compute_stats, format_stats, rebuild_stats
+from querybudget import query_budget, statement_shape, build_report, QueryBudgetExceeded
+from httpcache import Purger, MemoryPurger, HttpPurger
+from jobs import run_pending_jobs, claim_job, run_job, work
+import jobs
+import audit
+from ratelimit import RateLimitStore, MemoryStore
+from breakers import CircuitBreaker, DependencyError, auth0_breaker, database_breaker, tenant_breakers
+from flask import request
+from unittest.mock import patch, Mock
+import requests
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import rsa
+from jose import jwt
+import auth
 
 class AppTestCase(unittest.TestCase):
     """This class represents the Flask app test case"""
@@ -17,7 +51,8 @@ class AppTestCase(unittest.TestCase):
         self.database_uri = os.getenv('TEST_DATABASE_URI')
        
         self.app = create_app({
-            "SQLALCHEMY_DATABASE_URI": self.database_uri
+            "SQLALCHEMY_DATABASE_URI": self.database_uri,
+            "AUDIT_LOG": "off"
         })
         
         self.client = self.app.test_client()
@@ -42,6 +77,27 @@ class AppTestCase(unittest.TestCase):
             movie1.insert()
             movie2.insert()
 
+    # Helper to count the SQL statements a request runs
+    @contextmanager
+    def count_statements(self):
+        """Collect every statement run inside the block (the change log and stats writes included)"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = self.db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    def change_log_statements(self):
+        """Statements logging a change: the changes INSERT, after the seq lock on PostgreSQL (see lock_sequence)"""
+        return 2 if self.database_uri.startswith('postgres') else 1
+
 #######################################################################################################################################################
 
 #   TESTING ENDPOINTS
@@ -614,6 +670,1992 @@ class AppTestCase(unittest.TestCase):
         self.assertEqual(res5.status_code, 200)  # PATCH movies
         self.assertEqual(res6.status_code, 200)  # DELETE movies
 
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_create_actor_idempotent_retry(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test that a POST /actors retry with the same Idempotency-Key is replayed"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "ingest", "permissions": ["post:actors"]}
+
+        headers = {'Idempotency-Key': 'import-42'}
+        body = {'name': 'New Actor', 'age': 30, 'gender': 'Male'}
+        res1 = self.client.post('/actors', json=body, headers=headers)
+        res2 = self.client.post('/actors', json=body, headers=headers)
+
+        self.assertEqual(res1.status_code, 201)
+        self.assertEqual(res2.status_code, 201)
+        self.assertEqual(json.loads(res1.data), json.loads(res2.data))
+        self.assertEqual(res2.headers.get('Idempotent-Replayed'), 'true')
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 1)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_create_actor_idempotency_key_reused(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test that reusing an Idempotency-Key with another body is rejected"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "ingest", "permissions": ["post:actors"]}
+
+        headers = {'Idempotency-Key': 'import-43'}
+        res1 = self.client.post('/actors', json={'name': 'Actor A', 'age': 30, 'gender': 'Male'}, headers=headers)
+        res2 = self.client.post('/actors', json={'name': 'Actor B', 'age': 30, 'gender': 'Male'}, headers=headers)
+
+        self.assertEqual(res1.status_code, 201)
+        self.assertEqual(res2.status_code, 422)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_failed_request_releases_idempotency_key(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test that a failed POST /actors can be retried with the same key"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "ingest", "permissions": ["post:actors"]}
+
+        headers = {'Idempotency-Key': 'import-44'}
+        res = self.client.post('/actors', json={'name': 'Actor A'}, headers=headers)
+
+        self.assertEqual(res.status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(IdempotencyKey.query.count(), 0)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_stale_idempotency_reservation_taken_over(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test a retry takes over a key whose request died before storing a response, once its lease ran out"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "ingest", "permissions": ["post:actors"]}
+
+        headers = {'Idempotency-Key': 'import-45'}
+        body = {'name': 'New Actor', 'age': 30, 'gender': 'Male'}
+        with self.app.test_request_context('/actors', method='POST', json=body):
+            fingerprint = idempotency.request_fingerprint(mock_verify_decode_jwt.return_value)
+        with self.app.app_context():
+            # the reservation of a worker killed mid-request
+            self.assertIsNone(reserve_key('import-45', fingerprint))
+
+        res1 = self.client.post('/actors', json=body, headers=headers)
+        with self.app.app_context():
+            IdempotencyKey.query.update({'locked_until': utcnow() - timedelta(seconds=1)})
+            db.session.commit()
+        res2 = self.client.post('/actors', json={'name': 'Other Actor', 'age': 30, 'gender': 'Male'}, headers=headers)
+        res3 = self.client.post('/actors', json=body, headers=headers)
+        res4 = self.client.post('/actors', json=body, headers=headers)
+
+        self.assertEqual(res1.status_code, 409)
+        self.assertEqual(res2.status_code, 422)
+        self.assertEqual(res3.status_code, 201)
+        self.assertEqual(res4.headers.get('Idempotent-Replayed'), 'true')
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 1)
+            self.assertIsNone(IdempotencyKey.query.one().locked_until)
+
+    def test_idempotency_takeover_race(self):
+        """Test of two requests taking over an expired key, the one losing the race finds the other's reservation"""
+        with self.app.app_context():
+            db.session.add(IdempotencyKey('import-46', 'f', utcnow() - timedelta(seconds=1)))
+            db.session.commit()
+
+            take_over_key = idempotency.take_over_key
+            def racing_take_over(*args):
+                racing_take_over.calls += 1
+                if racing_take_over.calls == 1:
+                    # another request takes the key over first
+                    self.assertIsNone(reserve_key('import-46', 'f'))
+                take_over_key(*args)
+            racing_take_over.calls = 0
+
+            with patch('idempotency.take_over_key', racing_take_over):
+                record = reserve_key('import-46', 'f')
+
+            self.assertEqual(racing_take_over.calls, 2)
+            self.assertIsNotNone(record)
+            self.assertIsNone(record.status_code)
+            self.assertGreater(record.expires_at, utcnow())
+
+    def test_purge_expired_idempotency_keys(self):
+        """Test that expired idempotency keys are purged in batches"""
+        with self.app.app_context():
+            expired = utcnow() - timedelta(seconds=1)
+            for i in range(5):
+                db.session.add(IdempotencyKey(f'old-{i}', 'f', expired))
+            db.session.add(IdempotencyKey('fresh', 'f', utcnow() + timedelta(hours=1)))
+            db.session.commit()
+
+            self.assertEqual(purge_expired_keys(batch_size=2), 5)
+            self.assertEqual(IdempotencyKey.query.count(), 1)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_changes_success(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /changes returns actor mutations in order and pages with since"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {
+            "permissions": ["post:actors", "patch:actors", "delete:actors", "get:changes"]
+        }
+
+        actor_id = json.loads(self.client.post('/actors', json={'name': 'New Actor', 'age': 30, 'gender': 'Male'}).data)['created']
+        self.client.patch(f'/actors/{actor_id}', json={'age': 31})
+        self.client.delete(f'/actors/{actor_id}')
+
+        res = self.client.get('/changes?since=0')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([change['op'] for change in data['changes']], ['insert', 'update', 'delete'])
+        self.assertEqual(data['changes'][1]['data']['age'], 31)
+        self.assertIsNone(data['changes'][2]['data'])
+        self.assertFalse(data['has_more'])
+
+        res = self.client.get(f"/changes?since={data['changes'][0]['seq']}&limit=1")
+        data = json.loads(res.data)
+
+        self.assertEqual([change['op'] for change in data['changes']], ['update'])
+        self.assertTrue(data['has_more'])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_changes_error(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /changes with an invalid since"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:changes"]}
+
+        res = self.client.get('/changes?since=abc')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_stream_and_compact_changes(self):
+        """Test the SSE change stream and compaction of the change log"""
+        with self.app.app_context():
+            actor = Actor(name='actor1', age=64, gender='Male')
+            actor.insert()
+            actor.age = 65
+            actor.update()
+
+            events = list(stream_changes(0, duration=0))
+            self.assertEqual(len([event for event in events if event.startswith('id: ')]), 2)
+            self.assertIn('event: change', events[0])
+
+            self.assertEqual(compact_changes(Change.query.count()), 1)
+            remaining = Change.query.all()
+            self.assertEqual([change.op for change in remaining], ['update'])
+
+    def test_change_seq_locked_until_commit(self):
+        """Test every transaction logging changes takes the change seq lock once"""
+        with self.app.app_context(), patch('models.lock_sequence') as mock_lock_sequence:
+            actor = Actor(name='actor1', age=64, gender='Male')
+            actor.insert()
+            actor.age = 65
+            actor.update()
+            self.assertEqual([call.args[1] for call in mock_lock_sequence.call_args_list],
+                             [CHANGE_SEQ_LOCK, CHANGE_SEQ_LOCK])
+
+        connection = Mock()
+        connection.dialect.name = 'postgresql'
+        lock_sequence(connection, CHANGE_SEQ_LOCK)
+        connection.exec_driver_sql.assert_called_once_with(f'SELECT pg_advisory_xact_lock({CHANGE_SEQ_LOCK})')
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_stats_success(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /stats matches the aggregates computed from scratch"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {
+            "permissions": ["post:actors", "patch:actors", "delete:actors", "get:stats"]
+        }
+
+        self.client.post('/actors', json={'name': 'Actor A', 'age': 34, 'gender': 'Female'})
+        self.client.post('/actors', json={'name': 'Actor B', 'age': 38, 'gender': 'Male'})
+        actor_id = json.loads(self.client.post('/actors', json={'name': 'Actor C', 'age': 61, 'gender': 'Male'}).data)['created']
+        self.client.patch(f'/actors/{actor_id}', json={'age': 45, 'gender': 'Female'})
+        self.client.delete('/actors/1')
+        with self.app.app_context():
+            movie = Movie(title='movie1', release_date=date(1994, 7, 6))
+            movie.insert()
+            Movie(title='movie2', release_date=date(2005, 7, 6)).insert()
+            movie.release_date = date(2005, 1, 1)
+            movie.update()
+
+        res = self.client.get('/stats')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['stats']['actors'], {
+            'total': 2,
+            'by_gender': {'Female': 1, 'Male': 1},
+            'by_age': {'30-39': 1, '40-49': 1}
+        })
+        self.assertEqual(data['stats']['movies'], {'total': 2, 'by_release_year': {'2005': 2}})
+        with self.app.app_context():
+            self.assertEqual(data['stats'], format_stats(compute_stats()))
+            rebuild_stats()
+            self.assertEqual(get_stats(), data['stats'])
+
+    def test_stats_seeded_when_created(self):
+        """Test a stats table created next to existing rows starts from their counts"""
+        with self.app.app_context():
+            Actor(name='Actor A', age=34, gender='Female').insert()
+            Movie(title='movie1', release_date=date(1994, 7, 6)).insert()
+            expected = get_stats()
+            Stat.__table__.drop(db.engine)
+            db.create_all()
+
+            self.assertEqual(expected['actors']['total'], 1)
+            self.assertEqual(get_stats(), expected)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_create_actor_query_count(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test POST /actors writes the row with a single INSERT ... RETURNING, then its change and stats"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["post:actors"]}
+
+        with self.count_statements() as statements:
+            res = self.client.post('/actors', json={'name': 'New Actor', 'age': 30, 'gender': 'Male'})
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'New Actor')
+        self.assertEqual(len(statements), 2 + self.change_log_statements())
+        self.assertIn('RETURNING', statements[0])
+        self.assertIn('INTO changes', statements[-2])
+        self.assertIn('INTO stats', statements[-1])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_create_movie_query_count(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test POST /movies writes the row with a single INSERT ... RETURNING, then its change and stats"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["post:movies"]}
+
+        with self.count_statements() as statements:
+            res = self.client.post('/movies', json={'title': 'New Movie', 'release_date': '2023-10-01'})
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(statements), 2 + self.change_log_statements())
+        self.assertIn('RETURNING', statements[0])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_update_actor_query_count(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test PATCH /actors/<id> runs one UPDATE ... RETURNING and its change (plus a locking read when stats columns change)"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["patch:actors"]}
+
+        with self.app.app_context():
+            actor = Actor(name='actor1', age=64, gender='Male')
+            actor.insert()
+            actor_id = actor.id
+
+        with self.count_statements() as statements:
+            res = self.client.patch(f'/actors/{actor_id}', json={'name': 'Updated Name'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'Updated Name')
+        self.assertEqual(len(statements), 1 + self.change_log_statements())
+
+        with self.count_statements() as statements:
+            res = self.client.patch(f'/actors/{actor_id}', json={'age': 65})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actor']['age'], 65)
+        # still in the 60-69 bucket: no stats upsert
+        self.assertEqual(len(statements), 2 + self.change_log_statements())
+
+        with self.count_statements() as statements:
+            res = self.client.patch('/actors/999', json={'name': 'Updated Name'})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(len(statements), 1)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_update_movie_query_count(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test PATCH /movies/<id> runs a single UPDATE ... RETURNING and its change"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["patch:movies"]}
+
+        with self.app.app_context():
+            movie = Movie(title='movie1', release_date=date(1994, 7, 6))
+            movie.insert()
+            movie_id = movie.id
+
+        with self.count_statements() as statements:
+            res = self.client.patch(f'/movies/{movie_id}', json={'title': 'Updated Movie Title'})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movie']['title'], 'Updated Movie Title')
+        self.assertEqual(len(statements), 1 + self.change_log_statements())
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_delete_actor_query_count(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test DELETE /actors/<id> runs a single DELETE ... RETURNING, then its change and stats"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["delete:actors"]}
+
+        with self.app.app_context():
+            actor = Actor(name='actor1', age=64, gender='Male')
+            actor.insert()
+            actor_id = actor.id
+
+        with self.count_statements() as statements:
+            res = self.client.delete(f'/actors/{actor_id}')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), 2 + self.change_log_statements())
+        self.assertIn('RETURNING', statements[0])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_delete_movie_query_count(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test DELETE /movies/<id> runs a single DELETE ... RETURNING, then its change and stats"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["delete:movies"]}
+
+        with self.app.app_context():
+            movie = Movie(title='movie1', release_date=date(1994, 7, 6))
+            movie.insert()
+            movie_id = movie.id
+
+        with self.count_statements() as statements:
+            res1 = self.client.delete(f'/movies/{movie_id}')
+            res2 = self.client.delete(f'/movies/{movie_id}')
+
+        self.assertEqual(res1.status_code, 200)
+        self.assertEqual(res2.status_code, 404)
+        # the 404 runs the DELETE alone
+        self.assertEqual(len(statements), 3 + self.change_log_statements())
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_actors_by_ids_success(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /actors?ids= keeps the requested order and reports missing ids"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actor"]}
+
+        with self.app.app_context():
+            for name in ('actor1', 'actor2', 'actor3'):
+                Actor(name=name, age=40, gender='Male').insert()
+
+        with self.count_statements() as statements:
+            res = self.client.get('/actors?ids=3,999,1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['actor3', 'actor1'])
+        self.assertEqual(data['missing'], [999])
+        self.assertEqual(len(statements), 1)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_movies_by_ids_success(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /movies?ids= returns the requested movies"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:movie"]}
+
+        with self.app.app_context():
+            Movie(title='movie1', release_date=date(1994, 7, 6)).insert()
+            Movie(title='movie2', release_date=date(2005, 7, 6)).insert()
+
+        res = self.client.get('/movies?ids=2,1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']], ['movie2', 'movie1'])
+        self.assertEqual(data['missing'], [])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_by_ids_error(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /movies?ids= with malformed ids, too many ids or without get:movie"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:movie"]}
+
+        res1 = self.client.get('/movies?ids=1,abc')
+        res2 = self.client.get('/movies?ids=' + ','.join(str(id) for id in range(1000)))
+
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:movies"]}
+        res3 = self.client.get('/movies?ids=1')
+
+        self.assertEqual(res1.status_code, 400)
+        self.assertEqual(res2.status_code, 400)
+        self.assertEqual(res3.status_code, 403)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_batch_success(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test POST /batch runs every sub-request with a single JWT verification"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors", "get:actor", "post:actors"]}
+
+        res = self.client.post('/batch', json=[
+            {'method': 'POST', 'path': '/actors', 'body': {'name': 'New Actor', 'age': 30, 'gender': 'Male'}},
+            {'method': 'GET', 'path': '/actors'},
+            {'method': 'GET', 'path': '/actors/999'},
+            {'method': 'DELETE', 'path': '/actors/1'},
+            {'method': 'GET', 'path': '/actors?ids=1'}
+        ])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([item['status'] for item in data['responses']], [201, 200, 404, 403, 200])
+        self.assertEqual(data['responses'][1]['body']['actors'][0]['name'], 'New Actor')
+        self.assertEqual(data['responses'][3]['body']['message'], 'Permission not found in JWT.')
+        self.assertEqual(mock_verify_decode_jwt.call_count, 1)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_batch_error(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test POST /batch rejects malformed and oversized batches"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors"]}
+
+        res1 = self.client.post('/batch', json={'method': 'GET', 'path': '/actors'})
+        res2 = self.client.post('/batch', json=[{'method': 'GET', 'path': '/actors'}] * 1000)
+        res3 = self.client.post('/batch', json=[{'method': 'POST', 'path': '/batch', 'body': []}])
+
+        self.assertEqual(res1.status_code, 400)
+        self.assertEqual(res2.status_code, 400)
+        self.assertEqual(json.loads(res3.data)['responses'][0]['status'], 400)
+
+    def test_batch_without_token(self):
+        """Test POST /batch without an Authorization header"""
+
+        res = self.client.post('/batch', json=[{'method': 'GET', 'path': '/actors'}])
+
+        self.assertEqual(res.status_code, 401)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_create_actor_invalid_values(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test POST /actors rejects invalid values with 422 before touching the database"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["post:actors"]}
+
+        with self.count_statements() as statements:
+            res = self.client.post('/actors', json={'name': 'New Actor', 'age': 'thirty', 'gender': 'x' * 11})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Unprocessable entity.')
+        self.assertEqual(set(data['errors']), {'age', 'gender'})
+        self.assertEqual(statements, [])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_update_movie_invalid_values(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test PATCH /movies/<id> rejects a malformed release_date or an empty title"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["patch:movies"]}
+
+        res1 = self.client.patch('/movies/1', json={'release_date': '06/07/1994'})
+        res2 = self.client.patch('/movies/1', json={'title': None})
+
+        self.assertEqual(res1.status_code, 422)
+        self.assertIn('release_date', json.loads(res1.data)['errors'])
+        self.assertEqual(res2.status_code, 422)
+        self.assertIn('title', json.loads(res2.data)['errors'])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_update_actor_body_not_json(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test PATCH /actors/<id> rejects a malformed or form-encoded body, and accepts an empty one"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["patch:actors"]}
+
+        with self.app.app_context():
+            actor = Actor(name='actor1', age=40, gender='Male')
+            actor.insert()
+            actor_id = actor.id
+
+        res1 = self.client.patch(f'/actors/{actor_id}', data='{"name": ', content_type='application/json')
+        res2 = self.client.patch(f'/actors/{actor_id}', data={'name': 'Updated Name'})
+        res3 = self.client.patch(f'/actors/{actor_id}')
+
+        self.assertEqual(res1.status_code, 400)
+        self.assertEqual(res2.status_code, 400)
+        self.assertEqual(res3.status_code, 200)
+        self.assertEqual(json.loads(res3.data)['actor']['name'], 'actor1')
+
+    def test_validators(self):
+        """Test the compiled actor and movie validators"""
+
+        self.assertEqual(
+            validate_movie({'title': 'movie1', 'release_date': '1994-07-06', 'extra': 1}),
+            {'title': 'movie1', 'release_date': date(1994, 7, 6)}
+        )
+        self.assertEqual(validate_actor({'age': 40}, partial=True), {'age': 40})
+        with self.assertRaises(ValidationError) as missing:
+            validate_actor({'name': 'actor1', 'age': 40})
+        self.assertEqual(missing.exception.status_code, 400)
+        with self.assertRaises(ValidationError) as invalid:
+            validate_actor({'name': 'actor1', 'age': True, 'gender': 'Male'})
+        self.assertEqual(invalid.exception.status_code, 422)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_filtered_listings(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /actors and GET /movies filters"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors", "get:movies"]}
+
+        with self.app.app_context():
+            Actor(name='actor1', age=64, gender='Male').insert()
+            Actor(name='actor2', age=34, gender='Female').insert()
+            Actor(name='actor3', age=44, gender='Female').insert()
+            Movie(title='movie1', release_date=date(1994, 7, 6)).insert()
+            Movie(title='movie2', release_date=date(2005, 7, 6)).insert()
+
+        res1 = self.client.get('/actors?gender=Female&min_age=40')
+        res2 = self.client.get('/movies?released_from=2000-01-01')
+        res3 = self.client.get('/actors?max_age=old')
+
+        self.assertEqual([actor['name'] for actor in json.loads(res1.data)['actors']], ['actor3'])
+        self.assertEqual([movie['title'] for movie in json.loads(res2.data)['movies']], ['movie2'])
+        self.assertEqual(res3.status_code, 400)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_get_actors_total_count(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /actors pages and X-Total-Count in every count mode"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors"]}
+
+        with self.app.app_context():
+            Actor(name='actor1', age=64, gender='Male').insert()
+            Actor(name='actor2', age=34, gender='Female').insert()
+            Actor(name='actor3', age=44, gender='Female').insert()
+
+        def total(path):
+            res = self.client.get(path)
+            return res.headers.get('X-Total-Count'), res.headers.get('X-Total-Count-Source')
+
+        res = self.client.get('/actors?limit=1&offset=1&count=exact', headers={'Origin': 'https://ui.example.com'})
+        self.assertEqual([actor['name'] for actor in json.loads(res.data)['actors']], ['actor2'])
+        self.assertEqual(res.headers['X-Total-Count'], '3')
+        # readable by pagination UIs on another origin
+        self.assertEqual(set(res.headers['Access-Control-Expose-Headers'].split(', ')),
+                         {'X-Total-Count', 'X-Total-Count-Source'})
+
+        self.assertEqual(total('/actors'), (None, None))
+        self.assertEqual(total('/actors?count=exact'), ('3', 'exact'))
+        self.assertEqual(total('/actors?count=estimated'), ('3', 'counter'))
+        self.assertEqual(total('/actors?count=estimated&gender=Female'), ('2', 'exact'))
+        self.assertEqual(total('/actors?count=auto'), ('3', 'exact'))
+        with patch('counts.total_count_threshold', 2):
+            self.assertEqual(total('/actors?count=auto&offset=0'), ('3', 'counter'))
+        self.assertEqual(self.client.get('/actors?count=all').status_code, 400)
+        self.assertEqual(self.client.get('/actors?limit=-1').status_code, 400)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_export_actors_and_movies(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /actors/export and /movies/export as typed Arrow and Parquet"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors", "get:movies"]}
+
+        with self.app.app_context():
+            Actor(name='actor1', age=64, gender='Male').insert()
+            Actor(name='actor2', age=34, gender='Female').insert()
+            Actor(name='actor3', age=44, gender='Female').insert()
+            Movie(title='movie1', release_date=date(2001, 2, 3)).insert()
+
+        with patch('arrow_export.export_batch_size', 1):
+            res = self.client.get('/actors/export?gender=Female&columns=name,age')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/vnd.apache.arrow.stream')
+        table = pyarrow.ipc.open_stream(res.data).read_all()
+        self.assertEqual(table.schema.names, ['name', 'age'])
+        self.assertEqual(table.schema.field('age').type, pyarrow.int16())
+        self.assertEqual(table.to_pydict(), {'name': ['actor2', 'actor3'], 'age': [34, 44]})
+
+        res = self.client.get('/movies/export?format=parquet')
+        self.assertEqual(res.status_code, 200)
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(res.data))
+        self.assertEqual(table.schema.field('release_date').type, pyarrow.date32())
+        self.assertEqual(table.column('release_date').to_pylist(), [date(2001, 2, 3)])
+
+        res = self.client.get('/movies/export?released_from=2030-01-01')
+        self.assertEqual(pyarrow.ipc.open_stream(res.data).read_all().num_rows, 0)
+        self.assertEqual(self.client.get('/actors/export?columns=title').status_code, 400)
+        self.assertEqual(self.client.get('/actors/export?format=csv').status_code, 400)
+
+    def test_movie_partition_bounds(self):
+        """Test the partition of a release date by year and by decade"""
+
+        self.assertEqual(movie_partition_bounds(date(2014, 11, 7), 'year'),
+                         ('movies_2014', date(2014, 1, 1), date(2015, 1, 1)))
+        self.assertEqual(movie_partition_bounds(date(2014, 11, 7), 'decade'),
+                         ('movies_2010s', date(2010, 1, 1), date(2020, 1, 1)))
+        # the last partitions are unbounded above (MAXVALUE): year 10000 is no date
+        self.assertEqual(movie_partition_bounds(date(9999, 6, 1), 'year'), ('movies_9999', date(9999, 1, 1), None))
+        self.assertEqual(movie_partition_bounds(date(9999, 6, 1), 'decade'), ('movies_9990s', date(9990, 1, 1), None))
+
+    def test_database_driver_options(self):
+        """Test PostgreSQL uris follow DB_DRIVER and psycopg 3 engines prepare statements"""
+
+        self.assertEqual(get_database_uri('postgres://u:p@db/agency', 'psycopg'), 'postgresql+psycopg://u:p@db/agency')
+        self.assertEqual(get_database_uri('postgresql+psycopg://u:p@db/agency', 'psycopg2'), 'postgresql+psycopg2://u:p@db/agency')
+        self.assertEqual(get_database_uri('sqlite:////tmp/agency.db', 'psycopg'), 'sqlite:////tmp/agency.db')
+
+        options = get_engine_options('postgresql+psycopg://u:p@db/agency')
+        self.assertEqual(options['connect_args']['prepare_threshold'], 2)
+        self.assertNotIn('prepare_threshold', get_engine_options('postgresql+psycopg2://u:p@db/agency')['connect_args'])
+        engine = create_engine('postgresql+psycopg://u:p@db/agency', **options)
+        self.assertEqual(engine.dialect.driver, 'psycopg')
+
+        with self.app.app_context():
+            with db.engine.begin() as connection, pipeline(connection):
+                connection.execute(Stat.__table__.insert().values(metric='pipeline', bucket='x', count=1))
+            self.assertEqual(db.session.get(Stat, ('pipeline', 'x')).count, 1)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_movie_partitions_created_on_commit(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test a committed movie of a year without a partition splits one off (SQLite stays a single table)"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["post:movies", "patch:movies"]}
+
+        with patch('models.movie_partitioning', 'year'), patch('models.split_movie_partitions') as split:
+            res = self.client.post('/movies', json={'title': 'movie1', 'release_date': '2001-02-03'})
+            self.assertEqual(res.status_code, 201)
+            split.assert_not_called()
+
+            with patch('models.uses_movie_partitions', return_value=True), \
+                    patch('models.get_movie_partitions', return_value={'movies_2001'}):
+                self.client.post('/movies', json={'title': 'movie2', 'release_date': '2001-05-06'})
+                split.assert_not_called()
+                movie_id = json.loads(res.data)['movie']['id']
+                self.client.patch(f'/movies/{movie_id}', json={'release_date': '2030-01-02'})
+                split.assert_called_once()
+                self.assertEqual(split.call_args.args[1], {date(2030, 1, 2)})
+
+class AsyncAppTestCase(unittest.TestCase):
+    """This class represents the gevent served app (create_async_app) test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.database_uri = os.getenv('TEST_DATABASE_URI')
+
+        self.app = create_async_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_uri,
+            "AUDIT_LOG": "off"
+        })
+
+        self.client = self.app.test_client()
+        self.db = db
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with self.app.app_context():
+            self.db.drop_all()
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_gevent_app_get_actors_success(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /actors for success"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors", "post:actors"]}
+
+        res1 = self.client.post('/actors', json={'name': 'New Actor', 'age': 30, 'gender': 'Male'})
+        res2 = self.client.get('/actors')
+        data = json.loads(res2.data)
+
+        self.assertEqual(res1.status_code, 201)
+        self.assertEqual(res2.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['actors'][0]['name'], 'New Actor')
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_gevent_app_get_actor_error(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test GET /actors/<id> for error (actor not found)"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actor"]}
+
+        res = self.client.get('/actors/999')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Resource not found.')
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_gevent_app_permission_error(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test DELETE /movies/<id> without the permission"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:movies"]}
+
+        res = self.client.delete('/movies/1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['message'], 'Permission not found in JWT.')
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_gevent_app_matches_create_app(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test the app has the routes of create_app, and answers like it"""
+
+        def rules(app):
+            return sorted((rule.rule, rule.endpoint, tuple(sorted(rule.methods))) for rule in app.url_map.iter_rules())
+
+        sync_app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_uri, "AUDIT_LOG": "off"})
+        self.assertEqual(rules(self.app), rules(sync_app))
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "client", "permissions": ["get:actors", "get:actor", "post:actors"]}
+        headers = {'Idempotency-Key': 'key-1'}
+        res1 = self.client.post('/actors', json={'name': 'actor1', 'age': 30, 'gender': 'Male'}, headers=headers)
+        res2 = self.client.post('/actors', json={'name': 'actor1', 'age': 30, 'gender': 'Male'}, headers=headers)
+        self.assertEqual(res1.data, res2.data)
+        res3 = self.client.get('/actors?ids=1,2&count=exact')
+        res4 = sync_app.test_client().get('/actors?ids=1,2&count=exact')
+        self.assertEqual((res3.status_code, res3.data), (res4.status_code, res4.data))
+        self.assertEqual(res3.headers['Surrogate-Key'], 'actors-list')
+
+    def test_psycopg2_made_green(self):
+        """Test psycopg2 is patched to wait through gevent once gevent has patched the process"""
+
+        with patch('async_app.gevent_patched', return_value=True), \
+                patch('psycogreen.gevent.patch_psycopg') as mock_patch_psycopg:
+            patch_database_driver()
+        mock_patch_psycopg.assert_called_once()
+
+class SingleFlightTestCase(unittest.TestCase):
+    """This class represents the request coalescing test case"""
+
+    def test_concurrent_identical_calls_run_once(self):
+        """Test that callers arriving while a call is in flight share its result"""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'body'
+
+        def caller():
+            results.append(flight.do('movies', slow))
+
+        leader = threading.Thread(target=caller)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=caller) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['body'] * 5)
+
+    def test_calls_after_completion_run_again(self):
+        """Test that results are not kept once the call finishes"""
+        flight = SingleFlight()
+        calls = []
+
+        flight.do('movies', lambda: calls.append(1))
+        flight.do('movies', lambda: calls.append(1))
+
+        self.assertEqual(len(calls), 2)
+
+    def test_leader_error_is_raised(self):
+        """Test that an error in the in-flight call is raised to the caller"""
+        flight = SingleFlight()
+
+        def failing():
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            flight.do('movies', failing)
+
+class TrustedIssuerTestCase(unittest.TestCase):
+    """This class represents the offline JWT verification test case"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Create a signing key and a trusted issuers config pinning it"""
+        public_key, cls.private_key = rsa.newkeys(1024)
+        cls.config_dir = tempfile.mkdtemp()
+
+        def b64(number):
+            return base64.urlsafe_b64encode(number.to_bytes((number.bit_length() + 7) // 8, 'big')).rstrip(b'=').decode()
+
+        with open(os.path.join(cls.config_dir, 'internal.jwks.json'), 'w') as jwks_file:
+            json.dump({'keys': [{'kty': 'RSA', 'kid': 'internal-1', 'n': b64(public_key.n), 'e': b64(public_key.e)}]}, jwks_file)
+        with open(os.path.join(cls.config_dir, 'reports.pem'), 'wb') as pem_file:
+            pem_file.write(public_key.save_pkcs1())
+        with open(os.path.join(cls.config_dir, 'issuers.json'), 'w') as config_file:
+            json.dump({'issuers': [
+                {'issuer': 'https://batch.internal/', 'audiences': ['casting-internal', 'casting-bulk'], 'jwks_file': 'internal.jwks.json'},
+                {'issuer': 'https://reports.internal/', 'audiences': ['casting-internal'], 'public_key_file': 'reports.pem'}
+            ]}, config_file)
+
+        cls.trusted_issuers = auth.load_trusted_issuers(os.path.join(cls.config_dir, 'issuers.json'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.config_dir)
+
+    def make_token(self, issuer, audience, kid='internal-1', expires_in=60):
+        """Sign a token with the pinned key"""
+        claims = {
+            'iss': issuer,
+            'aud': audience,
+            'sub': 'batch-service',
+            'exp': int(time.time()) + expires_in,
+            'permissions': ['get:actors']
+        }
+        return jwt.encode(claims, self.private_key.save_pkcs1().decode(), algorithm='RS256', headers={'kid': kid})
+
+    @patch('auth.fetch_jwks')  # No network call must be made for trusted issuers
+    def test_trusted_issuers_are_verified_offline(self, mock_fetch_jwks):
+        """Test tokens of several trusted issuers and audiences verify against the pinned keys"""
+        mock_fetch_jwks.side_effect = AssertionError('JWKS must not be fetched')
+
+        with patch('auth.trusted_issuers', self.trusted_issuers):
+            payload1 = auth.verify_decode_jwt(self.make_token('https://batch.internal/', 'casting-bulk'))
+            payload2 = auth.verify_decode_jwt(self.make_token('https://reports.internal/', ['other', 'casting-internal'], kid=None))
+
+        self.assertEqual(payload1['sub'], 'batch-service')
+        self.assertEqual(payload2['permissions'], ['get:actors'])
+
+    @patch('auth.fetch_jwks')
+    def test_trusted_issuer_errors(self, mock_fetch_jwks):
+        """Test wrong audience, expired tokens and unknown keys are rejected"""
+        mock_fetch_jwks.side_effect = AssertionError('JWKS must not be fetched')
+
+        with patch('auth.trusted_issuers', self.trusted_issuers):
+            with self.assertRaises(auth.AuthError) as wrong_audience:
+                auth.verify_decode_jwt(self.make_token('https://batch.internal/', 'someone-else'))
+            with self.assertRaises(auth.AuthError) as expired:
+                auth.verify_decode_jwt(self.make_token('https://batch.internal/', 'casting-bulk', expires_in=-60))
+            with self.assertRaises(auth.AuthError) as unknown_key:
+                auth.verify_decode_jwt(self.make_token('https://batch.internal/', 'casting-bulk', kid='rotated'))
+
+        self.assertEqual(wrong_audience.exception.error['code'], 'invalid_claims')
+        self.assertEqual(expired.exception.error['code'], 'token_expired')
+        self.assertEqual(unknown_key.exception.status_code, 400)
+
+    def test_local_mode_rejects_other_issuers(self):
+        """Test that in local mode tokens from other issuers are rejected without a JWKS fetch"""
+
+        with patch('auth.trusted_issuers', self.trusted_issuers), patch('auth.auth_mode', 'local'):
+            with self.assertRaises(auth.AuthError) as untrusted:
+                auth.verify_decode_jwt(self.make_token('https://myapp-secure.us.auth0.com/', 'casting-internal'))
+
+        self.assertEqual(untrusted.exception.status_code, 401)
+
+class CatalogTestCase(unittest.TestCase):
+    """This class represents the in-memory catalog snapshot test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app with the catalog snapshot enabled."""
+        self.database_uri = os.getenv('TEST_DATABASE_URI')
+
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_uri,
+            "AUDIT_LOG": "off",
+            "CATALOG_SNAPSHOT": True
+        })
+
+        self.client = self.app.test_client()
+        self.db = db
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with self.app.app_context():
+            self.db.drop_all()
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_reads_are_served_from_the_snapshot(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test the GET endpoints read the snapshot and follow writes through the change log"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {
+            "permissions": ["get:actors", "get:actor", "get:movies", "get:movie", "patch:actors", "delete:movies"]
+        }
+
+        with self.app.app_context():
+            Actor(name='actor1', age=64, gender='Male').insert()
+            Actor(name='actor2', age=34, gender='Female').insert()
+            Movie(title='movie1', release_date=date(1994, 7, 6)).insert()
+            Movie(title='movie2', release_date=date(2005, 7, 6)).insert()
+            self.app.extensions['catalog'].refresh()
+            engine = self.db.engine
+
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if re.search(r'\b(actors|movies)\b', statement):
+                statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res1 = self.client.get('/actors?gender=Female')
+            res2 = self.client.get('/movies/2')
+            res3 = self.client.get('/actors?ids=2,1,9')
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(statements, [])
+        self.assertEqual([actor['name'] for actor in json.loads(res1.data)['actors']], ['actor2'])
+        self.assertEqual(json.loads(res2.data)['movie']['title'], 'movie2')
+        self.assertEqual(json.loads(res3.data)['missing'], [9])
+
+        self.client.patch('/actors/2', json={'gender': 'Male', 'age': 35})
+        self.client.delete('/movies/1')
+
+        res4 = self.client.get('/actors/2')
+        res5 = self.client.get('/movies')
+
+        self.assertEqual(json.loads(res4.data)['actor'], {'id': 2, 'name': 'actor2', 'age': 35, 'gender': 'Male'})
+        self.assertEqual([movie['title'] for movie in json.loads(res5.data)['movies']], ['movie2'])
+
+    def test_columnar_table(self):
+        """Test out-of-order inserts and tombstone compaction keep id order"""
+        table = ColumnarTable(ACTOR_COLUMNS)
+        for id in (1, 3, 2, 4, 5):
+            table.upsert({'id': id, 'name': f'actor{id}', 'age': 30 + id, 'gender': 'Female' if id % 2 else 'Male'})
+        table.delete(3)
+        table.delete(4)
+        table.ensure_sorted()
+
+        self.assertEqual([row['id'] for row in table.rows()], [1, 2, 5])
+        self.assertEqual(table.get(5), {'id': 5, 'name': 'actor5', 'age': 35, 'gender': 'Female'})
+        self.assertIsNone(table.get(3))
+        self.assertEqual(table.columns['gender'].categories, ['Female', 'Male'])
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    """This class represents the circuit breaker and health check test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app({"SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'), "AUDIT_LOG": "off"})
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            self.engine = db.engine
+
+    def tearDown(self):
+        """Executed after reach test"""
+        auth0_breaker.reset()
+        database_breaker.reset()
+        with self.app.app_context():
+            db.drop_all()
+
+    @contextmanager
+    def database_down(self):
+        """Make every statement fail as if the database were unreachable"""
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            raise exc.OperationalError(statement, parameters, Exception('connection refused'))
+        event.listen(self.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', before_cursor_execute)
+
+    def test_breaker_states(self):
+        """Test the breaker opens, fails fast, lets one probe through and recovers"""
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_seconds=0.05)
+
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(DependencyError):
+            breaker.call(lambda: 'not called')
+
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+
+        time.sleep(0.06)
+        self.assertEqual(breaker.call(lambda: 'probe'), 'probe')
+        self.assertEqual(breaker.status(), {'state': 'closed', 'failures': 0})
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.requests.get')  # Auth0 is unreachable
+    def test_jwks_circuit_fails_fast(self, mock_requests_get, mock_get_token_auth_header):
+        """Test an unreachable Auth0 answers 503 and stops being called once the circuit opens"""
+        mock_get_token_auth_header.return_value = jwt.encode({'iss': 'https://example.auth0.com/'}, 'secret', algorithm='HS256')
+        mock_requests_get.side_effect = requests.ConnectionError('connection refused')
+
+        responses = [self.client.get('/actors') for _ in range(auth0_breaker.failure_threshold + 2)]
+
+        self.assertEqual({res.status_code for res in responses}, {503})
+        self.assertEqual(mock_requests_get.call_count, auth0_breaker.failure_threshold)
+        self.assertGreater(int(responses[-1].headers['Retry-After']), 1)
+        self.assertEqual(mock_requests_get.call_args.kwargs['timeout'], (auth.jwks_connect_timeout, auth.jwks_read_timeout))
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_database_circuit_fails_fast(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test an unreachable database answers 503, fails fast and is probed back by /readyz"""
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors"]}
+
+        with self.database_down():
+            responses = [self.client.get('/actors') for _ in range(database_breaker.failure_threshold)]
+            self.assertEqual(database_breaker.state, 'open')
+
+            statements = []
+            def count(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+            event.listen(self.engine, 'before_cursor_execute', count, insert=True)
+            res1 = self.client.get('/actors')
+            res2 = self.client.get('/healthz')
+            res3 = self.client.get('/readyz')
+            event.remove(self.engine, 'before_cursor_execute', count)
+
+        self.assertEqual({res.status_code for res in responses}, {503})
+        self.assertEqual(res1.status_code, 503)
+        self.assertIn('Retry-After', res1.headers)
+        self.assertEqual(statements, [])
+        self.assertEqual(res2.status_code, 200)
+        self.assertEqual(res3.status_code, 503)
+        self.assertEqual(json.loads(res3.data)['checks']['database']['state'], 'open')
+
+        database_breaker.opened_at -= database_breaker.reset_seconds
+        res4 = self.client.get('/readyz')
+        res5 = self.client.get('/actors')
+
+        self.assertEqual(res4.status_code, 200)
+        self.assertEqual(json.loads(res4.data)['checks']['database'], {'state': 'closed', 'failures': 0})
+        self.assertEqual(res5.status_code, 200)
+
+class QueryBudgetTestCase(unittest.TestCase):
+    """This class represents the per-request SQL statement budget test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app in raise mode."""
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'),
+            "AUDIT_LOG": "off",
+            "QUERY_BUDGET_MODE": "raise"
+        })
+        self.client = self.app.test_client()
+
+        with self.app.app_context():
+            for number in range(1, 4):
+                Actor(name=f'actor{number}', age=30 + number, gender='Female').insert()
+                Movie(title=f'movie{number}', release_date=date(2000 + number, 1, 1)).insert()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with self.app.app_context():
+            db.drop_all()
+
+    def request_report(self, method, path, **kwargs):
+        """Send a request and return its response and query report"""
+        with self.client:
+            res = self.client.open(path, method=method, **kwargs)
+            return res, request.query_report
+
+    def test_statement_shapes(self):
+        """Test statements differing only by parameters or list length share a shape"""
+        self.assertEqual(
+            statement_shape('SELECT * FROM actors WHERE id IN (%(id_1_1)s, %(id_1_2)s)'),
+            statement_shape('SELECT *\nFROM actors WHERE id IN (?, ?, ?)')
+        )
+        self.assertNotEqual(statement_shape('SELECT * FROM actors'), statement_shape('SELECT * FROM movies'))
+
+        report = build_report(['SELECT * FROM movies WHERE id = ?'] * 3 + ['SELECT 1'], budget=2)
+        self.assertEqual(report['count'], 4)
+        self.assertTrue(report['over_budget'])
+        self.assertEqual(list(report['repeated'].values()), [3])
+
+    def test_every_route_has_a_budget(self):
+        """Test every route declares a query budget"""
+        for rule in self.app.url_map.iter_rules():
+            if rule.endpoint != 'static':
+                self.assertIsInstance(getattr(self.app.view_functions[rule.endpoint], 'query_budget', None), int, rule.rule)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_routes_stay_within_budget(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test every route runs within its budget and without repeated statements"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": [
+            "get:actors", "get:actor", "get:movies", "get:movie", "post:actors", "post:movies",
+            "patch:actors", "patch:movies", "delete:actors", "delete:movies", "get:changes", "get:stats",
+            "get:jobs", "get:audit"
+        ], "sub": "budget"}
+
+        idempotent = {'json': {'name': 'New Actor', 'age': 30, 'gender': 'Male'}, 'headers': {'Idempotency-Key': 'key-1'}}
+        requests_sent = [
+            ('GET', '/', {}),
+            ('GET', '/healthz', {}),
+            ('GET', '/readyz', {}),
+            ('GET', '/actors', {}),
+            ('GET', '/actors?ids=1,2,3', {}),
+            ('GET', '/actors?gender=Female&min_age=32', {}),
+            ('GET', '/actors/1', {}),
+            ('GET', '/movies', {}),
+            ('GET', '/movies?ids=1,2,3', {}),
+            ('GET', '/movies/1', {}),
+            ('POST', '/actors', {'json': {'name': 'New Actor', 'age': 30, 'gender': 'Male'}}),
+            ('POST', '/actors', idempotent),
+            ('POST', '/actors', idempotent),
+            ('POST', '/movies', {'json': {'title': 'New Movie', 'release_date': '2023-10-01'}}),
+            ('PATCH', '/actors/1', {'json': {'name': 'Updated Name'}}),
+            ('PATCH', '/actors/1', {'json': {'age': 65, 'gender': 'Male'}}),
+            ('PATCH', '/movies/1', {'json': {'release_date': '1999-01-01'}}),
+            ('DELETE', '/actors/2', {}),
+            ('DELETE', '/movies/2', {}),
+            ('DELETE', '/movies/999', {}),
+            ('GET', '/changes', {}),
+            ('GET', '/stats', {}),
+            ('POST', '/batch', {'json': [{'method': 'GET', 'path': '/actors/1'}, {'method': 'GET', 'path': '/movies/1'}]}),
+            ('GET', '/actors/export', {}),
+            ('GET', '/movies/export?format=parquet', {}),
+            ('GET', '/audit', {}),
+            ('POST', '/jobs', {'json': {'kind': 'export', 'entity': 'actors'}}),
+            ('GET', '/jobs/1', {}),
+            ('GET', '/jobs/1/result', {}),
+        ]
+
+        def assert_within_budget(method, path, **kwargs):
+            res, report = self.request_report(method, path, **kwargs)
+            res.close()
+            self.assertLess(res.status_code, 500, f'{method} {path}')
+            self.assertLessEqual(report['count'], report['budget'], f'{method} {path}')
+            self.assertEqual(report['repeated'], {}, f'{method} {path}')
+            return res
+
+        results_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, results_dir)
+        with patch('jobs.job_results_dir', results_dir):
+            for method, path, kwargs in requests_sent:
+                assert_within_budget(method, path, **kwargs)
+
+            with self.app.app_context():
+                run_pending_jobs('worker-1')
+            self.assertEqual(assert_within_budget('GET', '/jobs/1/result').status_code, 200)
+
+    def test_routes_stay_within_budget_with_seq_lock(self):
+        """Test the budgets leave room for the change seq lock PostgreSQL takes before logging a change"""
+
+        def lock_sequence(connection, key):
+            # stands for SELECT pg_advisory_xact_lock(key) on any database
+            connection.exec_driver_sql('SELECT 1')
+
+        with patch('models.lock_sequence', lock_sequence):
+            self.test_routes_stay_within_budget()
+
+    def test_regressions_are_reported(self):
+        """Test a route running N statements for N rows fails its budget in raise mode"""
+
+        @self.app.route('/movies/titles')
+        @query_budget(1)
+        def movie_titles():
+            ids = [movie.id for movie in Movie.query.all()]
+            return {'titles': [db.session.get(Movie, id).title for id in ids]}
+
+        with self.app.app_context():
+            db.session.expunge_all()
+        res, report = self.request_report('GET', '/movies/titles')
+
+        self.assertEqual(res.status_code, 500)
+        self.assertTrue(report['over_budget'])
+        self.assertEqual(list(report['repeated'].values()), [3])
+
+        # the 500 is a QueryBudgetExceeded carrying the report
+        self.app.config['PROPAGATE_EXCEPTIONS'] = True
+        with self.assertRaises(QueryBudgetExceeded) as exceeded:
+            self.client.get('/movies/titles')
+        self.assertEqual(exceeded.exception.report['route'], 'GET /movies/titles')
+        self.assertIn('(budget 1)', str(exceeded.exception))
+
+class FakeSharedStore(RateLimitStore):
+    """A stand-in for a shared counter backend, as several workers would see it"""
+
+    def __init__(self):
+        self.tokens = {}
+        self.in_flight = {}
+
+    def take(self, key, cost, rate, burst):
+        tokens = self.tokens.get(key, burst)
+        if tokens < cost:
+            return (cost - tokens) / rate
+        self.tokens[key] = tokens - cost
+        return 0
+
+    def acquire(self, key, limit):
+        if self.in_flight.get(key, 0) >= limit:
+            return False
+        self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        return True
+
+    def release(self, key):
+        self.in_flight[key] -= 1
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """This class represents the per-client rate limit test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.database_uri = os.getenv('TEST_DATABASE_URI')
+        self.app = create_app({"SQLALCHEMY_DATABASE_URI": self.database_uri, "AUDIT_LOG": "off"})
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with self.app.app_context():
+            db.drop_all()
+
+    def test_memory_store(self):
+        """Test the token bucket refills over time and the in-flight quota is released"""
+        store = MemoryStore()
+
+        self.assertEqual(store.take('client', 5, 10, 10), 0)
+        self.assertEqual(store.take('client', 5, 10, 10), 0)
+        self.assertGreater(store.take('client', 5, 10, 10), 0)
+        time.sleep(0.6)
+        self.assertEqual(store.take('client', 5, 10, 10), 0)
+
+        self.assertTrue(store.acquire('client', 1))
+        self.assertFalse(store.acquire('client', 1))
+        store.release('client')
+        self.assertTrue(store.acquire('client', 1))
+        self.assertEqual(store.in_flight, {'client': 1})
+
+    def test_store_interface(self):
+        """Test a store missing a method of the interface can't be created"""
+
+        class TakeOnlyStore(RateLimitStore):
+            def take(self, key, cost, rate, burst):
+                return 0
+
+        with self.assertRaises(TypeError):
+            TakeOnlyStore()
+
+    @patch('ratelimit.rate_limit_burst', 10)
+    @patch('ratelimit.rate_limit_per_second', 0.5)
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_rate_limit_per_subject(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test a client over its budget gets 429 with Retry-After while other clients don't"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "integration-1", "permissions": ["get:actors", "post:actors"]}
+
+        res1 = self.client.post('/actors', json={'name': 'New Actor', 'age': 30, 'gender': 'Male'})
+        reads = [self.client.get('/actors') for _ in range(5)]
+        res2 = self.client.get('/actors')
+        res3 = self.client.post('/actors', json={'name': 'New Actor', 'age': 30, 'gender': 'Male'})
+
+        mock_verify_decode_jwt.return_value = {"sub": "integration-2", "permissions": ["get:actors"]}
+        res4 = self.client.get('/actors')
+
+        self.assertEqual(res1.status_code, 201)
+        self.assertEqual({res.status_code for res in reads}, {200})
+        self.assertEqual(res2.status_code, 429)
+        self.assertEqual(json.loads(res2.data)['message'], 'Too many requests.')
+        self.assertEqual(res2.headers['Retry-After'], '2')
+        self.assertEqual(res3.headers['Retry-After'], '10')
+        self.assertEqual(res4.status_code, 200)
+
+    @patch('ratelimit.rate_limit_burst', 3)
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_shared_store(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test workers sharing a store share the client's budget and in-flight quota"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"azp": "client-1", "permissions": ["get:actors"]}
+
+        store = FakeSharedStore()
+        first = create_app({"SQLALCHEMY_DATABASE_URI": self.database_uri, "AUDIT_LOG": "off", "RATE_LIMIT_STORE": store}).test_client()
+        second = create_app({"SQLALCHEMY_DATABASE_URI": self.database_uri, "AUDIT_LOG": "off", "RATE_LIMIT_STORE": store}).test_client()
+
+        statuses = [client.get('/actors').status_code for client in (first, second, first, second)]
+        self.assertEqual(statuses, [200, 200, 200, 429])
+        self.assertEqual(store.in_flight, {'client-1': 0})
+
+        store.tokens.clear()
+        store.in_flight['client-1'] = 8
+        self.assertEqual(first.get('/actors').status_code, 429)
+
+class JobsTestCase(unittest.TestCase):
+    """This class represents the background job test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.app = create_app({"SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'), "AUDIT_LOG": "off"})
+        self.client = self.app.test_client()
+        self.results_dir = tempfile.mkdtemp()
+        self.patches = [patch('jobs.job_chunk_size', 2), patch('jobs.job_results_dir', self.results_dir)]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        for patcher in self.patches:
+            patcher.stop()
+        shutil.rmtree(self.results_dir)
+        with self.app.app_context():
+            db.drop_all()
+
+    def run_jobs(self, worker_id='worker-1'):
+        with self.app.app_context():
+            return run_pending_jobs(worker_id)
+
+    rows = [{'name': f'actor{number}', 'age': 30 + number, 'gender': 'Female'} for number in range(5)]
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_import_job(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test an import job is queued, run in chunks by a worker and polled to completion"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "importer", "permissions": ["post:actors", "get:jobs", "get:stats"]}
+
+        res1 = self.client.post('/jobs', json={'kind': 'import', 'entity': 'actors', 'rows': self.rows})
+        job = json.loads(res1.data)['job']
+        res2 = self.client.get(f'/jobs/{job["id"]}/result')
+
+        self.assertEqual(res1.status_code, 202)
+        self.assertEqual(res1.headers['Location'], f'/jobs/{job["id"]}')
+        self.assertEqual(job['status'], 'queued')
+        self.assertEqual(res2.status_code, 409)
+
+        self.assertEqual(self.run_jobs(), 1)
+
+        res3 = self.client.get(f'/jobs/{job["id"]}')
+        res4 = self.client.get(f'/jobs/{job["id"]}/result')
+        res5 = self.client.get('/stats')
+
+        self.assertEqual(json.loads(res3.data)['job']['status'], 'succeeded')
+        self.assertEqual(json.loads(res3.data)['job']['processed'], 5)
+        self.assertEqual(json.loads(res3.data)['job']['total'], 5)
+        self.assertEqual(json.loads(res4.data)['result'], {'created': 5})
+        self.assertEqual(json.loads(res5.data)['stats']['actors']['total'], 5)
+        with self.app.app_context():
+            self.assertEqual(Change.query.count(), 5)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_job_validation(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test jobs are validated up front and need the permission of the equivalent request"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["post:actors"]}
+
+        res1 = self.client.post('/jobs', json={'kind': 'import', 'entity': 'actors', 'rows': [self.rows[0], {'name': 'x', 'age': 'old', 'gender': 'Male'}]})
+        res2 = self.client.post('/jobs', json={'kind': 'delete', 'entity': 'actors'})
+        res3 = self.client.post('/jobs', json={'kind': 'reindex', 'entity': 'actors'})
+
+        self.assertEqual(res1.status_code, 422)
+        self.assertEqual(json.loads(res1.data)['errors'], {'rows.1.age': 'Must be an integer.'})
+        self.assertEqual(res2.status_code, 403)
+        self.assertEqual(res3.status_code, 400)
+
+    def test_job_resumes_after_a_crash(self):
+        """Test a job whose worker died is resumed from its last committed chunk"""
+
+        with self.app.app_context():
+            job = Job('import', {'entity': 'actors', 'rows': self.rows})
+            db.session.add(job)
+            db.session.commit()
+            job_id = job.id
+
+            run_import = jobs.JOB_KINDS['import']
+            calls = []
+            def crash_on_second_chunk(*args):
+                calls.append(args)
+                if len(calls) == 2:
+                    raise KeyboardInterrupt('worker killed')
+                return run_import(*args)
+
+            self.assertEqual(claim_job('worker-1'), job_id)
+            with patch.dict(jobs.JOB_KINDS, {'import': crash_on_second_chunk}):
+                with self.assertRaises(KeyboardInterrupt):
+                    run_job(job_id, 'worker-1')
+            db.session.rollback()
+
+            self.assertEqual(Actor.query.count(), 2)
+            self.assertIsNone(claim_job('worker-2'))
+            Job.query.filter_by(id=job_id).update({'locked_until': utcnow() - timedelta(seconds=1)})
+            db.session.commit()
+
+        self.assertEqual(self.run_jobs('worker-2'), 1)
+        with self.app.app_context():
+            job = db.session.get(Job, job_id)
+            self.assertEqual((job.status, job.processed, job.locked_by), ('succeeded', 5, 'worker-2'))
+            self.assertEqual(sorted(actor.name for actor in Actor.query), [row['name'] for row in self.rows])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_export_and_delete_jobs(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test export and bulk delete jobs work on the rows matching the filters"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors", "delete:actors", "get:jobs"]}
+
+        with self.app.app_context():
+            for row in self.rows:
+                Actor(**row).insert()
+            Actor(name='actor5', age=50, gender='Male').insert()
+
+        export = json.loads(self.client.post('/jobs', json={'kind': 'export', 'entity': 'actors', 'filters': {'gender': 'Female'}}).data)['job']
+        self.run_jobs()
+        res1 = self.client.get(f'/jobs/{export["id"]}/result')
+        lines = [json.loads(line) for line in res1.data.decode().splitlines()]
+
+        self.assertEqual(res1.mimetype, 'application/x-ndjson')
+        self.assertEqual([line['name'] for line in lines], [row['name'] for row in self.rows])
+        self.assertEqual(json.loads(self.client.get(f'/jobs/{export["id"]}').data)['job']['result'], {'exported': 5})
+
+        delete = json.loads(self.client.post('/jobs', json={'kind': 'delete', 'entity': 'actors', 'filters': {'gender': 'Female', 'min_age': 32}}).data)['job']
+        self.run_jobs()
+        res2 = self.client.get(f'/jobs/{delete["id"]}/result')
+
+        self.assertEqual(json.loads(res2.data)['result'], {'deleted': 3})
+        with self.app.app_context():
+            self.assertEqual(sorted(actor.name for actor in Actor.query), ['actor0', 'actor1', 'actor5'])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_jobs_read_by_owner_only(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test a job and its result are read by its owner only, while it still has the job's permission"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "exporter", "permissions": ["get:actors", "get:jobs"]}
+
+        with self.app.app_context():
+            Actor(**self.rows[0]).insert()
+        export = json.loads(self.client.post('/jobs', json={'kind': 'export', 'entity': 'actors'}).data)['job']
+        self.run_jobs()
+
+        mock_verify_decode_jwt.return_value = {"sub": "someone-else", "permissions": ["get:actors", "get:jobs"]}
+        res1 = self.client.get(f'/jobs/{export["id"]}')
+        res2 = self.client.get(f'/jobs/{export["id"]}/result')
+        mock_verify_decode_jwt.return_value = {"sub": "exporter", "permissions": ["get:jobs"]}
+        res3 = self.client.get(f'/jobs/{export["id"]}/result')
+        mock_verify_decode_jwt.return_value = {"sub": "exporter", "permissions": ["get:actors", "get:jobs"]}
+        res4 = self.client.get(f'/jobs/{export["id"]}/result')
+
+        self.assertEqual(res1.status_code, 404)
+        self.assertEqual(res2.status_code, 404)
+        self.assertEqual(res3.status_code, 403)
+        self.assertEqual(res4.status_code, 200)
+        res4.close()
+
+class AuditTestCase(unittest.TestCase):
+    """This class represents the write-behind audit log test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.spool_dir = tempfile.mkdtemp()
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'),
+            "AUDIT_SPOOL_FILE": os.path.join(self.spool_dir, 'audit.jsonl')
+        })
+        self.client = self.app.test_client()
+        self.audit = self.app.extensions['audit']
+        # flushed by the tests only
+        self.audit.flush_seconds = 60
+
+    def tearDown(self):
+        """Executed after reach test"""
+        shutil.rmtree(self.spool_dir)
+        with self.app.app_context():
+            db.drop_all()
+
+    def audit_events(self, query=''):
+        return json.loads(self.client.get(f'/audit{query}').data)['events']
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_audit_changes_by_subject(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test every committed change is audited with the token's sub once flushed"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {
+            "sub": "casting|alice",
+            "permissions": ["post:actors", "patch:actors", "delete:actors", "post:movies", "get:audit"]
+        }
+
+        actor = json.loads(self.client.post('/actors', json={'name': 'actor1', 'age': 30, 'gender': 'Male'}).data)['actor']
+        self.client.patch(f'/actors/{actor["id"]}', json={'age': 31})
+        self.client.delete(f'/actors/{actor["id"]}')
+        self.client.post('/movies', json={'title': 'movie1', 'release_date': '2001-02-03'})
+        self.client.post('/movies', json={'title': ''})
+        self.assertEqual(self.audit_events(), [])
+
+        self.assertEqual(self.audit.flush(), 4)
+        events = self.audit_events()
+        self.assertEqual([(event['entity'], event['op']) for event in events],
+                         [('actor', 'insert'), ('actor', 'update'), ('actor', 'delete'), ('movie', 'insert')])
+        self.assertEqual({event['subject'] for event in events}, {'casting|alice'})
+        self.assertEqual(len(self.audit_events(f'?entity=actor&entity_id={actor["id"]}')), 3)
+        self.assertEqual(self.audit_events('?subject=casting|bob'), [])
+        self.assertEqual(len(self.audit_events(f'?since={events[1]["id"]}&limit=1')), 1)
+        self.assertEqual(self.client.get('/audit?entity_id=x').status_code, 400)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_audit_job_changes_as_owner(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test the changes of a background job are audited as its owner's"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"sub": "importer", "permissions": ["post:actors", "get:audit"]}
+
+        rows = [{'name': f'actor{number}', 'age': 30, 'gender': 'Female'} for number in range(3)]
+        self.client.post('/jobs', json={'kind': 'import', 'entity': 'actors', 'rows': rows})
+        with self.app.app_context():
+            run_pending_jobs('worker-1')
+        self.audit.flush()
+
+        events = self.audit_events('?subject=importer')
+        self.assertEqual([event['op'] for event in events], ['insert'] * 3)
+
+    def test_audit_backpressure_spools(self):
+        """Test events that don't fit the full buffer are spooled and replayed by the next flush"""
+
+        self.audit.max_events = 1
+        self.audit.block_seconds = 0
+        event = {'subject': 'casting|alice', 'entity': 'actor', 'entity_id': 1, 'op': 'insert',
+                 'change_seq': None, 'created_at': utcnow()}
+
+        self.audit.record([event])
+        self.audit.record([dict(event, entity_id=2), dict(event, entity_id=3)])
+        self.assertEqual(len(self.audit.events), 1)
+        self.assertTrue(os.path.exists(self.audit.spool_path))
+
+        self.assertEqual(self.audit.flush(), 1)
+        self.assertFalse(os.path.exists(self.audit.spool_path))
+        with self.app.app_context():
+            self.assertEqual(sorted(row.entity_id for row in AuditEvent.query), [1, 2, 3])
+
+    def test_audit_flush_pipelines_writes_only(self):
+        """Test a flush of several batches writes them all, reading no results inside the pipeline"""
+
+        self.audit.batch_size = 2
+        audit_event = {'subject': 'casting|alice', 'entity': 'actor', 'op': 'insert', 'change_seq': None, 'created_at': utcnow()}
+        self.audit.record([dict(audit_event, entity_id=entity_id) for entity_id in range(5)])
+
+        statements = []
+        pipeline_context = audit.pipeline
+        @contextmanager
+        def recording_pipeline(connection):
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(connection, 'before_cursor_execute', record)
+            with pipeline_context(connection):
+                yield
+            event.remove(connection, 'before_cursor_execute', record)
+
+        with patch('audit.pipeline', recording_pipeline):
+            self.assertEqual(self.audit.flush(), 5)
+
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(all(statement.lstrip().upper().startswith('INSERT') and 'RETURNING' not in statement.upper()
+                            for statement in statements))
+        with self.app.app_context():
+            self.assertEqual(AuditEvent.query.count(), 5)
+
+    def test_audit_spool_recovery(self):
+        """Test a torn spool line is set aside, and the replay file of a dead process is taken over"""
+
+        event = {'subject': 'casting|alice', 'entity': 'actor', 'entity_id': 1, 'op': 'insert',
+                 'change_seq': None, 'created_at': utcnow().isoformat()}
+        with open(self.audit.spool_path, 'w') as spool_file:
+            spool_file.write(json.dumps(event) + '\n' + json.dumps(dict(event, entity_id=2))[:20])
+        # no process has this pid (above the kernel's pid_max)
+        with open(f'{self.audit.spool_path}.99999999.replay', 'w') as replay_file:
+            replay_file.write(json.dumps(dict(event, entity_id=3)) + '\n')
+
+        self.audit.flush()
+        self.audit.flush()
+        with self.app.app_context():
+            self.assertEqual(sorted(row.entity_id for row in AuditEvent.query), [1, 3])
+        with open(self.audit.spool_path + '.bad') as bad_file:
+            self.assertEqual(len(bad_file.readlines()), 1)
+        self.assertEqual(glob.glob(self.audit.spool_path + '*.replay'), [])
+
+    def test_audit_flusher_survives_errors(self):
+        """Test the flusher thread keeps running when a flush raises"""
+
+        self.audit.flush_seconds = 0.01
+        with patch.object(self.audit, 'take_spool', side_effect=OSError('disk error')):
+            self.audit.start()
+            time.sleep(0.1)
+            self.assertTrue(self.audit.thread.is_alive())
+        self.audit.flush_seconds = 60
+
+class TenantTestCase(unittest.TestCase):
+    """This class represents the multi-tenant routing test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.tenants_dir = tempfile.mkdtemp()
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'),
+            "AUDIT_SPOOL_FILE": os.path.join(self.tenants_dir, 'audit.jsonl'),
+            "TENANT_ROUTING": "database",
+            "TENANT_DATABASE_URI": 'sqlite:///' + os.path.join(self.tenants_dir, '{tenant}.db'),
+            "TENANTS": ['acme', 'globex']
+        })
+        self.client = self.app.test_client()
+        self.router = self.app.extensions['tenants']
+        self.audit = self.app.extensions['audit']
+        # flushed by the tests only
+        self.audit.flush_seconds = 60
+
+    def tearDown(self):
+        """Executed after reach test"""
+        # the events of tests that don't flush
+        self.audit.take()
+        tenant_breakers.clear()
+        for engine in self.router.engines.values():
+            engine.dispose()
+        shutil.rmtree(self.tenants_dir)
+        with self.app.app_context():
+            db.drop_all()
+
+    def payload(self, tenant, permissions=None):
+        payload = {"sub": f"{tenant}|admin", "permissions": permissions or ["get:actors", "post:actors"]}
+        if tenant is not None:
+            payload["agency"] = tenant
+        return payload
+
+    def actor_names(self):
+        return [actor['name'] for actor in json.loads(self.client.get('/actors').data)['actors']]
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_tenants_are_isolated(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test each agency reads and writes its own database only"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = self.payload('acme')
+        res = self.client.post('/actors', json={'name': 'acme actor', 'age': 30, 'gender': 'Male'})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(self.actor_names(), ['acme actor'])
+
+        mock_verify_decode_jwt.return_value = self.payload('globex')
+        self.assertEqual(self.actor_names(), [])
+        self.client.post('/actors', json={'name': 'globex actor', 'age': 40, 'gender': 'Female'})
+        self.assertEqual(self.actor_names(), ['globex actor'])
+
+        mock_verify_decode_jwt.return_value = self.payload('acme')
+        self.assertEqual(self.actor_names(), ['acme actor'])
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 0)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_tenant_database_circuits(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test an agency whose database is down fails fast without failing the other agencies"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = self.payload('acme')
+        self.assertEqual(self.client.get('/actors').status_code, 200)
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            raise exc.OperationalError(statement, parameters, Exception('connection refused'))
+        globex_engine = self.router.engine_for('globex')
+        event.listen(globex_engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            mock_verify_decode_jwt.return_value = self.payload('globex')
+            responses = [self.client.get('/actors') for _ in range(database_breaker.failure_threshold + 1)]
+            mock_verify_decode_jwt.return_value = self.payload('acme')
+            res1 = self.client.get('/actors')
+            res2 = self.client.get('/readyz')
+        finally:
+            event.remove(globex_engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual({res.status_code for res in responses}, {503})
+        self.assertEqual(res1.status_code, 200)
+        self.assertEqual(res2.status_code, 200)
+        self.assertEqual(database_breaker.status(), {'state': 'closed', 'failures': 0})
+        self.assertEqual(json.loads(res2.data)['checks']['tenants'],
+                         {'acme': {'state': 'closed', 'failures': 0},
+                          'globex': {'state': 'open', 'failures': database_breaker.failure_threshold}})
+
+        # /readyz probes the half-open circuit back
+        tenant_breakers['globex'].opened_at -= tenant_breakers['globex'].reset_seconds
+        res3 = self.client.get('/readyz')
+        mock_verify_decode_jwt.return_value = self.payload('globex')
+        res4 = self.client.get('/actors')
+
+        self.assertEqual(json.loads(res3.data)['checks']['tenants']['globex'], {'state': 'closed', 'failures': 0})
+        self.assertEqual(res4.status_code, 200)
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_tenant_claim_required(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test a token without a valid, accepted agency claim is forbidden"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        for tenant in [None, '../acme', 'Acme', 'initech']:
+            mock_verify_decode_jwt.return_value = self.payload(tenant)
+            res = self.client.get('/actors')
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(json.loads(res.data)['success'], False)
+        self.assertEqual(os.listdir(self.tenants_dir), [])
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_tenant_engines_evicted(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test the least recently used tenant engine is disposed, and reopened on demand"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        self.router.max_engines = 1
+        for tenant in ['acme', 'globex']:
+            mock_verify_decode_jwt.return_value = self.payload(tenant)
+            self.client.post('/actors', json={'name': f'{tenant} actor', 'age': 30, 'gender': 'Male'})
+            self.assertEqual(list(self.router.engines), [tenant])
+
+        mock_verify_decode_jwt.return_value = self.payload('acme')
+        self.assertEqual(self.actor_names(), ['acme actor'])
+        self.assertEqual(list(self.router.engines), ['acme'])
+
+    def test_tenants_required(self):
+        """Test tenant routing needs the list of tenants the worker serves"""
+
+        with self.assertRaises(ValueError):
+            create_app({
+                "SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'),
+                "AUDIT_LOG": "off",
+                "TENANT_ROUTING": "database",
+                "TENANT_DATABASE_URI": 'sqlite:///' + os.path.join(self.tenants_dir, '{tenant}.db'),
+                "TENANTS": []
+            })
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_tenant_exports_kept_apart(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test the export jobs of two tenants, both numbered 1, keep their own result files"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        permissions = ["get:actors", "post:actors", "get:jobs"]
+        with patch('jobs.job_results_dir', os.path.join(self.tenants_dir, 'results')):
+            for tenant in ['acme', 'globex']:
+                mock_verify_decode_jwt.return_value = self.payload(tenant, permissions)
+                self.client.post('/actors', json={'name': f'{tenant} actor', 'age': 30, 'gender': 'Male'})
+                job = json.loads(self.client.post('/jobs', json={'kind': 'export', 'entity': 'actors'}).data)['job']
+                self.assertEqual(job['id'], 1)
+
+            work(self.app, threading.Event(), burst=True)
+
+            for tenant in ['acme', 'globex']:
+                mock_verify_decode_jwt.return_value = self.payload(tenant, permissions)
+                res = self.client.get('/jobs/1/result')
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual([json.loads(line)['name'] for line in res.data.splitlines()], [f'{tenant} actor'])
+                res.close()
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_tenant_jobs_and_audit(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test the worker runs the jobs of every tenant, audited in the tenant's database"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        permissions = ["get:actors", "post:actors", "get:jobs", "get:audit"]
+        for tenant in ['acme', 'globex']:
+            mock_verify_decode_jwt.return_value = self.payload(tenant, permissions)
+            rows = [{'name': f'{tenant} actor{number}', 'age': 30, 'gender': 'Female'} for number in range(2)]
+            self.client.post('/jobs', json={'kind': 'import', 'entity': 'actors', 'rows': rows})
+
+        work(self.app, threading.Event(), burst=True)
+        self.audit.flush()
+
+        for tenant in ['acme', 'globex']:
+            mock_verify_decode_jwt.return_value = self.payload(tenant, permissions)
+            self.assertEqual(self.actor_names(), [f'{tenant} actor0', f'{tenant} actor1'])
+            events = json.loads(self.client.get('/audit').data)['events']
+            self.assertEqual({event['subject'] for event in events}, {f'{tenant}|admin'})
+            self.assertEqual(len(events), 2)
+
+
+class HttpCacheTestCase(unittest.TestCase):
+    """This class represents the Cache-Control and surrogate key purging test case"""
+
+    # Load environment variables from .env file
+    load_dotenv()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
+        self.purger = MemoryPurger()
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'),
+            "AUDIT_LOG": "off",
+            "CACHE_SHARED": "on",
+            "CACHE_MAX_AGE": 30,
+            "CACHE_PURGER": self.purger
+        })
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """Executed after reach test"""
+        with self.app.app_context():
+            db.drop_all()
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_cache_headers(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test the read routes' 200 responses carry their cache policy and surrogate keys"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {"permissions": ["get:actors", "get:actor", "get:movies", "get:movie", "post:actors"]}
+        actor = json.loads(self.client.post('/actors', json={'name': 'actor1', 'age': 30, 'gender': 'Male'}).data)['actor']
+
+        res1 = self.client.get(f'/actors/{actor["id"]}')
+        self.assertEqual(res1.headers['Cache-Control'], 'public, max-age=0, s-maxage=30')
+        self.assertEqual(res1.headers['Surrogate-Key'], f'actor-{actor["id"]}')
+        self.assertEqual(self.client.get('/actors').headers['Surrogate-Key'], 'actors-list')
+        self.assertEqual(self.client.get('/movies?count=exact').headers['Surrogate-Key'], 'movies-list')
+
+        res2 = self.client.get('/movies/1000')
+        self.assertEqual(res2.status_code, 404)
+        self.assertNotIn('Surrogate-Key', res2.headers)
+        self.assertNotIn('Cache-Control', self.client.post('/actors', json={'name': ''}).headers)
+
+        private_app = create_app({"SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'), "AUDIT_LOG": "off"})
+        res3 = private_app.test_client().get(f'/actors/{actor["id"]}')
+        self.assertEqual(res3.headers['Cache-Control'], 'private, no-cache')
+
+    @patch('auth.get_token_auth_header')  # Mocking the token extraction
+    @patch('auth.verify_decode_jwt')  # Mocking the JWT verification
+    def test_changes_purge_keys(self, mock_verify_decode_jwt, mock_get_token_auth_header):
+        """Test committed changes purge their keys, and rolled back ones don't"""
+
+        mock_get_token_auth_header.return_value = "mock_token"
+        mock_verify_decode_jwt.return_value = {
+            "sub": "importer",
+            "permissions": ["post:actors", "patch:actors", "delete:actors", "post:movies"]
+        }
+        actor = json.loads(self.client.post('/actors', json={'name': 'actor1', 'age': 30, 'gender': 'Male'}).data)['actor']
+        self.client.patch(f'/actors/{actor["id"]}', json={'age': 31})
+        self.client.delete(f'/actors/{actor["id"]}')
+        self.client.post('/movies', json={'title': ''})
+        keys = [f'actor-{actor["id"]}', 'actors-list']
+        self.assertEqual(self.purger.purged, keys * 3)
+
+        self.purger.purged.clear()
+        movie = json.loads(self.client.post('/movies', json={'title': 'movie1', 'release_date': '2001-02-03'}).data)['movie']
+        self.assertEqual(self.purger.purged, [f'movie-{movie["id"]}', 'movies-list'])
+
+        self.purger.purged.clear()
+        rows = [{'name': f'actor{number}', 'age': 30, 'gender': 'Female'} for number in range(2)]
+        self.client.post('/jobs', json={'kind': 'import', 'entity': 'actors', 'rows': rows})
+        with self.app.app_context():
+            run_pending_jobs('worker-1')
+            ids = sorted(actor.id for actor in Actor.query)
+        self.assertEqual(sorted(self.purger.purged), sorted([f'actor-{id}' for id in ids] + ['actors-list']))
+
+    def test_http_purger(self):
+        """Test the HTTP purger sends the queued keys to the proxy in the background"""
+
+        received = []
+
+        class PurgeHandler(http.server.BaseHTTPRequestHandler):
+            def do_PURGE(self):
+                received.append(self.headers['xkey'])
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), PurgeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            purger = HttpPurger(f'http://127.0.0.1:{server.server_port}/', header='xkey')
+            purger.purge(['actor-1', 'actors-list'])
+            deadline = time.monotonic() + 5
+            while not received and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(received, ['actor-1 actors-list'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_purger_interface(self):
+        """Test a purger must implement purge"""
+
+        class IncompletePurger(Purger):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompletePurger()
+
+    def test_shared_cache_refused_with_tenants(self):
+        """Test a shared cache can't be turned on for an app routing tenants"""
+
+        with self.assertRaises(ValueError):
+            create_app({
+                "SQLALCHEMY_DATABASE_URI": os.getenv('TEST_DATABASE_URI'),
+                "AUDIT_LOG": "off",
+                "CACHE_SHARED": "on",
+                "TENANT_ROUTING": "database",
+                "TENANT_DATABASE_URI": 'sqlite:///' + os.path.join(tempfile.gettempdir(), '{tenant}.db'),
+                "TENANTS": ['acme']
+            })
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,126 @@
+from datetime import date
+from models import Actor
+
+'''
+    Request-body validation for actors and movies
+
+    Each payload schema is compiled once, at import, into a tuple of
+    (field, required, check) so validating an item is a handful of
+    isinstance/len calls and never needs a database round trip
+    The validators are shared by every write path (create, update,
+    batch, import) and return the cleaned values to write
+'''
+
+'''
+ValidationError Exception
+A standardized way to communicate invalid payloads
+    errors: dict of field -> message
+    status_code: 400 for a missing field or a body that isn't an object,
+        422 for a value of the wrong type, length or format
+'''
+class ValidationError(Exception):
+    def __init__(self, errors, status_code):
+        self.errors = errors
+        self.status_code = status_code
+
+
+## Field checks
+## each returns (cleaned value, error message or None)
+
+def string(max_length=None):
+    def check(value):
+        if not isinstance(value, str):
+            return None, 'Must be a string.'
+        if max_length is not None and len(value) > max_length:
+            return None, f'Must be at most {max_length} characters.'
+        return value, None
+    return check
+
+
+def integer(minimum, maximum):
+    def check(value):
+        # bool is a subclass of int, but true/false isn't an age
+        if not isinstance(value, int) or isinstance(value, bool):
+            return None, 'Must be an integer.'
+        if not minimum <= value <= maximum:
+            return None, f'Must be between {minimum} and {maximum}.'
+        return value, None
+    return check
+
+
+def iso_date(value):
+    if not isinstance(value, str):
+        return None, 'Must be a date in YYYY-MM-DD format.'
+    try:
+        return date.fromisoformat(value), None
+    except ValueError:
+        return None, 'Must be a date in YYYY-MM-DD format.'
+
+
+'''
+    @INPUTS
+        schema: dict of field -> check (all fields are required on create)
+
+    Returns a validate(body, partial=False) function
+        partial: only validate the fields present in body (PATCH)
+    It raises ValidationError or returns a dict of cleaned values
+'''
+def compile_validator(schema):
+    checks = tuple(schema.items())
+
+    def validate(body, partial=False):
+        if not isinstance(body, dict):
+            raise ValidationError({'body': 'Must be a JSON object.'}, 400)
+
+        values = {}
+        missing = {}
+        invalid = {}
+        for field, check in checks:
+            if field not in body:
+                if not partial:
+                    missing[field] = 'This field is required.'
+                continue
+            value = body[field]
+            if value is None or value == '':
+                if partial:
+                    invalid[field] = 'This field can not be empty.'
+                else:
+                    missing[field] = 'This field is required.'
+                continue
+            cleaned, error = check(value)
+            if error is not None:
+                invalid[field] = error
+            else:
+                values[field] = cleaned
+
+        if missing:
+            raise ValidationError(missing, 400)
+        if invalid:
+            raise ValidationError(invalid, 422)
+        return values
+
+    return validate
+
+
+validate_actor = compile_validator({
+    'name': string(),
+    'age': integer(0, 150),
+    'gender': string(Actor.__table__.c.gender.type.length)
+})
+
+validate_movie = compile_validator({
+    'title': string(),
+    'release_date': iso_date
+})
+
+# the filters of GET /actors and GET /movies, as bulk jobs take them (see jobs.py)
+validate_actor_filters = compile_validator({
+    'gender': string(Actor.__table__.c.gender.type.length),
+    'min_age': integer(0, 150),
+    'max_age': integer(0, 150)
+})
+
+validate_movie_filters = compile_validator({
+    'released_from': iso_date,
+    'released_to': iso_date
+})